@@ -7,13 +7,23 @@ from docopt import docopt
 import numpy as np
 from pysilcam import __version__
 from pysilcam.acquisition import Acquire
+from pysilcam.fakepymba import image_timestamps
+from pysilcam.segments import silc_to_segments
 from pysilcam.background import backgrounder
 from pysilcam.process import processImage, statextract
 import pysilcam.oilgas as scog
+from pysilcam.postprocess import load_stats, stats_csv_to_h5
 from pysilcam.config import PySilcamSettings, updatePathLength
+from pysilcam.framepool import FramePool
+from pysilcam.scheduler import FrameScheduler
+from pysilcam.statswriter import StatsWriter, read_checkpoint, checkpoint_filename
+from pysilcam.statsfile import stats_h5_rows, truncate_stats_h5
 import os
+import itertools
 import pysilcam.silcam_classify as sccl
+import pysilcam.metrics as scmet
 import multiprocessing
+import queue
 from multiprocessing.managers import BaseManager
 from queue import LifoQueue
 import psutil
@@ -41,8 +51,9 @@ def silcam():
 
     Usage:
       silcam acquire <configfile> <datapath>
-      silcam process <configfile> <datapath> [--nbimages=<number of images>] [--nomultiproc] [--appendstats]
+      silcam process <configfile> <datapath> [--nbimages=<number of images>] [--nomultiproc] [--appendstats] [--chunked]
       silcam realtime <configfile> <datapath> [--discwrite] [--nomultiproc] [--appendstats]
+      silcam convert <datapath> [--framespersegment=<number of images>]
       silcam -h | --help
       silcam --version
 
@@ -50,12 +61,15 @@ def silcam():
         acquire     Acquire images
         process     Process images
         realtime    Acquire images from the camera and process them in real time
+        convert     Convert a folder of .silc files to segment files
 
     Options:
       --nbimages=<number of images>     Number of images to process.
       --discwrite                       Write images to disc.
       --nomultiproc                     Deactivate multiprocessing.
       --appendstats                     Appends data to output STATS.csv file. If not specified, the STATS.csv file will be overwritten!
+      --chunked                         Process independent time chunks of the data in parallel, including background correction.
+      --framespersegment=<number of images>  Number of images in each segment file [default: 100].
       -h --help                         Show this screen.
       --version                         Show version.
 
@@ -88,8 +102,12 @@ def silcam():
                 sys.exit(0)
         if args['--appendstats']:
             overwriteSTATS = False  # if you want to append to the stats file, then overwriting should be False
-        silcam_process(args['<configfile>'], datapath, multiProcess=multiProcess, realtime=False,
-                       nbImages=nbImages, overwriteSTATS=overwriteSTATS)
+        if args['--chunked'] and multiProcess:
+            silcam_process_chunked(args['<configfile>'], datapath, nbImages=nbImages,
+                                   overwriteSTATS=overwriteSTATS)
+        else:
+            silcam_process(args['<configfile>'], datapath, multiProcess=multiProcess, realtime=False,
+                           nbImages=nbImages, overwriteSTATS=overwriteSTATS)
 
     elif args['acquire']:  # this is the standard acquisition method under development now
         silcam_acquire(datapath, args['<configfile>'], writeToDisk=True)
@@ -106,6 +124,14 @@ def silcam():
         silcam_process(args['<configfile>'], datapath, multiProcess=multiProcess, realtime=True,
                        discWrite=discWrite, overwriteSTATS=overwriteSTATS)
 
+    elif args['convert']:
+        try:
+            frames_per_segment = int(args['--framespersegment'])
+        except ValueError:
+            print('Expected type int for --framespersegment.')
+            sys.exit(0)
+        silc_to_segments(datapath, frames_per_segment=frames_per_segment)
+
 
 def silcam_acquire(datapath, config_filename, writeToDisk=True, gui=None):
     '''Aquire images from the SilCam
@@ -138,7 +164,11 @@ def silcam_acquire(datapath, config_filename, writeToDisk=True, gui=None):
     # update path_length
     updatePathLength(settings, logger)
 
-    acq = Acquire(USE_PYMBA=True)  # ini class
+    acq = Acquire(USE_PYMBA=True,
+                  frames_per_segment=getattr(settings.General, 'frames_per_segment', None),
+                  write_queue_size=getattr(settings.General, 'write_queue_size', 20),
+                  write_policy=getattr(settings.General, 'write_policy', 'block'),
+                  stream_buffers=getattr(settings.General, 'stream_buffers', None))  # ini class
     t1 = time.time()
 
     aqgen = acq.get_generator(datapath, camera_config_file=config_filename, writeToDisk=writeToDisk)
@@ -204,6 +234,7 @@ def silcam_process(config_filename, datapath, multiProcess=True, realtime=False,
 
     # Configure logging
     configure_logger(settings.General)
+    configure_metrics(settings.General)
     logger = logging.getLogger(__name__ + '.silcam_process')
 
     logger.info('Processing path: ' + datapath)
@@ -226,18 +257,35 @@ def silcam_process(config_filename, datapath, multiProcess=True, realtime=False,
     datafilename = os.path.join(settings.General.datafile, procfoldername)
     logger.info('output stats to: ' + datafilename)
 
-    adminSTATS(logger, settings, overwriteSTATS, datafilename, datapath)
+    # images already done by the run that is resumed (if any) are not processed again
+    resume = adminSTATS(logger, settings, overwriteSTATS, datafilename, datapath)
 
     # Initialize the image acquisition generator
-    aq = Acquire(USE_PYMBA=realtime)
+    aq = Acquire(USE_PYMBA=realtime,
+                 frames_per_segment=getattr(settings.General, 'frames_per_segment', None),
+                 write_queue_size=getattr(settings.General, 'write_queue_size', 20),
+                 write_policy=getattr(settings.General, 'write_policy', 'block'),
+                 stream_buffers=getattr(settings.General, 'stream_buffers', None))
     aqgen = aq.get_generator(datapath, writeToDisk=discWrite,
                              camera_config_file=config_filename)
 
     # Get number of images to use for background correction from config
     print('* Initializing background image handler')
+    # the background is saved to a snapshot at intervals if snapshot_interval is set, so that a
+    # restarted session can use it straight away
+    snapshot_file = None
+    snapshot_interval = getattr(settings.Background, 'snapshot_interval', None)
+    if snapshot_interval is not None:
+        snapshot_file = datafilename + '-BACKGROUND'
+    # with a mono channel the corrected images are single-channel, and the colour raw images
+    # are passed on with them for the particle rois
+    mono_channel = getattr(settings.Process, 'mono_channel', None)
     bggen = backgrounder(settings.Background.num_images, aqgen,
                          bad_lighting_limit=settings.Process.bad_lighting_limit,
-                         real_time_stats=settings.Process.real_time_stats)
+                         real_time_stats=settings.Process.real_time_stats,
+                         snapshot_file=snapshot_file, snapshot_interval=snapshot_interval,
+                         snapshot_max_gap=getattr(settings.Background, 'snapshot_max_gap', 10.),
+                         mono_channel=mono_channel)
 
     # Create export directory if needed
     if settings.ExportParticles.export_images:
@@ -266,8 +314,36 @@ def silcam_process(config_filename, datapath, multiProcess=True, realtime=False,
         logger.debug('setting up processing queues')
         inputQueue, outputQueue = defineQueues(realtime, distributor_q_size)
 
+        # the first corrected image gives the size of the shared frame buffers.
+        # There is one buffer for each image that can wait in the queue, plus one for each worker
+        first_image = next(bggen, None)
+        frame_shape = (0,)
+        raw_shape = None
+        if first_image is not None:
+            frame_shape = first_image[1].shape
+            if mono_channel is not None:
+                raw_shape = first_image[2].shape
+            bggen = itertools.chain([first_image], bggen)
+        frame_pool = FramePool(distributor_q_size + multiprocessing.cpu_count(), frame_shape,
+                               raw_shape=raw_shape)
+
         logger.debug('setting up processing distributor')
-        distributor(inputQueue, outputQueue, config_filename, proc_list, gui)
+        classifier_server = distributor(inputQueue, outputQueue, config_filename, proc_list, gui,
+                                        frame_pool)
+
+        # in realtime mode the images to skip are chosen when the workers cannot keep up,
+        # and every image acquired is recorded in the frames log
+        scheduler = None
+        if realtime:
+            scheduler = FrameScheduler(frame_pool.nb_slots, target=len(proc_list) + distributor_q_size // 2,
+                                       policy=getattr(settings.Process, 'shed_policy', 'newest'),
+                                       frames_log=datafilename + '-FRAMES.csv')
+
+        # the stats are written by a separate thread, so the acquisition never waits for the output files
+        logger.debug('Starting stats writer')
+        stats_writer = StatsWriter(datafilename, outputQueue, len(proc_list),
+                                   on_stats=lambda stats: collect_rts(settings, rts, stats))
+        stats_writer.start()
 
         # iterate on the bggen generator to obtain images
         logger.debug('Starting acquisition loop')
@@ -275,7 +351,7 @@ def silcam_process(config_filename, datapath, multiProcess=True, realtime=False,
         for i, (timestamp, imc, imraw) in enumerate(bggen):
             t1 = np.copy(t2)
             t2 = time.time()
-            print(t2 - t1, 'Acquisition loop time')
+            logger.debug('Acquisition loop time: {0:.3f} s'.format(t2 - t1))
             logger.debug('Corrected image ' + str(timestamp) +
                          ' acquired from backgrounder')
 
@@ -284,16 +360,42 @@ def silcam_process(config_filename, datapath, multiProcess=True, realtime=False,
                 if (nbImages <= i):
                     break
 
-            logger.debug('Adding image to processing queue: ' + str(timestamp))
-            addToQueue(realtime, inputQueue, i, timestamp,
-                       imc)  # the tuple (i, timestamp, imc) is added to the inputQueue
-            logger.debug('Processing queue updated')
+            if stats_writer.error is not None:
+                logger.error('Acquisition stopped, the stats cannot be written')
+                break
+
+            if is_processed(timestamp, *resume):
+                logger.debug('Image already in the stats: ' + str(timestamp))
+                outputQueue.put((i, timestamp, None))
+                continue
+
+            queue_image, reason = True, ''
+            if scheduler is not None:
+                queue_image, reason = scheduler.select(imc, frame_pool.in_use())
+
+            if queue_image:
+                logger.debug('Adding image to processing queue: ' + str(timestamp))
+                with scmet.timer('queue_wait'):
+                    if not addToQueue(realtime, inputQueue, i, timestamp,
+                                      imc, frame_pool,  # the tuple (i, timestamp, slot) is added to the inputQueue
+                                      imraw=imraw if mono_channel is not None else None):
+                        reason = 'full'
+                logger.debug('Processing queue updated')
+            else:
+                logger.debug('Image skipped ({0}): {1}'.format(reason, timestamp))
+                scmet.count('frames_skipped')
+            if reason:
+                # the stats writer is told about skipped images, so the checkpoint can move past them
+                outputQueue.put((i, timestamp, None))
+            if scheduler is not None:
+                scheduler.record(i, timestamp, reason)
+            try:
+                scmet.gauge('input_queue_depth', inputQueue.qsize())
+            except NotImplementedError:
+                pass
+            scmet.end_frame()
 
-            # write the images that are available for the moment into the csv file
-            logger.debug('Running collector')
-            collector(inputQueue, outputQueue, datafilename, proc_list, False,
-                      settings, rts=rts)
-            logger.debug('Data collected')
+            logger.debug('Stats writer: {0}'.format(stats_writer.metrics()))
 
             if not gui == None:
                 logger.debug('Putting data on GUI Queue')
@@ -315,26 +417,43 @@ def silcam_process(config_filename, datapath, multiProcess=True, realtime=False,
                 logger.debug('GUI queue updated')
 
         logger.debug('Acquisition loop completed')
-        if (not realtime):
-            logger.debug('Halting processes')
-            for p in proc_list:
-                inputQueue.put(None)
+        if scheduler is not None:
+            scheduler.close()
+        if realtime:
+            # the workers take the newest image first, so they would stop before the images
+            # still waiting in the queue if they were told to stop now. Wait until every
+            # buffer is released (no image waiting or being processed, and their stats in the output queue)
+            logger.debug('Waiting for the images in flight')
+            while frame_pool.in_use() > 0 and any(p.is_alive() for p in proc_list):
+                time.sleep(0.1)
+        logger.debug('Halting processes')
+        for p in proc_list:
+            inputQueue.put(None)
 
         # some images might still be waiting to be written to the csv file
-        logger.debug('Running collector on left over data')
-        collector(inputQueue, outputQueue, datafilename, proc_list, True,
-                  settings, rts=rts)
+        logger.debug('Waiting for the stats writer')
+        stats_writer.join()
         logger.debug('All data collected')
 
         for p in proc_list:
             p.join()
             logger.info('%s.exitcode = %s' % (p.name, p.exitcode))
 
+        if classifier_server is not None:
+            classifier_server.stop()
+            logger.info('%s.exitcode = %s' % (classifier_server.name, classifier_server.exitcode))
+
     else: # no multiprocessing
         # load the model for particle classification and keep it for later
         nnmodel = []
         nnmodel, class_labels = sccl.load_model(model_path=settings.NNClassify.model_path)
 
+        # the stats are written by a separate thread while the next image is processed
+        stats_queue = queue.Queue()
+        stats_writer = StatsWriter(datafilename, stats_queue,
+                                   on_stats=lambda stats: collect_rts(settings, rts, stats))
+        stats_writer.start()
+
         # iterate on the bggen generator to obtain images
         for i, (timestamp, imc, imraw) in enumerate(bggen):
             # handle errors if the loop function fails for any reason
@@ -342,20 +461,227 @@ def silcam_process(config_filename, datapath, multiProcess=True, realtime=False,
                 if (nbImages <= i):
                     break
 
+            if stats_writer.error is not None:
+                logger.error('Acquisition stopped, the stats cannot be written')
+                break
+
+            if is_processed(timestamp, *resume):
+                logger.debug('Image already in the stats: ' + str(timestamp))
+                stats_queue.put((i, timestamp, None))
+                continue
+
             image = (i, timestamp, imc)
+            if mono_channel is not None:
+                image += (imraw,)
             # one single image is processed at a time
             stats_all = processImage(nnmodel, class_labels, image, settings, logger, gui)
 
-            if (not stats_all is None):  # if frame processed
-                # write the image into the csv file
-                writeCSV(datafilename, stats_all)
+            # write the image into the csv file (stats_all is None if the frame gave no stats)
+            stats_queue.put((i, timestamp, stats_all))
+
+        stats_queue.put(None)
+        stats_writer.join()
+
+    scmet.export()
+    if stats_writer.error is not None:
+        raise RuntimeError('Stats were not all written: {0}'.format(stats_writer.error))
 
     print('PROCESSING COMPLETE.')
 
     # ---- END ----
 
 
-def addToQueue(realtime, inputQueue, i, timestamp, imc):
+def silcam_process_chunked(config_filename, datapath, nbImages=None, overwriteSTATS=True, nb_chunks=None):
+    '''Run processing of SilCam images from disc, in independent time chunks processed in parallel
+
+    The sorted images are split into contiguous chunks. Each chunk is read, background corrected
+    and processed by its own process, starting Background.num_images images before the chunk
+    so that its background is the same as in a serial run. The stats of the chunks are written
+    in time order, so the output is the same as that of silcam_process().
+
+    The background of a serial run depends on all the images rejected for bad lighting before,
+    so if Process.bad_lighting_limit is set, silcam_process() is used instead.
+
+    Args:
+      config_filename   (str)               :  The filename (including path) of the config.ini file
+      datapath          (str)               :  Path to the data directory
+      nbImages=None     (int)               :  Number of images to process
+      overwriteSTATS=True (bool)            :  If False, the stats are appended to an existing -STATS.csv file
+      nb_chunks=None    (int)               :  Number of chunks the data are split into
+                                               (defaults to the number of processes used, with
+                                               at most about 1000 images per chunk)
+    '''
+    settings = PySilcamSettings(config_filename)
+    configure_logger(settings.General)
+    configure_metrics(settings.General)
+    logger = logging.getLogger(__name__ + '.silcam_process_chunked')
+
+    if settings.Process.bad_lighting_limit is not None:
+        logger.info('bad_lighting_limit is set: processing the chunks in sequence')
+        silcam_process(config_filename, datapath, nbImages=nbImages, overwriteSTATS=overwriteSTATS)
+        return
+
+    logger.info('Processing path: ' + datapath)
+
+    if (not os.path.isdir(settings.General.datafile)):
+        logger.info('Folder ' + settings.General.datafile + ' was not found and is created')
+        os.mkdir(settings.General.datafile)
+
+    procfoldername = os.path.split(datapath)[-1]
+    datafilename = os.path.join(settings.General.datafile, procfoldername)
+    logger.info('output stats to: ' + datafilename)
+
+    resume = adminSTATS(logger, settings, overwriteSTATS, datafilename, datapath)
+
+    if settings.ExportParticles.export_images:
+        if (not os.path.isdir(settings.ExportParticles.outputpath)):
+            logger.info('Export folder ' + settings.ExportParticles.outputpath + ' was not found and is created')
+            os.mkdir(settings.ExportParticles.outputpath)
+
+    # the images are read from the same offset as by the acquisition of silcam_process()
+    offset = int(os.environ.get('PYSILCAM_OFFSET', 0))
+    nb_files = len(image_timestamps(datapath)[offset:])
+    if nbImages is not None:
+        nb_files = min(nb_files, settings.Background.num_images + nbImages)
+
+    nb_processes = max(1, multiprocessing.cpu_count() - 1)
+    if nb_chunks is None:
+        # the stats of a chunk are held in memory until it is written, so limit the chunk length
+        nb_chunks = max(nb_processes, int(np.ceil((nb_files - settings.Background.num_images) / 1000)))
+    chunks = chunk_ranges(nb_files, settings.Background.num_images, nb_chunks)
+    logger.info('Processing {0} images in {1} chunks'.format(
+        nb_files - settings.Background.num_images, len(chunks)))
+
+    rts = scog.rt_stats(settings)
+    stats_queue = queue.Queue()
+    stats_writer = StatsWriter(datafilename, stats_queue,
+                               on_stats=lambda stats: collect_rts(settings, rts, stats))
+    stats_writer.start()
+
+    tasks = [(datapath, offset + start, first_image, end - start, resume) for start, first_image, end in chunks]
+    pool = multiprocessing.Pool(min(nb_processes, max(1, len(chunks))), initializer=init_chunk_process,
+                                initargs=(config_filename,))
+    try:
+        # the chunks are returned in order, so the stats are written in time order
+        for chunk_stats in pool.imap(process_chunk, tasks):
+            if stats_writer.error is not None:
+                logger.error('Processing stopped, the stats cannot be written')
+                break
+            for image_stats in chunk_stats:
+                stats_queue.put(image_stats)
+    finally:
+        if stats_writer.error is not None:
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+
+    stats_queue.put(None)
+    stats_writer.join()
+    if stats_writer.error is not None:
+        raise RuntimeError('Stats were not all written: {0}'.format(stats_writer.error))
+
+    print('PROCESSING COMPLETE.')
+
+
+def chunk_ranges(nb_files, nb_background, nb_chunks):
+    '''
+    Splits the images into contiguous chunks that can be processed independently
+
+    The first nb_background images only make the background. Each chunk starts
+    nb_background images before the first image it processes, to build the same
+    background as a serial run.
+
+    Args:
+        nb_files (int)          : number of images
+        nb_background (int)     : number of images used for the background (Background.num_images)
+        nb_chunks (int)         : number of chunks wanted
+
+    Returns:
+        chunks (list)           : (start, first_image, end) of each chunk, where images start:end are read,
+                                  and images first_image:end are processed
+    '''
+    nb_images = nb_files - nb_background
+    if nb_images <= 0:
+        return []
+
+    # keep the chunks long enough for the warm-up images not to dominate
+    nb_chunks = max(1, min(nb_chunks, nb_images // max(1, nb_background)))
+    edges = nb_background + np.round(np.linspace(0, nb_images, nb_chunks + 1)).astype(int)
+
+    return [(int(first) - nb_background, int(first), int(end)) for first, end in zip(edges[:-1], edges[1:])]
+
+
+# model and settings of a chunk process, loaded once by init_chunk_process()
+_chunk_process = {}
+
+
+def init_chunk_process(config_filename):
+    '''
+    Loads the settings and the classification model in a chunk process
+
+    Args:
+        config_filename (str)   : path of the config ini file
+    '''
+    settings = PySilcamSettings(config_filename)
+    configure_logger(settings.General)
+    configure_metrics(settings.General)
+
+    # a tensorflow session must be started on each process in order to function reliably in multiprocess.
+    import tensorflow as tf
+    _chunk_process['sess'] = tf.Session()
+    nnmodel, class_labels = sccl.load_model(model_path=settings.NNClassify.model_path)
+
+    _chunk_process['settings'] = settings
+    _chunk_process['nnmodel'] = nnmodel
+    _chunk_process['class_labels'] = class_labels
+    _chunk_process['logger'] = logging.getLogger(__name__ + '.silcam_process')
+
+
+def process_chunk(task):
+    '''
+    Acquires, background corrects and processes one chunk of images from disc
+
+    Args:
+        task (tuple)            : (datapath, start, first_image, nb_read, resume) where start is the index
+                                  of the first image read, first_image the index of the first image processed,
+                                  nb_read the number of images read and resume the images already done,
+                                  returned from adminSTATS(), which are not processed again
+
+    Returns:
+        chunk_stats (list)      : (i, timestamp, stats) of each image, in time order, where stats is
+                                  the dataframe returned from processImage() or None
+    '''
+    datapath, start, first_image, nb_read, resume = task
+    settings = _chunk_process['settings']
+
+    os.environ['PYSILCAM_OFFSET'] = str(start)
+    aq = Acquire(USE_PYMBA=False)
+    aqgen = itertools.islice(aq.get_generator(datapath), nb_read)
+    mono_channel = getattr(settings.Process, 'mono_channel', None)
+    bggen = backgrounder(settings.Background.num_images, aqgen,
+                         real_time_stats=settings.Process.real_time_stats,
+                         mono_channel=mono_channel)
+
+    chunk_stats = []
+    for i, (timestamp, imc, imraw) in enumerate(bggen):
+        # number the images as a serial run does
+        i = first_image - settings.Background.num_images + i
+        if is_processed(timestamp, *resume):
+            chunk_stats.append((i, timestamp, None))
+            continue
+        image = (i, timestamp, imc)
+        if mono_channel is not None:
+            image += (imraw,)
+        stats_all = processImage(_chunk_process['nnmodel'], _chunk_process['class_labels'], image,
+                                 settings, _chunk_process['logger'], None)
+        chunk_stats.append((i, timestamp, stats_all))
+
+    scmet.export()
+    return chunk_stats
+
+
+def addToQueue(realtime, inputQueue, i, timestamp, imc, frame_pool=None, imraw=None):
     '''
     Put a new image into the Queue.
 
@@ -366,19 +692,39 @@ def addToQueue(realtime, inputQueue, i, timestamp, imc):
         i            (int)      : index of the image acquired
         timestamp    (timestamp): timestamp of the acquired image
         imc          (uint8)    : corrected image
+        frame_pool=None (FramePool) : shared buffers used to pass the image to the workers.
+                                  If given, only the slot index of the image is put in the queue
+        imraw=None   (uint8)    : colour raw image passed on with a single-channel imc, for the particle rois
+
+    Returns:
+        queued       (bool)     : False if the image was dropped because the queue or the buffers were full
     '''
+    if frame_pool is None:
+        task = (i, timestamp, imc) if imraw is None else (i, timestamp, imc, imraw)
+    else:
+        # in realtime mode the image is dropped if all buffers are in use
+        slot = frame_pool.put(imc, timeout=0.01 if realtime else None, imraw=imraw)
+        if slot is None:
+            scmet.count('frames_dropped')
+            return False
+        task = (i, timestamp, slot)
+
     if (realtime):
         try:
-            inputQueue.put_nowait((i, timestamp, imc))
+            inputQueue.put_nowait(task)
         except:
-            pass
+            scmet.count('frames_dropped')
+            if frame_pool is not None:
+                frame_pool.release(task[2])
+            return False
     else:
         while True:
             try:
-                inputQueue.put((i, timestamp, imc), True, 0.5)
+                inputQueue.put(task, True, 0.5)
                 break
             except:
                 pass
+    return True
 
 
 def defineQueues(realtime, size):
@@ -399,7 +745,8 @@ def defineQueues(realtime, size):
 
 def createLIFOQueues(size):
     '''
-    Create a LIFOQueue (Last In First Out)
+    Create a LIFOQueue (Last In First Out) for the images, so the newest image is processed first.
+    The output queue is FIFO, so the None put by each process after its stats comes out after them
 
     Args:
         size: max size of the queue
@@ -411,7 +758,7 @@ def createLIFOQueues(size):
     manager = MyManager()
     manager.start()
     inputQueue = manager.LifoQueue(size)
-    outputQueue = manager.LifoQueue(size)
+    outputQueue = multiprocessing.Queue(size)
     return inputQueue, outputQueue
 
 
@@ -441,7 +788,7 @@ class MyManager(BaseManager):
 MyManager.register('LifoQueue', LifoQueue)
 
 
-def loop(config_filename, inputQueue, outputQueue, gui=None):
+def loop(config_filename, inputQueue, outputQueue, gui=None, classifier=None, frame_pool=None):
     '''
     Main processing loop, run for each image
 
@@ -453,42 +800,72 @@ def loop(config_filename, inputQueue, outputQueue, gui=None):
                                   initilised using defineQueues()
         gui=None (Class object) : Queue used to pass information between process thread and GUI
                                   initialised in ProcThread within guicals.py
+        classifier=None         : ClassifierClient used instead of loading the model in this
+                                  process, obtained from sccl.ClassifierServer.get_client()
+        frame_pool=None (FramePool) : shared buffers holding the images. If given, the tasks
+                                  in inputQueue contain slot indexes instead of images
     '''
     settings = PySilcamSettings(config_filename)
     configure_logger(settings.General)
+    configure_metrics(settings.General)
     logger = logging.getLogger(__name__ + '.silcam_process')
 
-    # load the model for particle classification and keep it for later
+    sess = None
+    if classifier is not None:
+        # the model lives in the classifier server, so only the labels are needed here
+        nnmodel = classifier
+        class_labels = sccl.get_class_labels(model_path=settings.NNClassify.model_path)
+    else:
+        # load the model for particle classification and keep it for later
 
-    # a tensorflow session must be started on each process in order to function reliably in multiprocess.
-    # This also includes the import of tensorflow on each process
-    # @todo the loading of the model and prediction functions should be within a class that is initialized by starting a
-    #  tensorflow session, then this will be cleaner.
-    import tensorflow as tf
-    sess = tf.Session()
+        # a tensorflow session must be started on each process in order to function reliably in multiprocess.
+        # This also includes the import of tensorflow on each process
+        # @todo the loading of the model and prediction functions should be within a class that is initialized by starting a
+        #  tensorflow session, then this will be cleaner.
+        import tensorflow as tf
+        sess = tf.Session()
 
-    nnmodel = []
-    nnmodel, class_labels = sccl.load_model(model_path=settings.NNClassify.model_path)
+        nnmodel = []
+        nnmodel, class_labels = sccl.load_model(model_path=settings.NNClassify.model_path)
 
     while True:
         task = inputQueue.get()
         if task is None:
             outputQueue.put(None)
             break
-        stats_all = processImage(nnmodel, class_labels, task, settings, logger, gui)
 
-        if (not stats_all is None):
-            outputQueue.put(stats_all)
+        i, timestamp = task[:2]
+        if frame_pool is None:
+            stats_all = processImage(nnmodel, class_labels, task, settings, logger, gui)
         else:
+            slot = task[2]
+            image = (i, timestamp, frame_pool.frame(slot))
+            if frame_pool.raw_shape is not None:
+                image += (frame_pool.raw(slot),)
+            try:
+                stats_all = processImage(nnmodel, class_labels, image, settings, logger, gui)
+            except:
+                frame_pool.release(slot)
+                raise
+
+        # the stats writer is told about every image, also those without stats
+        if stats_all is None:
             logger.info('No stats found.')
+        outputQueue.put((i, timestamp, stats_all))
+        if frame_pool is not None:
+            # the buffer is released once the stats are in the queue, so that no image
+            # is still on its way to the stats writer when all buffers are free
+            frame_pool.release(slot)
 
     # close of the tensorflow session when everything is finished.
     # unsure of behaviour if things crash or are stoppped before reaching this point
-    sess.close()
+    if sess is not None:
+        sess.close()
+    scmet.export()
     return
 
 
-def distributor(inputQueue, outputQueue, config_filename, proc_list, gui=None):
+def distributor(inputQueue, outputQueue, config_filename, proc_list, gui=None, frame_pool=None):
     '''
     distributes the images in the input queue to the different loop processes
     Args:
@@ -499,50 +876,32 @@ def distributor(inputQueue, outputQueue, config_filename, proc_list, gui=None):
         proc_list   (list)          : list of multiprocessing objects
         gui=None (Class object)     : Queue used to pass information between process thread and GUI
                                       initialised in ProcThread within guicals.py
+        frame_pool=None (FramePool) : shared buffers holding the images to be processed
+
+    Returns:
+        classifier_server           : the sccl.ClassifierServer shared by the loop processes,
+                                      or None if each process loads its own model
     '''
 
     numCores = max(1, multiprocessing.cpu_count() - 2)
 
+    # optionally let one process own the model and classify rois for all workers
+    settings = PySilcamSettings(config_filename)
+    classifier_server = None
+    if getattr(settings.NNClassify, 'inference_server', False):
+        classifier_server = sccl.ClassifierServer(settings.NNClassify.model_path, numCores)
+        classifier_server.start()
+
     for nbCore in range(numCores):
-        proc = multiprocessing.Process(target=loop, args=(config_filename, inputQueue, outputQueue, gui))
+        classifier = None
+        if classifier_server is not None:
+            classifier = classifier_server.get_client(nbCore)
+        proc = multiprocessing.Process(target=loop, args=(config_filename, inputQueue, outputQueue, gui,
+                                                          classifier, frame_pool))
         proc_list.append(proc)
         proc.start()
 
-
-def collector(inputQueue, outputQueue, datafilename, proc_list, testInputQueue,
-              settings, rts=None):
-    '''
-    collects all the results and write them into the stats.csv file
-
-    Args:
-        inputQueue  ()              : queue where the images are added for processing
-                                      initilised using defineQueues()
-        outputQueue ()              : queue where information is retrieved from processing
-                                      initilised using defineQueues()
-        datafilename (str)          : filename where processed data are written to csv
-        proc_list   (list)          : list of multiprocessing objects
-        testInputQueue (Bool)       : if True function will keep collecting until inputQueue is empty
-        settings (PySilcamSettings) : Settings read from a .ini file
-        rts (Class):                : Class for realtime stats
-    '''
-
-    countProcessFinished = 0
-
-    while ((outputQueue.qsize() > 0) or (testInputQueue and inputQueue.qsize() > 0)):
-
-        task = outputQueue.get()
-
-        if (task is None):
-            countProcessFinished = countProcessFinished + 1
-            if (len(proc_list) == 0):  # no multiprocessing
-                break
-            # The collector can be stopped only after all loop processes are finished
-            elif (countProcessFinished == len(proc_list)):
-                break
-            continue
-
-        writeCSV(datafilename, task)
-        collect_rts(settings, rts, task)
+    return classifier_server
 
 
 def collect_rts(settings, rts, stats_all):
@@ -558,39 +917,12 @@ def collect_rts(settings, rts, stats_all):
         stats_all (DataFrame)       :  stats dataframe returned from processImage()
     '''
     if settings.Process.real_time_stats:
-        try:
-            rts.stats = rts.stats().append(stats_all)
-        except:
-            rts.stats = rts.stats.append(stats_all)
-        rts.update()
+        rts.update(stats_all)
         filename = os.path.join(settings.General.datafile,
                                 'OilGasd50.csv')
         rts.to_csv(filename)
 
 
-def writeCSV(datafilename, stats_all):
-    '''
-    Writes particle stats into the csv ouput file
-
-    Args:
-        datafilename (str):     filame prefix for -STATS.csv file that may or may not include a path
-        stats_all (DataFrame):  stats dataframe returned from processImage()
-    '''
-
-    # create or append particle statistics to output file
-    # if the output file does not already exist, create it
-    # otherwise data will be appended
-    # @todo accidentally appending to an existing file could be dangerous
-    # because data will be duplicated (and concentrations would therefore
-    # double) GUI promts user regarding this - directly-run functions are more dangerous.
-    if not os.path.isfile(datafilename + '-STATS.csv'):
-        stats_all.to_csv(datafilename +
-                         '-STATS.csv', index_label='particle index')
-    else:
-        stats_all.to_csv(datafilename + '-STATS.csv',
-                         mode='a', header=False)
-
-
 def check_path(filename):
     '''Check if a path exists, and create it if not
 
@@ -624,41 +956,78 @@ def configure_logger(settings):
         logging.basicConfig(level=getattr(logging, settings.loglevel))
 
 
+def configure_metrics(settings):
+    '''Set up the export of the timing metrics of this process according to the settings.
+
+    Args:
+        settings (PySilcamSettings): Settings read from a .ini file
+                                     settings.metrics_file, settings.metrics_format
+                                     and settings.metrics_interval are optional
+    '''
+    scmet.configure(getattr(settings, 'metrics_file', None),
+                    fmt=getattr(settings, 'metrics_format', 'prometheus'),
+                    interval=getattr(settings, 'metrics_interval', 10.))
+
+
 def adminSTATS(logger, settings, overwriteSTATS, datafilename, datapath):
     '''
-    Administration of the -STATS.csv file
+    Administration of the -STATS.csv and -STATS.h5 files
+
+    When appending, processing resumes after the last image already in the stats.
+    If the previous run left a checkpoint manifest (-CHECKPOINT.json), the output
+    files are cut back to the last checkpoint and processing resumes after the last
+    image before which every image was done, without reading the old stats back.
+
+    The images are read from Background.num_images images before the resume point,
+    to build the background. If the background is loaded from a snapshot instead,
+    these images are yielded by the backgrounder, so they (and the images after the
+    resume point that are already in the stats) must be skipped with is_processed().
 
     Args:
         logger          (logger object) : logger object created using configure_logger()
         datafilename    (str)           : name of the folder containing the -STATS.csv
         datapath        (str)           : name of the path containing the data
 
+    Returns:
+        resume (tuple)                  : (last_time, written) where every image up to last_time is done
+                                          (NaT if not appending), and written holds the timestamps of the
+                                          images after it that are already in the stats
     '''
+    last_time = pd.NaT
+    written = set()
+    if overwriteSTATS and os.path.isfile(datafilename + '-STATS.h5'):
+        logger.info('removing: ' + datafilename + '-STATS.h5')
+        os.remove(datafilename + '-STATS.h5')
+
+    if overwriteSTATS and os.path.isfile(checkpoint_filename(datafilename)):
+        logger.info('removing: ' + checkpoint_filename(datafilename))
+        os.remove(checkpoint_filename(datafilename))
+
     if (os.path.isfile(datafilename + '-STATS.csv')):
         if overwriteSTATS:
             logger.info('removing: ' + datafilename + '-STATS.csv')
             print('Overwriting ' + datafilename + '-STATS.csv')
             os.remove(datafilename + '-STATS.csv')
         else:
-            logger.info('Loading old data from: ' + datafilename + '-STATS.csv')
-            print('Loading old data from: ' + datafilename + '-STATS.csv')
-            oldstats = pd.read_csv(datafilename + '-STATS.csv')
-            logger.info('  OK.')
-            print('  OK.')
-            last_time = pd.to_datetime(oldstats['timestamp'].max())
+            resume = resume_from_checkpoint(logger, datafilename)
+            if resume is not None:
+                last_time, written = resume
+            else:
+                logger.info('Loading old data from: ' + datafilename + '-STATS.csv')
+                print('Loading old data from: ' + datafilename + '-STATS.csv')
+                # the new data will be appended to both files, so re-write the -STATS.h5 file
+                # from the -STATS.csv file, which also holds any frames written after the last
+                # -STATS.h5 update of an interrupted run
+                stats_csv_to_h5(datafilename + '-STATS.csv')
+                oldstats = load_stats(datafilename + '-STATS.csv')
+                logger.info('  OK.')
+                print('  OK.')
+                last_time = pd.to_datetime(oldstats['timestamp'].max())
 
             logger.info('Calculating spooling offset')
             print('Calculating spooling offset')
 
-            # TODO: move this import to the top
-            from pysilcam.fakepymba import silcam_name2time
-            files = [f for f in sorted(os.listdir(datapath))
-                     if (f.endswith('.silc') or f.endswith('.bmp'))]
-            offsetcalc = pd.DataFrame(columns=['files', 'times'])
-            offsetcalc['files'] = files
-            for i, f in enumerate(files):
-                offsetcalc['times'].iloc[i] = silcam_name2time(f)
-            offset = int(min(np.argwhere(offsetcalc['times'] > last_time)))
+            offset = resume_offset(datapath, last_time)
             offset -= settings.Background.num_images  # subtract the number of background images, so we get data from the correct start point
             # and check offset is still positive
             if offset < 0:
@@ -666,4 +1035,76 @@ def adminSTATS(logger, settings, overwriteSTATS, datafilename, datapath):
             offset = str(offset)
             os.environ['PYSILCAM_OFFSET'] = offset
             logger.info('PYSILCAM_OFFSET set to: ' + offset)
-            print('PYSILCAM_OFFSET set to: ' + offset)
\ No newline at end of file
+            print('PYSILCAM_OFFSET set to: ' + offset)
+
+    return last_time, written
+
+
+def is_processed(timestamp, last_time, written):
+    '''
+    Checks whether an image is already in the stats of the run that is resumed
+
+    Args:
+        timestamp       (timestamp)     : timestamp of the image
+        last_time       (Timestamp)     : time up to which every image is done (NaT if none)
+        written         (set)           : timestamps of the images after last_time already in the stats
+
+    Returns:
+        processed (bool)                : True if the image must not be processed again
+    '''
+    timestamp = pd.Timestamp(timestamp)
+    return timestamp <= last_time or timestamp in written
+
+
+def resume_from_checkpoint(logger, datafilename):
+    '''
+    Cuts the -STATS.csv and -STATS.h5 files back to the last checkpoint of a previous run
+
+    Anything written after the checkpoint is removed, as the images it came from
+    are processed again when the run is resumed.
+
+    Args:
+        logger          (logger object) : logger object created using configure_logger()
+        datafilename    (str)           : filename prefix of the -STATS.csv file
+
+    Returns:
+        resume (tuple)                  : (last_time, written) where every image up to last_time
+                                          (NaT if none) is done, and written holds the timestamps
+                                          of the images after it that are in the stats,
+                                          or None if the files cannot be resumed from a checkpoint
+    '''
+    checkpoint = read_checkpoint(datafilename)
+    if checkpoint is None:
+        return None
+
+    csv_file = datafilename + '-STATS.csv'
+    h5_file = datafilename + '-STATS.h5'
+    if os.path.getsize(csv_file) < checkpoint['stats_csv_bytes'] or \
+            stats_h5_rows(h5_file) < checkpoint['stats_h5_rows']:
+        logger.warning('Stats files are shorter than at the last checkpoint: ignoring ' +
+                       checkpoint_filename(datafilename))
+        return None
+
+    logger.info('Resuming from checkpoint at ' + str(checkpoint['resume_timestamp']))
+    print('Resuming from checkpoint at ' + str(checkpoint['resume_timestamp']))
+    with open(csv_file, 'r+') as fh:
+        fh.truncate(checkpoint['stats_csv_bytes'])
+    if stats_h5_rows(h5_file) > checkpoint['stats_h5_rows']:
+        truncate_stats_h5(h5_file, checkpoint['stats_h5_rows'])
+
+    return checkpoint['resume_timestamp'], set(checkpoint['done_after'])
+
+
+def resume_offset(datapath, last_time):
+    '''
+    Index of the first image acquired after last_time, in the order the images are read
+
+    Args:
+        datapath        (str)           : name of the path containing the data
+        last_time       (Timestamp)     : latest timestamp already processed (NaT if none)
+
+    Returns:
+        offset (int)                    : number of images up to and including last_time
+    '''
+    times = image_timestamps(datapath)
+    return int(np.sum(times <= pd.to_datetime(last_time)))
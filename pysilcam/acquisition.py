@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
 import os
 import time
+import queue
+import itertools
 import numpy as np
 import pandas as pd
 import logging
 from pysilcam.config import load_camera_config
 import pysilcam.fakepymba as fakepymba
+from pysilcam.discreader import DiscReader
+from pysilcam.segments import list_segments, SegmentSet
+from pysilcam.framewriter import RawFrameWriter
+import pysilcam.metrics as scmet
 import sys
 
 logger = logging.getLogger(__name__)
@@ -15,6 +21,9 @@ try:
 except:
     logger.debug('Pymba not available. Cannot use camera')
 
+# number of seconds without images before a streaming camera is restarted
+STREAM_TIMEOUT = 10.
+
 
 def _init_camera(vimba):
     '''Initialize the camera system from vimba object
@@ -105,8 +114,32 @@ class Acquire():
     '''
     Class used to acquire images from camera or disc
     '''
-    def __init__(self, USE_PYMBA=False):
-        if USE_PYMBA:
+    def __init__(self, USE_PYMBA=False, prefetch=4, frames_per_segment=None,
+                 write_queue_size=20, write_policy='block', stream_buffers=None):
+        '''
+        Args:
+            USE_PYMBA=False (bool)          : if True acquire from the camera (emulated by fakepymba if
+                                              PYSILCAM_FAKE_CAMERA is set), otherwise from disc
+            prefetch=4 (int)                : number of images read ahead when acquiring from disc
+            frames_per_segment=None (int)   : if given, images written to disc are appended to segment
+                                              files of this number of images, instead of one .silc file each
+            write_queue_size=20 (int)       : number of acquired images that can wait to be written to disc
+            write_policy='block' (str)      : what to do when images cannot be written fast enough:
+                                              'block' acquisition, 'drop-oldest' or 'drop-newest' image
+            stream_buffers=None (int)       : if given, the camera acquires continuously into this number
+                                              of frames, instead of starting and stopping for each image
+        '''
+        self.prefetch = prefetch
+        self.frames_per_segment = frames_per_segment
+        self.write_queue_size = write_queue_size
+        self.write_policy = write_policy
+        self.stream_buffers = stream_buffers
+        if USE_PYMBA and 'PYSILCAM_FAKE_CAMERA' in os.environ.keys():
+            # the camera is emulated, e.g. with synthetic images for load testing (see fakepymba)
+            self.pymba = fakepymba
+            logger.info('using fakepymba camera')
+            self.get_generator = self.get_generator_camera
+        elif USE_PYMBA:
             self.pymba = pymba
             self.pymba.get_time_stamp = lambda x: pd.Timestamp.now()
             logger.info('Pymba imported')
@@ -132,6 +165,22 @@ class Acquire():
         if datapath != None:
             os.environ['PYSILCAM_TESTDATA'] = datapath
 
+        # images in a data folder are read ahead by a DiscReader, instead of one at a time
+        # through the fake camera
+        if 'PYSILCAM_TESTDATA' in os.environ.keys() and \
+                'PYSILCAM_REALTIME_DATA' not in os.environ.keys():
+            offset = int(os.environ.get('PYSILCAM_OFFSET', 0))
+            path = os.environ['PYSILCAM_TESTDATA'].replace('\\ ', ' ')
+            if len(list_segments(path)) > 0:
+                # images in segments are memory-mapped, so need no reading ahead
+                frames = SegmentSet(path, offset).frames()
+            else:
+                frames = DiscReader(fakepymba.list_image_files(path)[offset:], prefetch=self.prefetch).frames()
+            for timestamp, img in frames:
+                yield timestamp, img
+            logger.info('  END OF FILE LIST.')
+            return
+
         self.wait_for_camera()
 
         with self.pymba.Vimba() as vimba:
@@ -174,6 +223,7 @@ class Acquire():
             os.environ['PYSILCAM_TESTDATA'] = datapath
 
         while True:
+            frame_writer = None
             try:
                 #Wait until camera wakes up
                 self.wait_for_camera()
@@ -184,26 +234,40 @@ class Acquire():
                     #Configure camera
                     camera = _configure_camera(camera, camera_config_file)
 
-                    #Prepare for image acquisition and create a frame
-                    frame0 = camera.getFrame()
-                    frame0.announceFrame()
+                    if self.stream_buffers is None:
+                        #Prepare for image acquisition and create a frame
+                        frame0 = camera.getFrame()
+                        frame0.announceFrame()
+                        frames = (self._acquire_frame(camera, frame0) for i in itertools.count())
+                    else:
+                        frames = self._stream_frames(camera, self.stream_buffers)
+
+                    # the images are written to disc by a separate thread, so the acquisition
+                    # does not wait for the disc
+                    if writeToDisk:
+                        frame_writer = RawFrameWriter(datapath, queue_size=self.write_queue_size,
+                                                      policy=self.write_policy,
+                                                      frames_per_segment=self.frames_per_segment)
+                        frame_writer.start()
 
                     #Aquire raw images and yield to calling context
-                    while True:
-                        timestamp, img = self._acquire_frame(camera, frame0)
-                        if writeToDisk:
-                            filename = os.path.join(datapath, timestamp.strftime('D%Y%m%dT%H%M%S.%f.silc'))
-                            with open(filename, 'wb') as fh:
-                                np.save(fh, img, allow_pickle=False)
-                                fh.flush()
-                                os.fsync(fh.fileno())
-                                logger.info('Written {0}'.format(filename))
+                    for timestamp, img in frames:
+                        if frame_writer is not None:
+                            frame_writer.put(timestamp, img)
+                            logger.debug('Raw image writer: {0}'.format(frame_writer.metrics()))
+                            scmet.gauge('raw_write_queue_depth', frame_writer.frame_queue.qsize())
                         yield timestamp, img
-            except pymba.vimbaexception.VimbaException:
+                    logger.info('No images from camera. Restarting')
+            except self.pymba.vimbaexception.VimbaException:
                 logger.info('Camera error. Restarting')
             except KeyboardInterrupt:
                 logger.info('User interrupt with ctrl+c, terminating PySilCam.')
                 sys.exit(0)
+            finally:
+                # the images acquired are all written before the camera is restarted
+                if frame_writer is not None:
+                    frame_writer.close()
+                    logger.info('Raw image writer: {0}'.format(frame_writer.metrics()))
            
 
     def _acquire_frame(self, camera, frame0):
@@ -241,6 +305,82 @@ class Acquire():
         
         return timestamp, output
 
+    def _stream_frames(self, camera, nb_buffers):
+        '''Aquire frames continuously, into several frames queued to the camera
+
+        Each frame is copied out in the frame callback and queued to the camera again
+        straight away, so the camera always has a frame to fill and does not wait for
+        the processing. If the images are not taken fast enough, the oldest image
+        waiting is dropped.
+
+        Args:
+            camera (Camera)         : The camera with settings from the config
+                                      obtained from _configure_camera()
+            nb_buffers (int)        : number of frames queued to the camera
+
+        Yields:
+            timestamp (timestamp)   : timestamp of image acquisition
+            output (uint8)          : raw image acquired
+
+        The generator ends if no image is received for STREAM_TIMEOUT seconds.
+        '''
+        ready = queue.Queue(maxsize=nb_buffers)
+        errors = []
+
+        def on_frame(frame):
+            # called by the camera driver for each filled frame
+            try:
+                img = np.ndarray(buffer = frame.getBufferByteData(),
+                                dtype = np.uint8,
+                                shape = (frame.height, frame.width, 3))
+                output = img.copy()
+                timestamp = self.pymba.get_time_stamp(frame)
+            except Exception as e:
+                # raised to the calling context once the images before it are taken
+                errors.append(e)
+                return
+
+            # the frame can be filled again as soon as its image is copied out
+            frame.queueFrameCapture(on_frame)
+            try:
+                ready.put_nowait((timestamp, output))
+            except queue.Full:
+                try:
+                    ready.get_nowait()
+                except queue.Empty:
+                    pass
+                logger.warning('Image dropped: images are not taken as fast as they are acquired')
+                ready.put_nowait((timestamp, output))
+
+        #Prepare for image acquisition and create the frames
+        frames = [camera.getFrame() for i in range(nb_buffers)]
+        for frame in frames:
+            frame.announceFrame()
+        camera.AcquisitionMode = 'Continuous'
+        camera.startCapture()
+        for frame in frames:
+            frame.queueFrameCapture(on_frame)
+        camera.runFeatureCommand('AcquisitionStart')
+
+        try:
+            last_image = time.time()
+            while True:
+                try:
+                    timestamp, output = ready.get(True, 0.1)
+                except queue.Empty:
+                    if len(errors) > 0:
+                        raise errors[0]
+                    if time.time() - last_image > STREAM_TIMEOUT:
+                        logger.warning('No image for {0} s'.format(STREAM_TIMEOUT))
+                        return
+                    continue
+                last_image = time.time()
+                yield timestamp, output
+        finally:
+            camera.runFeatureCommand('AcquisitionStop')
+            camera.endCapture()
+            camera.revokeAllFrames()
+
     def wait_for_camera(self):
         '''
         Waiting function that will continue forever until a camera becomes connected
@@ -5,13 +5,270 @@ Moving background correction
 use the backgrounder function!
 
 acquire() must produce a float64 np array
+
+The background stack can be saved to a snapshot (a .npy file holding the
+images of the stack, and a .json file with the time of the snapshot), so that
+a restarted session can carry on with the same background instead of reading
+a new stack of images first. The backgrounder writes the snapshots from a
+separate thread, so the acquisition does not wait for the disc.
+
+With a mono channel (see to_mono()), each raw image is reduced to a single
+channel as it is acquired, so the background stack, the correction and the
+bad lighting check work on a third of the data of colour images.
+The classifier still needs colour rois, so the colour raw image is yielded with
+each corrected image and passed on to the workers: the transport to the workers
+is 4/3 of that of the colour pipeline (one corrected channel plus three raw
+channels), so the mono pipeline saves background work, not transport. The raw
+image is not background corrected, so the exported and classified rois differ
+from those of the colour pipeline (see process.extract_particles()).
 '''
+import os
+import json
+import time
+import threading
+import itertools
 import numpy as np
+import pandas as pd
 import logging
+import pysilcam.metrics as scmet
 
 #Get module-level logger
 logger = logging.getLogger(__name__)
 
+
+class BackgroundStack():
+    '''
+    Running-mean background built from a ring buffer of the most recent raw images
+
+    The sum of the images in the ring is kept in an integer accumulator, so adding
+    a new image (and dropping the oldest one) is exact and costs the same whatever
+    the number of images used for the background.
+    '''
+    def __init__(self, av_window):
+        '''
+        Args:
+            av_window (int)     : number of images to use in creating the background
+        '''
+        self.av_window = av_window
+        self.stack = None
+        self.sum = None
+        self.count = 0
+        self.head = 0
+        self.saver = None
+
+    def _allocate(self, imnew):
+        '''
+        Pre-allocate the ring buffer and accumulator from the first image
+
+        Args:
+            imnew (uint8)       : first image to be added to the stack
+        '''
+        self.stack = np.zeros((self.av_window,) + imnew.shape, dtype=imnew.dtype)
+
+        # use the smallest unsigned integer that can hold the sum of the full stack
+        max_sum = int(np.iinfo(imnew.dtype).max) * self.av_window
+        sum_dtype = np.uint16 if max_sum <= np.iinfo(np.uint16).max else np.uint32
+        self.sum = np.zeros(imnew.shape, dtype=sum_dtype)
+
+    def push(self, imnew):
+        '''
+        Add a new image to the stack, replacing the oldest image once the stack is full
+
+        Args:
+            imnew (uint8)       : new image to be added to stack
+        '''
+        if self.stack is None:
+            self._allocate(imnew)
+
+        if self.count == self.av_window:
+            # remove the oldest image from the sum
+            self.sum -= self.stack[self.head]
+        else:
+            self.count += 1
+
+        self.stack[self.head] = imnew
+        self.sum += self.stack[self.head]
+        self.head = (self.head + 1) % self.av_window
+
+    def is_full(self):
+        '''
+        Returns:
+            full (bool)         : True once av_window images have been added
+        '''
+        return self.count == self.av_window
+
+    def mean(self):
+        '''
+        Returns:
+            imbg (float64)      : background image, the mean of all images in the stack
+        '''
+        return self.sum / self.count
+
+    def save(self, snapshot_file, timestamp, wait=True):
+        '''
+        Saves the images of a full stack to a snapshot, oldest image first
+
+        The images are written to a new memory-mapped .npy file, which then replaces
+        the previous snapshot, so an interrupted save leaves the previous snapshot intact.
+
+        Args:
+            snapshot_file (str)     : snapshot filename, without extension
+            timestamp (timestamp)   : timestamp of the newest image in the stack
+            wait=True (bool)        : if False, a copy of the images is written by a separate thread,
+                                      and save() returns straight away. A save always waits for the
+                                      previous one to finish
+        '''
+        self.wait_saved()
+        images = np.concatenate([self.stack[self.head:], self.stack[:self.head]])
+        if wait:
+            write_snapshot(snapshot_file, images, timestamp)
+            return
+
+        self.saver = threading.Thread(target=self._save_thread, args=(snapshot_file, images, timestamp),
+                                      name='BackgroundSnapshot')
+        self.saver.start()
+
+    def _save_thread(self, snapshot_file, images, timestamp):
+        '''
+        Writes a snapshot, logging any error instead of raising it in the saving thread
+        '''
+        try:
+            with scmet.timer('background_snapshot'):
+                write_snapshot(snapshot_file, images, timestamp)
+        except Exception:
+            logger.exception('Could not save background snapshot ' + snapshot_file)
+
+    def wait_saved(self):
+        '''
+        Waits for the snapshot being written by save(wait=False), if any
+        '''
+        if self.saver is not None:
+            self.saver.join()
+            self.saver = None
+
+    @classmethod
+    def load(cls, snapshot_file):
+        '''
+        Loads a stack saved with save()
+
+        Args:
+            snapshot_file (str)     : snapshot filename, without extension
+
+        Returns:
+            background (BackgroundStack) : full stack of the snapshot (None if there is no snapshot)
+            timestamp (Timestamp)   : timestamp of the newest image in the stack (None if there is no snapshot)
+        '''
+        npy_file, json_file = snapshot_filenames(snapshot_file)
+        if not (os.path.isfile(npy_file) and os.path.isfile(json_file)):
+            return None, None
+        try:
+            with open(json_file) as fh:
+                timestamp = pd.Timestamp(json.load(fh)['timestamp'])
+            snapshot = np.load(npy_file, mmap_mode='r')
+        except (ValueError, KeyError, OSError):
+            logger.warning('Could not read background snapshot ' + npy_file)
+            return None, None
+
+        background = cls(snapshot.shape[0])
+        for imnew in snapshot:
+            background.push(imnew)
+        return background, timestamp
+
+
+def to_mono(img, channel='min'):
+    '''
+    Reduces a colour image to a single channel
+
+    Args:
+        img (uint8)                 : colour image
+        channel='min' (str or int)  : 'min' for the minimum of the channels, which represents the highest
+                                      attenuation of all wavelengths as used for segmentation, or the
+                                      index of the channel to keep
+
+    Returns:
+        img (uint8)                 : single-channel image
+    '''
+    if channel == 'min':
+        # element-wise over the channels, which is much faster than np.min(img, axis=2)
+        return np.minimum(np.minimum(img[:, :, 0], img[:, :, 1]), img[:, :, 2])
+    return np.ascontiguousarray(img[:, :, channel])
+
+
+def write_snapshot(snapshot_file, images, timestamp):
+    '''
+    Writes the images of a background stack to a snapshot
+
+    Args:
+        snapshot_file (str)     : snapshot filename, without extension
+        images (uint8)          : images of the stack, oldest image first
+        timestamp (timestamp)   : timestamp of the newest image in the stack
+    '''
+    npy_file, json_file = snapshot_filenames(snapshot_file)
+
+    snapshot = np.lib.format.open_memmap(npy_file + '.tmp', mode='w+',
+                                         dtype=images.dtype, shape=images.shape)
+    snapshot[:] = images
+    snapshot.flush()
+    del snapshot
+    os.replace(npy_file + '.tmp', npy_file)
+
+    with open(json_file + '.tmp', 'w') as fh:
+        json.dump({'timestamp': pd.Timestamp(timestamp).isoformat(),
+                   'av_window': len(images)}, fh)
+    os.replace(json_file + '.tmp', json_file)
+
+
+def snapshot_filenames(snapshot_file):
+    '''
+    Names of the files of a background snapshot
+
+    Args:
+        snapshot_file (str)     : snapshot filename, without extension
+
+    Returns:
+        npy_file (str)          : file holding the images of the stack
+        json_file (str)         : file holding the time of the snapshot
+    '''
+    return snapshot_file + '.npy', snapshot_file + '.json'
+
+
+def resume_background(av_window, acquire, snapshot_file, max_gap, mono_channel=None):
+    '''
+    Loads the background from a snapshot, if the next image follows it closely enough
+
+    Args:
+        av_window (int)             : number of images to use in creating the background
+        acquire (generator object)  : acquire generator object created by the Acquire class
+        snapshot_file (str)         : snapshot filename, without extension
+        max_gap (float)             : maximum number of seconds between the snapshot and the next image
+        mono_channel=None           : channel the images are reduced to (see to_mono()), None for colour
+
+    Returns:
+        background (BackgroundStack): background of the snapshot, or None if it cannot be used
+        acquire (generator object)  : acquire generator, still starting with the next image
+    '''
+    background, snapshot_time = BackgroundStack.load(snapshot_file)
+    if background is None:
+        return None, acquire
+
+    first = next(acquire, None)
+    if first is None:
+        return None, acquire
+    acquire = itertools.chain([first], acquire)
+
+    gap = (pd.Timestamp(first[0]) - snapshot_time).total_seconds()
+    shape = first[1].shape if mono_channel is None else first[1].shape[:2]
+    if background.av_window != av_window or background.stack.shape[1:] != shape:
+        logger.info('Background snapshot does not match the images: not used')
+        return None, acquire
+    if not (0 < gap <= max_gap):
+        logger.info('Background snapshot is {0:.1f} s from the next image: not used'.format(gap))
+        return None, acquire
+
+    logger.info('Background loaded from snapshot of ' + str(snapshot_time))
+    return background, acquire
+
+
 def ini_background(av_window, acquire):
     '''
     Create and initial background stack and average image
@@ -84,12 +341,77 @@ def shift_bgstack_fast(bgstack, imbg, imnew, stacklength):
     return bgstack, imbg
 
 
+# work buffers of correct_im_accurate, re-used from one image to the next
+_correct_buffers = {}
+
+
+def _correct_work_buffers(shape):
+    '''
+    Get the pre-allocated work buffers of correct_im_accurate for a given image shape
+
+    Args:
+        shape (tuple)       : shape of the raw image
+
+    Returns:
+        work (float64)      : buffer with the shape of the image
+        bins (int16)        : histogram bin of each pixel of one channel
+        mask (bool)         : pixel selection of one channel
+    '''
+    if shape not in _correct_buffers:
+        # only keep buffers for the image size currently being processed
+        _correct_buffers.clear()
+        # the corrected values stay float64: the background is a mean with a fractional part,
+        # and the truncation to uint8 of the result depends on it, so integer (int16) values
+        # would change the output. Only the histogram bins are integers
+        _correct_buffers[shape] = (np.empty(shape, dtype=np.float64),
+                                   np.empty(shape[:2], dtype=np.int16),
+                                   np.empty(shape[:2], dtype=bool))
+    return _correct_buffers[shape]
+
+
+def _histogram_median(values, bins, mask):
+    '''
+    Exact median of one channel, equal to np.percentile(values, 50)
+
+    The pixels are counted into 512 integer bins, which locates the one or two
+    middle values in a single bin each. Only the pixels of those bins are then
+    partitioned, instead of sorting the whole channel.
+
+    Args:
+        values (float64)    : channel of the background-subtracted image
+        bins (int16)        : histogram bin of each value, in [0, 512) and non-decreasing with the value
+        mask (bool)         : work buffer with the shape of values
+
+    Returns:
+        median (float64)    : median of values
+    '''
+    cumhist = np.cumsum(np.bincount(bins.ravel(), minlength=512))
+    n = cumhist[-1]
+
+    # order statistics either side of the median, and the bins holding them
+    ranks = np.unique([(n - 1) // 2, n // 2])
+    ranks_bin = np.searchsorted(cumhist, ranks, side='right')
+    ranks_in_bin = ranks - np.where(ranks_bin > 0, cumhist[ranks_bin - 1], 0)
+
+    middle_values = []
+    for b in np.unique(ranks_bin):
+        np.equal(bins, b, out=mask)
+        kth = ranks_in_bin[ranks_bin == b]
+        middle_values.extend(np.partition(values[mask], kth)[kth])
+
+    # let numpy interpolate between the middle values as it does for the full channel
+    return np.percentile(middle_values, 50)
+
+
 def correct_im_accurate(imbg, imraw):
     '''
     Corrects raw image by subtracting the background and scaling the output
     
     There is a small chance of clipping of imc in both crushed blacks an blown
     highlights if the background or raw images are very poorly obtained
+
+    The work buffers are re-used between calls, so only the corrected image is
+    allocated for each new image.
     
     Args:
       imbg (uint8)  : background averaged image
@@ -98,17 +420,23 @@ def correct_im_accurate(imbg, imraw):
     Returns:
       imc (uint8)   : corrected image
     '''
-
-    imc = np.float64(imraw) - np.float64(imbg)
-    imc[:,:,0] += (255/2 - np.percentile(imc[:,:,0], 50))
-    imc[:,:,1] += (255/2 - np.percentile(imc[:,:,1], 50))
-    imc[:,:,2] += (255/2 - np.percentile(imc[:,:,2], 50))
+    imc, bins, mask = _correct_work_buffers(imraw.shape)
+
+    np.subtract(imraw, imbg, out=imc, dtype=np.float64)
+    # each channel of a colour image, or the single channel of a mono image
+    channels = [imc] if imc.ndim == 2 else [imc[:, :, c] for c in range(imc.shape[2])]
+    for channel in channels:
+        # integer part of the corrected values, offset into the 512 histogram bins
+        np.copyto(bins, channel, casting='unsafe')
+        bins += 256
+        channel += (255/2 - _histogram_median(channel, bins, mask))
     #imc += 255 - np.percentile(imc, 99)
     imc += 255 - imc.max()
 
-    imc[imc>255] = 255
-    imc[imc<0] = 0
-    imc = np.uint8(imc)
+    # the maximum is now 255 (give or take rounding, which the cast to uint8
+    # truncates), so only the crushed blacks need clipping
+    np.maximum(imc, 0, out=imc)
+    imc = imc.astype(np.uint8)
 
     return imc
 
@@ -169,7 +497,8 @@ def shift_and_correct(bgstack, imbg, imraw, stacklength, real_time_stats=False):
 
 
 def backgrounder(av_window, acquire, bad_lighting_limit=None,
-        real_time_stats=False):
+        real_time_stats=False, snapshot_file=None, snapshot_interval=60.,
+        snapshot_max_gap=10., mono_channel=None):
     '''
     Generator which interacts with acquire to return a corrected image
     given av_window number of frame to use in creating a moving background
@@ -178,11 +507,17 @@ def backgrounder(av_window, acquire, bad_lighting_limit=None,
         av_window (int)               : number of images to use in creating the background
         acquire (generator object)    : acquire generator object created by the Acquire class
         bad_lighting_limit=None (int) : if a number is supplied it is used for throwing away raw images that have a standard deviation in colour which exceeds the given value
+        snapshot_file=None (str)      : if given, the background is saved to this snapshot (without extension),
+                                        and loaded from it when the first image follows the snapshot closely enough
+        snapshot_interval=60. (float) : number of seconds (of image timestamps) between snapshots
+        snapshot_max_gap=10. (float)  : maximum number of seconds between the snapshot and the first image for the snapshot to be used
+        mono_channel=None             : if given, the raw images are reduced to this channel (see to_mono())
+                                        before the background correction, and the corrected images are 2D
 
     Yields:
         timestamp (timestamp)         : timestamp of when raw image was acquired 
         imc (uint8)                   : corrected image ready for analysis or plotting
-        imraw (uint8)                 : raw image
+        imraw (uint8)                 : raw image (in colour also with a mono channel)
 
     Useage:
       avwind = 10 # number of images used for background
@@ -194,30 +529,57 @@ def backgrounder(av_window, acquire, bad_lighting_limit=None,
           print(i)
     '''
 
+    background = None
+    if snapshot_file is not None:
+        background, acquire = resume_background(av_window, acquire, snapshot_file, snapshot_max_gap,
+                                                mono_channel)
+
+    def reduce(imraw):
+        # the image the background is made of and corrected
+        return imraw if mono_channel is None else to_mono(imraw, mono_channel)
+
     # Set up initial background image stack
-    bgstack, imbg = ini_background(av_window, acquire)
-    stacklength = len(bgstack)
+    if background is None:
+        background = BackgroundStack(av_window)
+        for i in range(av_window):
+            background.push(reduce(next(acquire)[1]))
+
+    last_snapshot = None
 
     # Aquire images, apply background correction and yield result
+    acquire_start = time.perf_counter()
     for timestamp, imraw in acquire:
+        # time waiting for the image, which is acquired while the previous one is used
+        scmet.add('acquire', time.perf_counter() - acquire_start)
+        correct_start = time.perf_counter()
+        imbg = background.mean()
+        im = reduce(imraw)
+
+        if real_time_stats:
+            imc = correct_im_fast(imbg, im)
+        else:
+            imc = correct_im_accurate(imbg, im)
 
         if not (bad_lighting_limit==None):
-            bgstack_new, imbg_new, imc = shift_and_correct(bgstack, imbg,
-                    imraw, stacklength, real_time_stats)
-
-            # basic check of image quality
-            r = imc[:, :, 0]
-            g = imc[:, :, 1]
-            b = imc[:, :, 2]
-            s = np.std([r, g, b])
-            # ignore bad images
-            if (s <= bad_lighting_limit):
-                bgstack = bgstack_new
-                imbg = imbg_new
-                yield timestamp, imc, imraw
-            else:
+            # basic check of image quality: the standard deviation over all channels
+            s = np.std(imc)
+            # ignore bad images, and keep them out of the background
+            if not (s <= bad_lighting_limit):
                 logger.info('bad lighting, std={0}'.format(s))
-        else:
-            bgstack, imbg, imc = shift_and_correct(bgstack, imbg, imraw,
-                    stacklength, real_time_stats)
-            yield timestamp, imc, imraw
+                scmet.count('bad_lighting')
+                acquire_start = time.perf_counter()
+                continue
+
+        background.push(im)
+        scmet.add('background_correct', time.perf_counter() - correct_start)
+
+        if snapshot_file is not None and (last_snapshot is None or
+                (pd.Timestamp(timestamp) - last_snapshot).total_seconds() >= snapshot_interval):
+            # the snapshot is written by a separate thread, off the acquisition path
+            background.save(snapshot_file, timestamp, wait=False)
+            last_snapshot = pd.Timestamp(timestamp)
+
+        yield timestamp, imc, imraw
+        acquire_start = time.perf_counter()
+
+    background.wait_saved()
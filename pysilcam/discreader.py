@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+'''
+Reading of raw images from disc, prefetching the next images on a thread pool
+
+Reading the images one at a time on the acquisition loop leaves it waiting for
+the disc (or network storage) between images. Here the next images are read
+by a pool of threads while the current one is processed (np.load and imageio
+release the GIL while they read), directly into a fixed set of pre-allocated
+image buffers, so the memory used does not grow with the read-ahead.
+'''
+import os
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from pysilcam.fakepymba import silcam_load, silcam_name2time
+
+#Get module-level logger
+logger = logging.getLogger(__name__)
+
+
+def read_image_into(filename, out):
+    '''
+    Reads a raw image file into a pre-allocated buffer
+
+    The data of .silc files is read straight into the buffer when it has the shape and
+    type of the buffer. Other images are loaded and copied, and grey-scale images are
+    copied into all three channels.
+
+    Args:
+        filename (str)      : .silc or .bmp file
+        out (uint8)         : buffer of shape (height, width, 3) to read the image into
+
+    Raises:
+        ValueError          : if the image does not have the size of the buffer
+    '''
+    if filename.endswith('.silc'):
+        with open(filename, 'rb') as fh:
+            version = np.lib.format.read_magic(fh)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fh)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fh)
+            if shape == out.shape and dtype == out.dtype and not fortran_order:
+                if fh.readinto(out) != out.nbytes:
+                    raise ValueError('Incomplete image file: ' + filename)
+                return
+
+    img = silcam_load(filename)
+    if img.shape[:2] != out.shape[:2]:
+        raise ValueError('Image {0} has shape {1}, expected {2}'.format(filename, img.shape, out.shape))
+    if len(img.shape) == 2:
+        out[:] = img[:, :, np.newaxis]
+    else:
+        out[:] = img
+
+
+class DiscReader():
+    '''
+    Reads a list of raw image files in order, with the next images read ahead on a thread pool
+
+    The images are held in prefetch + 2 pre-allocated buffers which are re-used in turn,
+    so a yielded image stays valid until two more images have been read. Copy the image
+    if it is kept for longer.
+
+    Files that cannot be read are skipped.
+
+    Usage:
+        reader = DiscReader(list_image_files(datapath))
+        for timestamp, img in reader.frames():
+            ...
+    '''
+    def __init__(self, files, prefetch=4, nb_workers=None):
+        '''
+        Args:
+            files (list)            : image filenames, in the order they are read
+            prefetch=4 (int)        : number of images read ahead
+            nb_workers=None (int)   : number of reading threads (prefetch if None)
+        '''
+        self.files = files
+        self.prefetch = max(1, prefetch)
+        self.nb_workers = nb_workers if nb_workers is not None else self.prefetch
+        self.buffers = None
+
+    def _allocate(self):
+        '''
+        Allocates the image buffers with the size of the first readable image
+        '''
+        for filename in self.files:
+            try:
+                img0 = silcam_load(filename)
+                break
+            except Exception:
+                logger.warning('Could not read {0}'.format(filename), exc_info=True)
+        else:
+            return False
+
+        shape = img0.shape[:2] + (3,)
+        self.buffers = [np.empty(shape, dtype=np.uint8) for i in range(self.prefetch + 2)]
+        logger.debug('Disc reader of {0} buffers ({1:.0f} MB)'.format(len(self.buffers),
+                     len(self.buffers) * self.buffers[0].nbytes / 2**20))
+        return True
+
+    def _read(self, filename, out):
+        '''
+        Reads one image, run on the thread pool
+
+        Args:
+            filename (str)      : image file
+            out (uint8)         : buffer to read the image into
+
+        Returns:
+            timestamp (timestamp) : timestamp of the image, from its filename
+        '''
+        read_image_into(filename, out)
+        return silcam_name2time(os.path.basename(filename))
+
+    def frames(self):
+        '''
+        Generator of the images, in the order of the file list
+
+        Yields:
+            timestamp (timestamp)   : timestamp of the image, from its filename
+            img (uint8)             : image, in one of the buffers of the reader
+        '''
+        if len(self.files) == 0 or not self._allocate():
+            return
+
+        pool = ThreadPoolExecutor(max_workers=self.nb_workers)
+        pending = deque()
+        next_file = 0
+        try:
+            while len(pending) > 0 or next_file < len(self.files):
+                # the buffer of the file read now was last yielded prefetch + 2 images ago
+                while next_file < len(self.files) and len(pending) < self.prefetch:
+                    out = self.buffers[next_file % len(self.buffers)]
+                    pending.append((self.files[next_file], out,
+                                    pool.submit(self._read, self.files[next_file], out)))
+                    next_file += 1
+
+                filename, out, future = pending.popleft()
+                try:
+                    timestamp = future.result()
+                except Exception:
+                    logger.warning('Could not read {0}'.format(filename), exc_info=True)
+                    continue
+                logger.debug('Read {0}'.format(filename))
+                yield timestamp, out
+        finally:
+            # stop reading ahead when the generator is closed before the end of the list
+            for filename, out, future in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
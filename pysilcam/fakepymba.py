@@ -1,16 +1,42 @@
 # -*- coding: utf-8 -*-
 '''
 Partial drop-in replacement for Pymba, for testing purposes.
+
+Images are read from PYSILCAM_TESTDATA (or PYSILCAM_REALTIME_DATA), or generated
+if neither is set. As with pymba, a frame is either captured one at a time, or
+several frames are announced and queued with a callback, which a capture thread
+fills in turn between the AcquisitionStart and AcquisitionStop commands, as a
+camera acquiring continuously does.
+
+Generated images are random noise, or synthetic images of particles (see
+pysilcam.synthetic) if PYSILCAM_SYNTHETIC_D50 is set. They are configured with
+the environment variables:
+    PYSILCAM_SYNTHETIC_D50              : d50 of the particles [um]
+    PYSILCAM_SYNTHETIC_CONCENTRATION    : volume concentration of the particles [uL/L] (800)
+    PYSILCAM_SYNTHETIC_PIX_SIZE         : pixel size [um] (28.758)
+    PYSILCAM_SYNTHETIC_PATH_LENGTH      : path length [mm] (40)
+    PYSILCAM_FPS                        : frame rate [Hz] (FPS)
+    PYSILCAM_FPS_JITTER                 : standard deviation of the frame interval, relative to the interval (0)
+    PYSILCAM_DROP_RATE                  : fraction of the frames dropped by the camera (0)
+    PYSILCAM_CORRUPT_RATE               : fraction of the frames only partly transferred (0)
+Synthetic images are generated even if PYSILCAM_TESTDATA is set, so that
+realtime processing can be load tested with PYSILCAM_FAKE_CAMERA set (see
+pysilcam.acquisition.Acquire).
 '''
 from __future__ import print_function
 import os
 import sys
 import time
+import types
+import threading
+from collections import deque
 from datetime import datetime
 import numpy as np
 import imageio
 import logging
 import pandas as pd
+from pysilcam.segments import list_segments, SegmentSet
+from pysilcam.fileindex import get_file_index
 
 #Handle potential Python 2.7 and Python 3
 try:
@@ -31,6 +57,41 @@ def silcam_name2time(fname):
     timestamp = pd.to_datetime(os.path.splitext(fname)[0][1:])
     return timestamp
 
+def list_image_files(path):
+    '''
+    Lists the images read from a data folder, in the order they are read
+
+    Args:
+        path (str)      : data folder
+
+    Returns:
+        files (list)    : sorted .silc files if there are any, otherwise the sorted D*.bmp files
+    '''
+    files = get_file_index(path, ('.silc',)).files()
+
+    if len(files)==0:
+        files = get_file_index(path, ('.bmp',)).files()
+    return files
+
+def image_timestamps(path):
+    '''
+    Timestamps of the images read from a data folder, in the order they are read
+
+    Args:
+        path (str)              : data folder
+
+    Returns:
+        times (DatetimeIndex)   : timestamps of the images in the segments if there are any,
+                                  otherwise those of the files of list_image_files()
+    '''
+    if len(list_segments(path)) > 0:
+        return SegmentSet(path).timestamps
+
+    index = get_file_index(path, ('.silc',))
+    if len(index) == 0:
+        index = get_file_index(path, ('.bmp',))
+    return index.timestamps()
+
 #Fake aqusition frequency
 FPS = 5
 
@@ -43,7 +104,24 @@ def get_time_stamp(frame):
 def query_start():
     logger.debug('Starting query')
 
+
+class VimbaException(Exception):
+    '''Camera error, as raised by pymba'''
+    pass
+
+# for pymba.vimbaexception.VimbaException
+vimbaexception = types.SimpleNamespace(VimbaException=VimbaException)
+
+
 class Camera:
+    def __init__(self):
+        # frames announced, and frames queued with a callback waiting to be filled
+        self.frames = []
+        self.queued = deque()
+        self.capture = threading.Condition()
+        self.capture_thread = None
+        self.streaming = False
+
     def openCamera(self):
         logger.debug('Opening camera')
 
@@ -53,43 +131,121 @@ class Camera:
 
     def runFeatureCommand(self, cmd):
         logger.debug('Camera command: {0}'.format(cmd))
+        # frames queued with a callback are filled continuously until acquisition is stopped
+        if cmd == 'AcquisitionStart' and len(self.queued) > 0:
+            self._start_streaming()
+        elif cmd == 'AcquisitionStop':
+            self._stop_streaming()
 
     def endCapture(self):
         logger.debug('Ending camera capture')
+        self._stop_streaming()
 
     def getFrame(self):
         #time.sleep(1.0/FPS)
         if 'PYSILCAM_REALTIME_DATA' in os.environ.keys():
-            return RealtimeFrame()
+            frame = RealtimeFrame()
         else:
-            return Frame()
+            frame = Frame()
+        frame.camera = self
+        return frame
 
     def revokeAllFrames(self):
         logger.debug('\nCleaning up: revoking all frames')
-        pass
+        self._stop_streaming()
+        self.frames = []
+        self.queued.clear()
+
+    def queue_frame(self, frame, frameCallback):
+        '''
+        Queues a frame to be filled by the capture thread, which then calls frameCallback(frame)
+        '''
+        with self.capture:
+            self.queued.append((frame, frameCallback))
+            self.capture.notify()
+
+    def _start_streaming(self):
+        if self.streaming:
+            return
+        self.streaming = True
+        self.capture_thread = threading.Thread(target=self._stream, name='FakeCamera')
+        self.capture_thread.daemon = True
+        self.capture_thread.start()
+
+    def _stop_streaming(self):
+        with self.capture:
+            self.streaming = False
+            self.capture.notify()
+        if self.capture_thread is not None and self.capture_thread is not threading.current_thread():
+            self.capture_thread.join()
+        self.capture_thread = None
+
+    def _stream(self):
+        '''
+        Fills the queued frames in turn. The images are read by the first frame announced,
+        so all frames carry on from the same position in the data.
+        '''
+        while True:
+            with self.capture:
+                while self.streaming and len(self.queued) == 0:
+                    self.capture.wait(0.1)
+                if not self.streaming:
+                    return
+                frame, frameCallback = self.queued.popleft()
+
+            source = self.frames[0]
+            try:
+                frame.captured = source.read_image()
+                frame.timestamp = source.timestamp
+                frame.capture_error = None
+            except Exception as e:
+                # e.g. the end of the data: passed on by getBufferByteData()
+                frame.captured = None
+                frame.capture_error = e
+            frameCallback(frame)
+            if frame.capture_error is not None:
+                return
 
 
 class Frame:
+    # camera of the frame, and image filled in by the capture thread of the camera
+    camera = None
+    captured = None
+    capture_error = None
+
     def __init__(self):
+        self.synthetic = None
+        if 'PYSILCAM_SYNTHETIC_D50' in os.environ.keys():
+            # imported here, as the processing modules take long to import
+            from pysilcam.synthetic import SyntheticImages
+            self.files = None
+            self.segments = None
+            self.synthetic = SyntheticImages(
+                    d50=float(os.environ['PYSILCAM_SYNTHETIC_D50']),
+                    concentration=float(os.environ.get('PYSILCAM_SYNTHETIC_CONCENTRATION', 800)),
+                    pix_size=float(os.environ.get('PYSILCAM_SYNTHETIC_PIX_SIZE', 28.758169934640524)),
+                    path_length=float(os.environ.get('PYSILCAM_SYNTHETIC_PATH_LENGTH', 40)))
+            self.width = self.synthetic.imx
+            self.height = self.synthetic.imy
+
         #If the environment variable PYSILCAM_TESTDATA is defined, read images
         #from that location.
-        if 'PYSILCAM_TESTDATA' in os.environ.keys():
+        elif 'PYSILCAM_TESTDATA' in os.environ.keys():
             offset = int(os.environ.get('PYSILCAM_OFFSET', 0))
             path = os.environ['PYSILCAM_TESTDATA']
             path = path.replace('\ ',' ') # handle spaces (not sure on windows behaviour)
-            self.files = [os.path.join(path, f)
-                          for f in sorted(os.listdir(path))
-                          if f.endswith('.silc')][offset:]
-
-            if len(self.files)==0:
-                self.files = [os.path.join(path, f)
-                              for f in sorted(os.listdir(path))
-                              if f.startswith('D') and (f.endswith('.bmp'))][offset:]
+            # images in segment files are read from the segments, otherwise one file per image
+            self.segments = None
+            if len(list_segments(path)) > 0:
+                self.segments = SegmentSet(path, offset)
+                self.files = self.segments
+                img0 = self.segments[0][1]
+            else:
+                self.files = list_image_files(path)[offset:]
+                img0 = silcam_load(self.files[0])
 
             self.img_idx = 0
 
-            img0 = silcam_load(self.files[0])
-
             if len(img0.shape) == 2:
                 self.height, self.width = img0.shape
             else:
@@ -97,13 +253,41 @@ class Frame:
 
         else:
             self.files = None
+            self.segments = None
             self.width = 800
             self.height = 600
 
+        # frame rate and faults of generated images
+        self.fps = float(os.environ.get('PYSILCAM_FPS', FPS))
+        self.jitter = float(os.environ.get('PYSILCAM_FPS_JITTER', 0))
+        self.drop_rate = float(os.environ.get('PYSILCAM_DROP_RATE', 0))
+        self.corrupt_rate = float(os.environ.get('PYSILCAM_CORRUPT_RATE', 0))
+        self.next_frame = None
+        self.frames_dropped = 0
+        self.frames_corrupted = 0
+
         logger.debug('Frame acquired')
 
     def getBufferByteData(self):
-        if self.files is not None:
+        # a frame filled by the capture thread of the camera holds its image
+        if self.capture_error is not None:
+            raise self.capture_error
+        if self.captured is not None:
+            return self.captured
+        return self.read_image()
+
+    def read_image(self):
+        '''
+        Reads (or generates) the next image
+
+        Returns:
+            image (bytes)   : image data
+        '''
+        if self.segments is not None:
+            self.timestamp, frame = self.segments[self.img_idx]
+            self.img_idx += 1
+            logger.debug('Getting buffer byte data from segment {0}, {1}/{2}'.format(frame.shape, self.img_idx, len(self.files)))
+        elif self.files is not None:
             frame = silcam_load(self.files[self.img_idx])
             if len(frame.shape) == 2:
                 frame2 = np.zeros((self.height, self.width, 3), dtype=frame.dtype)
@@ -115,20 +299,64 @@ class Frame:
             self.img_idx += 1
             logger.debug('Getting buffer byte data from file {0}, {1}/{2}'.format(frame.shape, self.img_idx, len(self.files)))
         else:
-            self.timestamp = datetime.now()
-            frame = np.random.random((self.height, self.width, 3))
+            frame = self._generate_image()
             logger.debug('Getting buffer byte data, {0}'.format(frame.shape))
-            time.sleep(1.0/FPS)
         return frame.tobytes()
 
-    def announceFrame(self):
-        logger.debug('Frame acquired')
+    def _wait_for_frame(self):
+        '''
+        Waits until the next frame is due at the frame rate, with jitter
+        '''
+        interval = 1.0 / self.fps
+        if self.jitter > 0:
+            interval = max(0., interval * (1 + self.jitter * np.random.randn()))
+        if self.next_frame is None:
+            self.next_frame = time.time()
+        self.next_frame += interval
+        delay = self.next_frame - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            # frames taken slower than the frame rate are acquired when asked for
+            self.next_frame = time.time()
+
+    def _generate_image(self):
+        '''
+        Generates the next image at the frame rate, dropping or corrupting
+        images at the configured rates
+
+        Returns:
+            frame (array)   : image
+        '''
+        while True:
+            self._wait_for_frame()
+            self.timestamp = datetime.now()
+            if self.synthetic is not None:
+                frame = self.synthetic.image()[0]
+            else:
+                frame = np.random.random((self.height, self.width, 3))
+            if np.random.random() >= self.drop_rate:
+                break
+            # a dropped frame leaves a gap of one frame interval
+            self.frames_dropped += 1
+            logger.debug('Frame dropped at {0}'.format(self.timestamp))
+
+        if np.random.random() < self.corrupt_rate:
+            # as for a frame with lost packets, the end of the frame is missing
+            self.frames_corrupted += 1
+            frame[np.random.randint(self.height):] = 0
+            logger.debug('Frame corrupted at {0}'.format(self.timestamp))
+        return frame
 
     def announceFrame(self):
         logger.debug('Announcing frame')
+        if self.camera is not None:
+            self.camera.frames.append(self)
 
-    def queueFrameCapture(self):
+    def queueFrameCapture(self, frameCallback=None):
         logger.debug('Queuing frame capture')
+        if frameCallback is not None and self.camera is not None:
+            self.camera.queue_frame(self, frameCallback)
 
     def waitFrameCapture(self):
         logger.debug('Waiting for frame capture')
@@ -138,22 +366,21 @@ class RealtimeFrame(Frame):
     '''For faster real-time processing from disk'''
 
     def _list_images(self):
-        self.files = [os.path.join(self.path, f)
-                      for f in sorted(os.listdir(self.path))
-                      if f.endswith('.bmp')]
+        # only the newest images are needed, and the index only takes in the new files
+        self.files = get_file_index(self.path, ('.bmp',)).newest(3)
 
     def __init__(self):
         #Read files from this location
         self.path = os.environ['PYSILCAM_REALTIME_DATA']
         self._list_images()
         self.img_idx = 0
-        self.filename = self.files[0]
-        img0 = silcam_load(self.filename)
+        self.filename = None
+        img0 = silcam_load(self.files[0])
         self.height = img0.shape[0]
         self.width = img0.shape[1]
         logger.debug('Realtime frame acquired')
 
-    def getBufferByteData(self):
+    def read_image(self):
         self._list_images()
         while self.files[-3] == self.filename:
             logger.debug('No new images ({0}), waiting 1s and then retrying'.format(len(self.files)))
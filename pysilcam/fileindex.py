@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+'''
+Sorted index of the raw image files of a data folder
+
+Listing and sorting a folder of hundreds of thousands of images takes seconds,
+so the index keeps the files sorted by the timestamp in their name, and is
+updated with the changes only: from inotify events if inotify_simple is
+installed (Linux, pip install pysilcam[inotify]), otherwise by listing the
+folder again when its modification time changes, looking up each file in the
+set of indexed names. The index is saved to a cache file, so that the next
+process reading the same folder does not have to list it again while it is
+unchanged.
+'''
+import os
+import time
+import bisect
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+
+#Get module-level logger
+logger = logging.getLogger(__name__)
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+    logger.debug('inotify_simple not available. Folders are polled for new images')
+
+# folder of the saved indexes
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.pysilcam', 'index')
+
+# modification times closer than this (in nanoseconds) to the listing of a folder are not trusted
+MTIME_RESOLUTION = 2 * 10**9
+
+# indexes of the folders read by this process, see get_file_index()
+_indexes = {}
+
+
+def default_index_file(path, extensions):
+    '''
+    Name of the cache file of the index of a folder
+
+    Args:
+        path (str)              : data folder
+        extensions (tuple)      : file extensions in the index
+
+    Returns:
+        index_file (str)        : .npz file in CACHE_PATH
+    '''
+    key = os.path.abspath(path) + '|' + '|'.join(extensions)
+    return os.path.join(CACHE_PATH, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npz')
+
+
+def parse_timestamps(names):
+    '''
+    Timestamps in image filenames (e.g. D20180101T100000.123456.silc)
+
+    Args:
+        names (list)            : image filenames, without path
+
+    Returns:
+        times (int64)           : timestamps in nanoseconds since epoch (-1 where the name has no timestamp)
+    '''
+    stems = [os.path.splitext(n)[0][1:] for n in names]
+    times = pd.to_datetime(stems, format='%Y%m%dT%H%M%S.%f', errors='coerce')
+    times = np.asarray(times.values.astype('datetime64[ns]').astype(np.int64))
+    # other timestamp formats are parsed one at a time, as by silcam_name2time
+    for i in np.flatnonzero(times == np.iinfo(np.int64).min):
+        try:
+            times[i] = pd.to_datetime(stems[i]).value
+        except (ValueError, OverflowError):
+            times[i] = -1
+    return times
+
+
+class FileIndex():
+    '''
+    Image files of a data folder, sorted by the timestamp in their name
+
+    Only files starting with D and ending with one of the extensions are indexed.
+    Call update() to take in files added or removed since the index was last updated.
+
+    Usage:
+        index = FileIndex(datapath, extensions=('.silc',))
+        files = index.files()
+        ...
+        index.update()
+        newest = index.newest(3)
+    '''
+    def __init__(self, path, extensions=('.silc', '.bmp'), index_file=None, use_inotify=True,
+                 save_interval=60.):
+        '''
+        Args:
+            path (str)              : data folder
+            extensions=('.silc', '.bmp') (tuple)
+                                    : file extensions to index
+            index_file=None (str)   : cache file of the index (default_index_file() if None, '' for no cache file)
+            use_inotify=True (bool) : if True, and inotify_simple is installed, follow the changes
+                                      to the folder with inotify instead of polling it
+            save_interval=60. (float) : minimum number of seconds between saves of the index by update()
+        '''
+        self.path = path
+        self.extensions = tuple(extensions)
+        self.index_file = default_index_file(path, self.extensions) if index_file is None else index_file
+
+        self.save_interval = save_interval
+        self._names = []
+        self._times = []
+        # the names of the index, to look up the files listed
+        self._known = set()
+        self._mtime = None
+        self._scanned = None
+        self._last_save = 0.
+
+        self._inotify = None
+        if use_inotify and inotify_simple is not None:
+            try:
+                flags = inotify_simple.flags
+                self._inotify = inotify_simple.INotify()
+                self._inotify.add_watch(path, flags.CLOSE_WRITE | flags.MOVED_TO |
+                                        flags.DELETE | flags.MOVED_FROM)
+            except OSError:
+                logger.debug('Could not watch {0}, polling instead'.format(path), exc_info=True)
+                self._inotify = None
+
+        if not self._load():
+            self._scan()
+            self._save()
+
+    def _indexed(self, name):
+        '''
+        Returns:
+            indexed (bool)      : True if the file is of a type in the index
+        '''
+        return name.startswith('D') and name.endswith(self.extensions)
+
+    def _load(self):
+        '''
+        Loads the saved index if the folder has not changed since it was saved
+
+        Returns:
+            loaded (bool)       : True if the index was loaded
+        '''
+        if self.index_file == '' or not os.path.isfile(self.index_file):
+            return False
+        try:
+            with np.load(self.index_file, allow_pickle=False) as saved:
+                if int(saved['mtime']) != os.stat(self.path).st_mtime_ns:
+                    return False
+                # files added just after the folder was listed may not have changed its modification
+                # time on file systems with a coarse time resolution
+                if int(saved['scanned']) - int(saved['mtime']) < MTIME_RESOLUTION:
+                    return False
+                self._names = [n.decode('utf-8') for n in saved['names']]
+                self._known = set(self._names)
+                self._times = saved['times'].tolist()
+                self._mtime = int(saved['mtime'])
+                self._scanned = int(saved['scanned'])
+        except (OSError, ValueError, KeyError):
+            logger.debug('Could not load index {0}'.format(self.index_file), exc_info=True)
+            return False
+        logger.debug('Index of {0} loaded ({1} files)'.format(self.path, len(self._names)))
+        return True
+
+    def _save(self):
+        '''
+        Saves the index to its cache file, replacing the previous one in a single step
+        '''
+        if self.index_file == '':
+            return
+        self._last_save = time.time()
+        try:
+            os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+            tmp_file = self.index_file + '.{0}.tmp'.format(os.getpid())
+            with open(tmp_file, 'wb') as fh:
+                np.savez(fh, names=np.array([n.encode('utf-8') for n in self._names], dtype=bytes),
+                         times=np.array(self._times, dtype=np.int64), mtime=np.int64(self._mtime),
+                         scanned=np.int64(self._scanned))
+            os.replace(tmp_file, self.index_file)
+        except OSError:
+            logger.debug('Could not save index {0}'.format(self.index_file), exc_info=True)
+
+    def _scan(self):
+        '''
+        Lists the folder and takes in the files added and removed since the last scan
+
+        Returns:
+            changed (bool)      : True if files were added or removed
+        '''
+        # the modification time is read before listing, so changes made while listing are found next time
+        self._mtime = os.stat(self.path).st_mtime_ns
+        self._scanned = int(time.time() * 1e9)
+        names = set(n for n in os.listdir(self.path) if self._indexed(n))
+        removed = self._known - names
+        if len(removed) > 0:
+            self._remove(removed)
+        return self._add(names - self._known) or len(removed) > 0
+
+    def _scan_new(self):
+        '''
+        Lists the folder and takes in the files added since the last scan
+
+        Files are normally only added to a folder being acquired to, so the files listed
+        are looked up in the names of the index, without building and comparing sets
+        of the whole folder. If fewer indexed files than expected are found, files were
+        removed, and the folder is scanned as by _scan() instead.
+
+        Returns:
+            changed (bool)      : True if files were added or removed
+        '''
+        mtime = os.stat(self.path).st_mtime_ns
+        scanned = int(time.time() * 1e9)
+        nb_known = 0
+        new = []
+        for name in os.listdir(self.path):
+            if name in self._known:
+                nb_known += 1
+            elif self._indexed(name):
+                new.append(name)
+        if nb_known != len(self._known):
+            return self._scan()
+
+        self._mtime = mtime
+        self._scanned = scanned
+        return self._add(new)
+
+    def _add(self, names):
+        '''
+        Adds files to the index, keeping it sorted
+
+        Args:
+            names (iterable)    : new filenames, without path
+
+        Returns:
+            changed (bool)      : True if files were added
+        '''
+        names = list(names)
+        if len(names) == 0:
+            return False
+        times = parse_timestamps(names)
+        new = sorted((t, n) for t, n in zip(times.tolist(), names) if t >= 0)
+        if len(new) == 0:
+            return False
+
+        if len(self._names) == 0 or new[0] >= (self._times[-1], self._names[-1]):
+            # new images are normally the newest ones
+            self._times.extend(t for t, n in new)
+            self._names.extend(n for t, n in new)
+        else:
+            merged = sorted(list(zip(self._times, self._names)) + new)
+            self._times = [t for t, n in merged]
+            self._names = [n for t, n in merged]
+        self._known.update(n for t, n in new)
+        return True
+
+    def _remove(self, names):
+        '''
+        Removes files from the index
+
+        Args:
+            names (set)         : filenames to remove, without path
+        '''
+        kept = [(t, n) for t, n in zip(self._times, self._names) if n not in names]
+        self._times = [t for t, n in kept]
+        self._names = [n for t, n in kept]
+        self._known -= set(names)
+
+    def update(self):
+        '''
+        Takes in the files added to or removed from the folder since the last update
+
+        Returns:
+            changed (bool)      : True if files were added or removed
+        '''
+        if self._inotify is not None:
+            changed = self._read_events()
+        elif os.stat(self.path).st_mtime_ns != self._mtime:
+            changed = self._scan_new()
+        else:
+            changed = False
+
+        if changed and time.time() - self._last_save >= self.save_interval:
+            self._save()
+        return changed
+
+    def _read_events(self):
+        '''
+        Applies the inotify events received since the last update
+
+        Returns:
+            changed (bool)      : True if files were added or removed
+        '''
+        flags = inotify_simple.flags
+        # as for _scan(), the modification time is read before the changes are
+        mtime = os.stat(self.path).st_mtime_ns
+        scanned = int(time.time() * 1e9)
+
+        # whether each file is in the folder after the events, in the order they happened
+        present = dict()
+        for event in self._inotify.read(timeout=0):
+            if event.mask & flags.Q_OVERFLOW:
+                # events were lost: list the whole folder
+                return self._scan()
+            if self._indexed(event.name):
+                present[event.name] = not (event.mask & (flags.DELETE | flags.MOVED_FROM))
+        self._mtime = mtime
+        self._scanned = scanned
+
+        removed = set(n for n, p in present.items() if not p and n in self._known)
+        if len(removed) > 0:
+            self._remove(removed)
+        return self._add([n for n, p in present.items() if p and n not in self._known]) or len(removed) > 0
+
+    def __len__(self):
+        return len(self._names)
+
+    def files(self):
+        '''
+        Returns:
+            files (list)            : all files in the index (with path), in time order
+        '''
+        return [os.path.join(self.path, n) for n in self._names]
+
+    def timestamps(self):
+        '''
+        Returns:
+            times (DatetimeIndex)   : timestamps of all files in the index, in time order
+        '''
+        return pd.to_datetime(np.array(self._times, dtype=np.int64))
+
+    def newest(self, n):
+        '''
+        Args:
+            n (int)                 : number of files
+
+        Returns:
+            files (list)            : the n newest files (with path), oldest first
+        '''
+        return [os.path.join(self.path, name) for name in self._names[max(0, len(self._names) - n):]]
+
+    def at(self, timestamp):
+        '''
+        Finds the image acquired at a given time
+
+        Args:
+            timestamp (timestamp)   : time of interest
+
+        Returns:
+            filename (str)          : the newest file acquired at or before timestamp (None if there is none)
+        '''
+        i = bisect.bisect_right(self._times, pd.Timestamp(timestamp).value) - 1
+        if i < 0:
+            return None
+        return os.path.join(self.path, self._names[i])
+
+
+def get_file_index(path, extensions=('.silc', '.bmp')):
+    '''
+    Index of a data folder, shared by all callers in the process and updated on each call
+
+    Args:
+        path (str)                      : data folder
+        extensions=('.silc', '.bmp') (tuple) : file extensions to index
+
+    Returns:
+        index (FileIndex)               : up-to-date index of the folder
+    '''
+    key = (os.path.abspath(path), tuple(extensions))
+    if key not in _indexes:
+        _indexes[key] = FileIndex(path, extensions)
+    else:
+        _indexes[key].update()
+    return _indexes[key]
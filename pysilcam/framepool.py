@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+'''
+Shared-memory transport of images between the acquisition loop and the
+processing workers.
+
+Images are written into pre-allocated slots of one shared buffer, so only the
+slot index has to pass through the processing queues instead of a pickled copy
+of the whole image.
+
+For a mono pipeline, each slot can also hold the colour raw image the particle
+rois are cut from, next to the single-channel corrected image. Such a slot is
+4/3 of the size of a slot of the colour pipeline.
+'''
+import ctypes
+import multiprocessing
+import queue
+import logging
+import numpy as np
+
+#Get module-level logger
+logger = logging.getLogger(__name__)
+
+
+class FramePool():
+    '''
+    Pool of pre-allocated image buffers in shared memory
+
+    The pool must be created before the worker processes are started, and passed
+    to them as a Process argument.
+    '''
+    def __init__(self, nb_slots, shape, dtype=np.uint8, raw_shape=None):
+        '''
+        Allocate the shared buffers
+
+        Args:
+            nb_slots (int)          : number of images that can be held at the same time
+            shape (tuple)           : shape of each image, e.g. (2048, 2448, 3)
+            dtype=np.uint8          : data type of the images
+            raw_shape=None (tuple)  : if given, each slot also holds a uint8 raw image of this shape,
+                                      e.g. the colour raw image of a single-channel corrected image
+        '''
+        self.nb_slots = int(nb_slots)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.frame_size = int(np.prod(self.shape))
+        slot_bytes = self.frame_size * self.dtype.itemsize
+
+        self.buffer = multiprocessing.RawArray(ctypes.c_uint8, self.nb_slots * slot_bytes)
+        self.raw_shape = None
+        self.raw_buffer = None
+        if raw_shape is not None:
+            self.raw_shape = tuple(raw_shape)
+            self.raw_size = int(np.prod(self.raw_shape))
+            self.raw_buffer = multiprocessing.RawArray(ctypes.c_uint8, self.nb_slots * self.raw_size)
+            slot_bytes += self.raw_size
+        self.free_slots = multiprocessing.Queue()
+        for slot in range(self.nb_slots):
+            self.free_slots.put(slot)
+        # number of slots holding an image, shared with the workers releasing them
+        self.nb_used = multiprocessing.Value(ctypes.c_int, 0)
+
+        logger.debug('Frame pool of {0} slots ({1:.0f} MB)'.format(nb_slots,
+                     nb_slots * slot_bytes / 2**20))
+
+    def frame(self, slot):
+        '''
+        Get the image held in a slot, without copying it
+
+        Args:
+            slot (int)          : index of the slot
+
+        Returns:
+            frame (array)       : view of the slot with the shape and dtype of the pool
+        '''
+        frame = np.frombuffer(self.buffer, dtype=self.dtype, count=self.frame_size,
+                              offset=slot * self.frame_size * self.dtype.itemsize)
+        return frame.reshape(self.shape)
+
+    def raw(self, slot):
+        '''
+        Get the raw image held in a slot, without copying it
+
+        Args:
+            slot (int)          : index of the slot
+
+        Returns:
+            raw (uint8)         : view of the raw image of the slot (None if the pool holds no raw images)
+        '''
+        if self.raw_buffer is None:
+            return None
+        raw = np.frombuffer(self.raw_buffer, dtype=np.uint8, count=self.raw_size,
+                            offset=slot * self.raw_size)
+        return raw.reshape(self.raw_shape)
+
+    def put(self, img, timeout=None, imraw=None):
+        '''
+        Copy an image into a free slot
+
+        Args:
+            img (array)         : image with the shape of the pool
+            timeout=None (float): maximum number of seconds to wait for a slot to be released.
+                                  If None, wait until a slot is free
+            imraw=None (uint8)  : raw image with the raw shape of the pool, held in the same slot
+
+        Returns:
+            slot (int)          : index of the slot holding the image (or None if no slot
+                                  became free within the timeout)
+        '''
+        try:
+            slot = self.free_slots.get(True, timeout)
+        except queue.Empty:
+            return None
+        with self.nb_used.get_lock():
+            self.nb_used.value += 1
+        self.frame(slot)[...] = img
+        if imraw is not None:
+            self.raw(slot)[...] = imraw
+        return slot
+
+    def release(self, slot):
+        '''
+        Return a slot to the pool once its image has been processed
+
+        Args:
+            slot (int)          : index of the slot
+        '''
+        with self.nb_used.get_lock():
+            self.nb_used.value -= 1
+        self.free_slots.put(slot)
+
+    def in_use(self):
+        '''
+        Returns:
+            nb_used (int)       : number of slots holding an image waiting for or being processed
+        '''
+        return self.nb_used.value
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+'''
+Writing of the raw images to disc in a thread of its own, so that the
+acquisition keeps its frame rate while the images are written.
+
+The images are passed to the thread through a bounded queue. When the disc
+cannot keep up and the queue is full, the policy decides whether acquisition
+waits ('block'), or an image is dropped: the oldest image waiting in the queue
+('drop-oldest') or the new image ('drop-newest'). The files written are synced
+to disc in batches instead of one at a time.
+'''
+import os
+import time
+import queue
+import threading
+import logging
+import numpy as np
+from pysilcam.segments import SegmentWriter
+
+#Get module-level logger
+logger = logging.getLogger(__name__)
+
+# policies when the queue of images to write is full
+POLICIES = ('block', 'drop-oldest', 'drop-newest')
+
+
+class RawFrameWriter(threading.Thread):
+    '''
+    Thread writing raw images to .silc files (or segment files)
+
+    Usage:
+        writer = RawFrameWriter(datapath)
+        writer.start()
+        for timestamp, img in ...:
+            writer.put(timestamp, img)
+        writer.close()
+    '''
+    def __init__(self, datapath, queue_size=20, policy='block', fsync_interval=1.,
+                 fsync_frames=20, frames_per_segment=None):
+        '''
+        Args:
+            datapath (str)                  : folder the images are written to
+            queue_size=20 (int)             : number of images that can wait to be written
+            policy='block' (str)            : what to do when the queue is full, one of POLICIES
+            fsync_interval=1. (float)       : maximum number of seconds before written images are synced to disc
+            fsync_frames=20 (int)           : maximum number of images written before they are synced to disc
+            frames_per_segment=None (int)   : if given, the images are appended to segment files of this
+                                              number of images, instead of one .silc file each
+        '''
+        super(RawFrameWriter, self).__init__(name='RawFrameWriter')
+        if policy not in POLICIES:
+            raise ValueError('Unknown policy {0}, expected one of {1}'.format(policy, POLICIES))
+        self.daemon = True
+        self.datapath = datapath
+        self.frame_queue = queue.Queue(maxsize=queue_size)
+        self.policy = policy
+        self.fsync_interval = fsync_interval
+        self.fsync_frames = fsync_frames
+
+        self.segment_writer = None
+        if frames_per_segment is not None:
+            self.segment_writer = SegmentWriter(datapath, frames_per_segment=frames_per_segment, sync=False)
+
+        # files written but not synced to disc yet
+        self.unsynced = []
+        self.last_fsync = time.time()
+        self.error = None
+
+        # metrics
+        self.lock = threading.Lock()
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.latency = 0.
+        self.max_latency = 0.
+        self.fsyncs = 0
+        self.max_fsync_time = 0.
+
+    def put(self, timestamp, img):
+        '''
+        Passes an image to the thread to be written, following the policy if the queue is full
+
+        The image must not be modified afterwards.
+
+        Args:
+            timestamp (timestamp)   : timestamp of the image
+            img (uint8)             : raw image
+
+        Returns:
+            queued (bool)           : False if the image was dropped
+
+        Raises:
+            RuntimeError            : if the thread is not running, e.g. after an error writing to disc
+        '''
+        item = (timestamp, img, time.time())
+        if self.policy == 'block':
+            while True:
+                self._check_running()
+                try:
+                    self.frame_queue.put(item, True, 0.1)
+                    return True
+                except queue.Full:
+                    continue
+
+        self._check_running()
+        try:
+            self.frame_queue.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+
+        if self.policy == 'drop-newest':
+            self._dropped(timestamp)
+            return False
+
+        # drop-oldest: make room by removing the image that has waited longest
+        try:
+            oldest = self.frame_queue.get_nowait()
+            self._dropped(oldest[0])
+        except queue.Empty:
+            pass
+        self.frame_queue.put(item)
+        return True
+
+    def _check_running(self):
+        '''
+        Raises an error if the thread is not running, so acquisition does not carry on without writing
+        '''
+        if not self.is_alive():
+            raise RuntimeError('Raw image writer is not running: {0}'.format(self.error))
+
+    def _dropped(self, timestamp):
+        '''
+        Counts an image that is not written
+        '''
+        with self.lock:
+            self.frames_dropped += 1
+        logger.warning('Raw image dropped: {0}'.format(timestamp))
+
+    def run(self):
+        '''
+        Writes the images from the queue until close() is called
+        '''
+        try:
+            while True:
+                try:
+                    item = self.frame_queue.get(True, 0.1)
+                except queue.Empty:
+                    self._fsync_if_due()
+                    continue
+
+                if item is None:
+                    break
+                self.write(*item)
+                self._fsync_if_due()
+        except Exception as e:
+            logger.exception('Writing of the raw images failed')
+            self.error = e
+        finally:
+            self._fsync()
+            if self.segment_writer is not None:
+                self.segment_writer.close()
+
+    def write(self, timestamp, img, queued):
+        '''
+        Writes one image to disc, without syncing it
+
+        Args:
+            timestamp (timestamp)   : timestamp of the image
+            img (uint8)             : raw image
+            queued (float)          : time the image was passed to put()
+        '''
+        if self.segment_writer is not None:
+            self.segment_writer.write(timestamp, img)
+        else:
+            filename = os.path.join(self.datapath, timestamp.strftime('D%Y%m%dT%H%M%S.%f.silc'))
+            fh = open(filename, 'wb')
+            np.save(fh, img, allow_pickle=False)
+            fh.flush()
+            # the file is kept open until it is synced with the rest of the batch
+            self.unsynced.append(fh)
+            logger.info('Written {0}'.format(filename))
+
+        latency = time.time() - queued
+        with self.lock:
+            self.frames_written += 1
+            self.latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def _fsync_if_due(self):
+        '''
+        Syncs the written images if there are enough of them, or they have waited long enough
+        '''
+        nb_unsynced = len(self.unsynced)
+        if self.segment_writer is not None:
+            nb_unsynced = len(self.segment_writer.pending)
+        if nb_unsynced >= self.fsync_frames or \
+                (nb_unsynced > 0 and time.time() - self.last_fsync >= self.fsync_interval):
+            self._fsync()
+
+    def _fsync(self):
+        '''
+        Syncs the images written since the last sync to disc
+        '''
+        start = time.time()
+        if self.segment_writer is not None:
+            self.segment_writer.flush()
+        for fh in self.unsynced:
+            os.fsync(fh.fileno())
+            fh.close()
+        self.unsynced = []
+
+        fsync_time = time.time() - start
+        self.last_fsync = time.time()
+        with self.lock:
+            self.fsyncs += 1
+            self.max_fsync_time = max(self.max_fsync_time, fsync_time)
+
+    def close(self):
+        '''
+        Writes the images left in the queue, syncs them to disc and stops the thread
+        '''
+        while self.is_alive():
+            try:
+                self.frame_queue.put(None, True, 0.1)
+                break
+            except queue.Full:
+                continue
+        self.join()
+
+    def metrics(self):
+        '''
+        Returns:
+            metrics (dict)      : queue depth, number of images written and dropped, latency from
+                                  put() to written in seconds, and number and maximum time of syncs
+        '''
+        with self.lock:
+            return {'queue_depth': self.frame_queue.qsize(),
+                    'frames_written': self.frames_written,
+                    'frames_dropped': self.frames_dropped,
+                    'mean_latency': self.latency / self.frames_written if self.frames_written > 0 else np.nan,
+                    'max_latency': self.max_latency,
+                    'fsyncs': self.fsyncs,
+                    'max_fsync_time': self.max_fsync_time}
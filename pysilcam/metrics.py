@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+'''
+Timing instrumentation of the acquisition and processing
+
+Each process keeps its own metrics (see get_metrics()):
+    - the durations of the stages of the processing of each image, in histograms
+      of fixed logarithmic buckets. The time spent in a stage is summed over the
+      image with timer() and recorded once per image by end_frame(), so a stage
+      timed in several places is still counted once per image
+    - gauges, such as queue depths, and counters, such as dropped images
+    - the utilisation of the process: the fraction of time it is busy (see busy())
+
+The metrics are exported to a file of each process at intervals, when configured
+with configure(): in Prometheus text format (rewritten at each export, e.g. for
+the textfile collector of the node exporter), or in CSV format (a row appended
+for each metric at each export).
+
+Recording a duration costs a few microseconds, so the timers are always on.
+
+Usage:
+    import pysilcam.metrics as scmet
+    with scmet.timer('threshold'):
+        imbw = image2blackwhite_fast(img, threshold)
+    ...
+    scmet.end_frame()
+'''
+import os
+import time
+import bisect
+import logging
+import datetime
+import threading
+import multiprocessing
+from contextlib import contextmanager
+import numpy as np
+
+#Get module-level logger
+logger = logging.getLogger(__name__)
+
+# upper bounds of the histogram buckets [s], from 100 us to about 100 s
+BUCKETS = [1e-4 * 2**k for k in range(21)]
+
+# export formats and their file extensions
+FORMATS = {'prometheus': '.prom', 'csv': '.csv'}
+
+# metrics of this process, see get_metrics()
+_metrics = None
+
+
+class Histogram():
+    '''
+    Counts of values in fixed buckets, with their sum and maximum
+    '''
+    def __init__(self, buckets=BUCKETS):
+        '''
+        Args:
+            buckets=BUCKETS (list)  : increasing upper bounds of the buckets. Larger values are
+                                      counted in an extra bucket
+        '''
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def observe(self, value):
+        '''
+        Args:
+            value (float)       : value to count
+        '''
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        '''
+        Estimates a quantile as the upper bound of the bucket it falls in
+
+        Args:
+            q (float)           : quantile, between 0 and 1
+
+        Returns:
+            value (float)       : estimate of the quantile (nan if there are no values)
+        '''
+        if self.count == 0:
+            return np.nan
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics():
+    '''
+    Histograms of stage durations, gauges and counters of one process
+    '''
+    def __init__(self, process=None):
+        '''
+        Args:
+            process=None (str)  : name of the process in the exported metrics
+                                  (the multiprocessing process name if None)
+        '''
+        self.process = process if process is not None else multiprocessing.current_process().name
+        self.pid = os.getpid()
+        self.histograms = {}
+        self.gauges = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        # durations of the current image of each thread
+        self._local = threading.local()
+
+        self.filename = None
+        self.format = 'prometheus'
+        self.interval = 10.
+        self.last_export = time.time()
+        self.busy_time = 0.
+
+    def configure(self, filename, fmt='prometheus', interval=10.):
+        '''
+        Sets up the export of the metrics
+
+        Args:
+            filename (str)              : file prefix of the metrics files. The process name and the
+                                          extension of the format are added (None for no export)
+            fmt='prometheus' (str)      : 'prometheus' or 'csv'
+            interval=10. (float)        : minimum number of seconds between exports by end_frame()
+        '''
+        if fmt not in FORMATS:
+            raise ValueError('Unknown metrics format {0}, expected one of {1}'.format(fmt, list(FORMATS)))
+        self.filename = None
+        if filename is not None:
+            self.filename = '{0}-{1}{2}'.format(filename, self.process, FORMATS[fmt])
+        self.format = fmt
+        self.interval = interval
+
+    def _frame(self):
+        if not hasattr(self._local, 'frame'):
+            self._local.frame = {}
+        return self._local.frame
+
+    def add(self, stage, seconds):
+        '''
+        Adds time spent in a stage to the current image of the thread
+
+        Args:
+            stage (str)         : name of the stage
+            seconds (float)     : duration
+        '''
+        frame = self._frame()
+        frame[stage] = frame.get(stage, 0.) + seconds
+
+    @contextmanager
+    def timer(self, stage):
+        '''
+        Context manager adding the time spent in its block to a stage of the current image
+
+        Args:
+            stage (str)         : name of the stage
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def observe(self, stage, seconds):
+        '''
+        Records a duration straight into the histogram of a stage
+
+        Args:
+            stage (str)         : name of the stage
+            seconds (float)     : duration
+        '''
+        with self.lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram()
+            self.histograms[stage].observe(seconds)
+
+    def end_frame(self):
+        '''
+        Records the stage durations of the current image of the thread, and exports
+        the metrics if the export interval has passed
+        '''
+        frame = self._frame()
+        for stage, seconds in frame.items():
+            self.observe(stage, seconds)
+        frame.clear()
+        if self.filename is not None and time.time() - self.last_export >= self.interval:
+            self.export()
+
+    def gauge(self, name, value):
+        '''
+        Sets a gauge, e.g. a queue depth
+
+        Args:
+            name (str)          : name of the gauge
+            value (float)       : current value
+        '''
+        with self.lock:
+            self.gauges[name] = value
+
+    def count(self, name, n=1):
+        '''
+        Increments a counter, e.g. of dropped images
+
+        Args:
+            name (str)          : name of the counter
+            n=1 (int)           : increment
+        '''
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def busy(self, seconds):
+        '''
+        Adds time the process was busy, from which its utilisation is exported
+
+        Args:
+            seconds (float)     : busy time
+        '''
+        with self.lock:
+            self.busy_time += seconds
+
+    def export(self):
+        '''
+        Writes the metrics to the metrics file of the process
+        '''
+        now = time.time()
+        with self.lock:
+            if self.busy_time > 0:
+                # fraction of the time since the last export the process was busy
+                self.gauges['utilisation'] = min(1., self.busy_time / max(now - self.last_export, 1e-9))
+                self.busy_time = 0.
+            self.last_export = now
+            if self.filename is None:
+                return
+            try:
+                if self.format == 'csv':
+                    self._export_csv()
+                else:
+                    self._export_prometheus()
+            except OSError:
+                logger.warning('Could not write metrics to {0}'.format(self.filename), exc_info=True)
+
+    def _export_prometheus(self):
+        '''
+        Rewrites the metrics file in Prometheus text format, replacing the previous one in a single step
+        '''
+        label = 'process="{0}"'.format(self.process)
+        lines = []
+        if len(self.histograms) > 0:
+            lines.append('# HELP pysilcam_stage_duration_seconds Time spent in each stage per image')
+            lines.append('# TYPE pysilcam_stage_duration_seconds histogram')
+        for stage, histogram in sorted(self.histograms.items()):
+            labels = '{0},stage="{1}"'.format(label, stage)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append('pysilcam_stage_duration_seconds_bucket{{{0},le="{1:g}"}} {2}'.format(
+                    labels, bound, cumulative))
+            lines.append('pysilcam_stage_duration_seconds_bucket{{{0},le="+Inf"}} {1}'.format(
+                labels, histogram.count))
+            lines.append('pysilcam_stage_duration_seconds_sum{{{0}}} {1:.6f}'.format(labels, histogram.sum))
+            lines.append('pysilcam_stage_duration_seconds_count{{{0}}} {1}'.format(labels, histogram.count))
+        for name, value in sorted(self.gauges.items()):
+            lines.append('# TYPE pysilcam_{0} gauge'.format(name))
+            lines.append('pysilcam_{0}{{{1}}} {2:g}'.format(name, label, value))
+        for name, value in sorted(self.counters.items()):
+            lines.append('# TYPE pysilcam_{0}_total counter'.format(name))
+            lines.append('pysilcam_{0}_total{{{1}}} {2}'.format(name, label, value))
+
+        tmp_file = self.filename + '.tmp'
+        with open(tmp_file, 'w') as fh:
+            fh.write('\n'.join(lines) + '\n')
+        os.replace(tmp_file, self.filename)
+
+    def _export_csv(self):
+        '''
+        Appends a row for each metric to the metrics file in CSV format
+        '''
+        now = datetime.datetime.now().isoformat()
+        rows = []
+        for stage, h in sorted(self.histograms.items()):
+            rows.append([now, self.process, stage, h.count, '{0:.6f}'.format(h.sum),
+                         '{0:.6f}'.format(h.sum / h.count), '{0:g}'.format(h.quantile(0.5)),
+                         '{0:g}'.format(h.quantile(0.9)), '{0:g}'.format(h.quantile(0.99)),
+                         '{0:.6f}'.format(h.max), ''])
+        for name, value in sorted(list(self.gauges.items()) + list(self.counters.items())):
+            rows.append([now, self.process, name, '', '', '', '', '', '', '', '{0:g}'.format(value)])
+
+        new_file = not os.path.isfile(self.filename)
+        with open(self.filename, 'a') as fh:
+            if new_file:
+                fh.write('time,process,metric,count,sum,mean,p50,p90,p99,max,value\n')
+            for row in rows:
+                fh.write(','.join(str(v) for v in row) + '\n')
+
+
+def get_metrics():
+    '''
+    Metrics of this process, created on first use (and again in a process forked from it)
+
+    Returns:
+        metrics (Metrics)       : metrics of the process
+    '''
+    global _metrics
+    if _metrics is None or _metrics.pid != os.getpid():
+        _metrics = Metrics()
+    return _metrics
+
+
+def configure(filename, fmt='prometheus', interval=10.):
+    '''Sets up the export of the metrics of this process, see Metrics.configure()'''
+    get_metrics().configure(filename, fmt, interval)
+
+
+def timer(stage):
+    '''Times a block as part of a stage of the current image, see Metrics.timer()'''
+    return get_metrics().timer(stage)
+
+
+def add(stage, seconds):
+    '''Adds time spent in a stage to the current image, see Metrics.add()'''
+    get_metrics().add(stage, seconds)
+
+
+def end_frame():
+    '''Records the stage durations of the current image, see Metrics.end_frame()'''
+    get_metrics().end_frame()
+
+
+def gauge(name, value):
+    '''Sets a gauge, see Metrics.gauge()'''
+    get_metrics().gauge(name, value)
+
+
+def count(name, n=1):
+    '''Increments a counter, see Metrics.count()'''
+    get_metrics().count(name, n)
+
+
+def busy(seconds):
+    '''Adds busy time of the process, see Metrics.busy()'''
+    get_metrics().busy(seconds)
+
+
+def export():
+    '''Writes the metrics file of this process, see Metrics.export()'''
+    get_metrics().export()
@@ -6,6 +6,8 @@ import pysilcam.postprocess as sc_pp
 from pysilcam.config import PySilcamSettings
 from pysilcam.datalogger import DataLogger
 import itertools
+import bisect
+from collections import deque
 import pandas as pd
 import numpy as np
 import os
@@ -37,10 +39,18 @@ def getListPortCom():
     return com_list
 
 
-def extract_gas(stats, THRESH=0.85):
+def gas_mask(stats, THRESH=0.85):
+    '''
+    Selects the gas particles in stats, as extract_gas() does
+
+    Args:
+        stats (DataFrame)       : particle statistics
+        THRESH=0.85 (float)     : minimum probability of a bubble
+
+    Returns:
+        ind (bool array)        : True for the gas particles
+    '''
     ma = stats['minor_axis_length'] / stats['major_axis_length']
-    stats = stats[ma>0.3]
-    stats = stats[stats['solidity']>solidityThresh]
     ind = np.logical_or((stats['probability_bubble']>stats['probability_oil']),
             (stats['probability_oily_gas']>stats['probability_oil']))
 
@@ -49,58 +59,66 @@ def extract_gas(stats, THRESH=0.85):
 
     ind2 = stats['probability_bubble'] > THRESH
 
-    ind = np.logical_and(ind, ind2)
+    ind = (ma>0.3) & (stats['solidity']>solidityThresh) & ind & ind2
+    return ind.values
 
-    stats = stats[ind]
-    return stats
 
+def oil_mask(stats, THRESH=0.85):
+    '''
+    Selects the oil particles in stats, as extract_oil() does
+
+    Args:
+        stats (DataFrame)       : particle statistics
+        THRESH=0.85 (float)     : minimum probability of oil
 
-def extract_oil(stats, THRESH=0.85):
+    Returns:
+        ind (bool array)        : True for the oil particles
+    '''
     ma = stats['minor_axis_length'] / stats['major_axis_length']
-    stats = stats[ma>0.3]
-    stats = stats[stats['solidity']>solidityThresh]
     ind = np.logical_or((stats['probability_oil']>stats['probability_bubble']),
             (stats['probability_oil']>stats['probability_oily_gas']))
 
     ind2 = (stats['probability_oil'] > THRESH)
 
-    ind = np.logical_and(ind, ind2)
+    ind = (ma>0.3) & (stats['solidity']>solidityThresh) & ind & ind2
+    return ind.values
+
 
-    stats = stats[ind]
+def extract_gas(stats, THRESH=0.85):
+    stats = stats[gas_mask(stats, THRESH)]
     return stats
 
 
-def gor_timeseries(stats, settings):
-    from tqdm import tqdm
+def extract_oil(stats, THRESH=0.85):
+    stats = stats[oil_mask(stats, THRESH)]
+    return stats
 
-    u = stats['timestamp'].unique()
-    td = pd.to_timedelta('00:00:' + str(settings.window_size / 2.))
 
+def gor_timeseries(stats, settings):
     sample_volume = sc_pp.get_sample_volume(settings.pix_size, path_length=settings.path_length)
 
-    gor = []
-    time = []
-
-    for t in tqdm(u):
-        dt = pd.to_datetime(t)
-        stats_ = stats[(pd.to_datetime(stats['timestamp']) < (dt + td)) & (pd.to_datetime(stats['timestamp']) > (dt - td))]
-
-        oilstats = extract_oil(stats_)
-        dias, vd_oil = sc_pp.vd_from_stats(oilstats, settings)
-        nims = sc_pp.count_images_in_stats(oilstats)
-        sv = sample_volume * nims
-        vd_oil /= sv
-
-        gasstats = extract_gas(stats_)
-        dias, vd_gas = sc_pp.vd_from_stats(gasstats, settings)
-        nims = sc_pp.count_images_in_stats(gasstats)
-        sv = sample_volume * nims
-        vd_gas /= sv
-
-        gor_ = sum(vd_gas)/sum(vd_oil)
-
-        time.append(pd.to_datetime(t))
-        gor.append(gor_)
+    # bin all particles once, then sum the bins over the window around each image
+    time, image_index, size_bin = sc_pp.particle_bins(stats, settings)
+    dias, bin_limits_um = sc_pp.get_size_bins()
+    is_oil = oil_mask(stats)
+    is_gas = gas_mask(stats)
+
+    nd_oil = sc_pp.rolling_sum(time, sc_pp.nd_timeseries(image_index, size_bin, len(time), is_oil),
+                               settings.window_size)
+    nd_gas = sc_pp.rolling_sum(time, sc_pp.nd_timeseries(image_index, size_bin, len(time), is_gas),
+                               settings.window_size)
+
+    # oil and gas are scaled by the number of images within the window containing oil (or gas)
+    nims_oil = sc_pp.rolling_sum(time, np.float64(np.bincount(image_index[is_oil], minlength=len(time)) > 0),
+                                 settings.window_size)
+    nims_gas = sc_pp.rolling_sum(time, np.float64(np.bincount(image_index[is_gas], minlength=len(time)) > 0),
+                                 settings.window_size)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vd_oil = sc_pp.vd_from_nd(nd_oil, dias, sample_volume * nims_oil[:, np.newaxis])
+        vd_gas = sc_pp.vd_from_nd(nd_gas, dias, sample_volume * nims_gas[:, np.newaxis])
+        gor = list(np.sum(vd_gas, axis=1) / np.sum(vd_oil, axis=1))
+    time = list(time)
 
     if (len(gor) == 0) or (np.isnan(max(gor))):
         gor = np.nan
@@ -112,9 +130,17 @@ def gor_timeseries(stats, settings):
 class rt_stats():
     '''
     Class for maintining realtime statistics
+
+    The oil and gas number distributions of each image are kept in a ring
+    buffer ordered by time, together with their running sums, so adding an
+    image and dropping those older than the window costs the same whatever
+    the number of particles in the window.
+
+    The volume concentrations are scaled by the sample volume of the images
+    analysed within the window, so they do not depend on how many of the images
+    acquired were skipped in realtime mode.
     '''
     def __init__(self, settings):
-        self.stats = pd.DataFrame
         self.settings = settings
         self.dias = []
         self.vd_oil = []
@@ -122,32 +148,72 @@ class rt_stats():
         self.oil_d50 = np.nan
         self.gas_d50 = np.nan
         self.saturation = np.nan
+        # number of images analysed within the window
+        self.nims = 0
+
+        # (timestamp, oil number distribution, gas number distribution, saturation) of each image
+        self.images = deque()
+        self.nd_oil = 0
+        self.nd_gas = 0
+        # images in the window with decreasing saturation, so the first is the maximum
+        self.max_saturation = deque()
 
-    def update(self):
+    def update(self, stats):
         '''
-        Updates the rt_stats to remove data from before the specified window of seconds
+        Adds the stats of a new image and removes images from before the specified window of seconds
         given in the config ini file, here: settings.PostProcess.window_size
-        '''
-        self.stats = sc_pp.extract_latest_stats(self.stats,
-                self.settings.PostProcess.window_size)
 
-        #extract seperate stats on oil and gas
-        self.oil_stats = extract_oil(self.stats)
-        self.gas_stats = extract_gas(self.stats)
+        Args:
+            stats (DataFrame) : stats dataframe of one image returned from processImage()
+        '''
+        timestamp = pd.to_datetime(stats['timestamp']).max()
+        dias, nd_oil = sc_pp.nd_from_stats(extract_oil(stats), self.settings.PostProcess)
+        self.dias, nd_gas = sc_pp.nd_from_stats(extract_gas(stats), self.settings.PostProcess)
+        image = (timestamp, nd_oil, nd_gas, np.max(stats['saturation']))
+
+        self.nd_oil += nd_oil
+        self.nd_gas += nd_gas
+        if len(self.images) == 0 or timestamp >= self.images[-1][0]:
+            self.images.append(image)
+            while len(self.max_saturation) > 0 and not (self.max_saturation[-1][3] > image[3]):
+                self.max_saturation.pop()
+            self.max_saturation.append(image)
+        else:
+            # images processed in parallel can arrive late: keep the buffer sorted by time
+            self.images.insert(bisect.bisect_right([im[0] for im in self.images], timestamp), image)
+            self._rebuild_max_saturation()
+
+        # remove the images from before the window, as extract_latest_stats() does
+        start = self.images[-1][0] - pd.to_timedelta('00:00:' + str(self.settings.PostProcess.window_size))
+        while self.images[0][0] <= start:
+            expired = self.images.popleft()
+            self.nd_oil -= expired[1]
+            self.nd_gas -= expired[2]
+            if self.max_saturation[0] is expired:
+                self.max_saturation.popleft()
+
+        # scale by the volume sampled by the images analysed in the window, as nd_from_stats_scaled() does
+        self.nims = len(self.images)
+        sample_volume = sc_pp.get_sample_volume(self.settings.PostProcess.pix_size,
+                                                path_length=self.settings.PostProcess.path_length)
+        self.vd_oil = sc_pp.vd_from_nd(self.nd_oil, self.dias, sample_volume * self.nims)
+        self.vd_gas = sc_pp.vd_from_nd(self.nd_gas, self.dias, sample_volume * self.nims)
 
         #calculate d50
-        self.oil_d50 = sc_pp.d50_from_stats(self.oil_stats,
-            self.settings.PostProcess)
-        self.gas_d50 = sc_pp.d50_from_stats(self.gas_stats,
-                self.settings.PostProcess)
-
-        self.dias, self.vd_oil = sc_pp.vd_from_stats(self.oil_stats,
-                    self.settings.PostProcess)
-        self.dias, self.vd_gas = sc_pp.vd_from_stats(self.gas_stats,
-                    self.settings.PostProcess)
+        self.oil_d50 = sc_pp.d50_from_vd(self.vd_oil, self.dias)
+        self.gas_d50 = sc_pp.d50_from_vd(self.vd_gas, self.dias)
 
-        self.saturation = np.max(self.stats.saturation)
+        self.saturation = self.max_saturation[0][3]
 
+    def _rebuild_max_saturation(self):
+        '''
+        Rebuilds the queue of decreasing saturation after an image was inserted out of order
+        '''
+        self.max_saturation.clear()
+        for image in self.images:
+            while len(self.max_saturation) > 0 and not (self.max_saturation[-1][3] > image[3]):
+                self.max_saturation.pop()
+            self.max_saturation.append(image)
 
     def to_csv(self, filename):
         '''
@@ -161,6 +227,7 @@ class rt_stats():
         df['Gas d50[um]'] = [self.gas_d50]
         # @todo include saturation here too
         df['saturation [%]'] = [self.saturation]
+        df['Images analysed'] = [self.nims]
         df.to_csv(filename, index=False, mode='w') # do not append to this file
 
 
@@ -348,7 +415,7 @@ def convert_to_pj_format(stats_csv_file, config_file):
 
     settings = PySilcamSettings(config_file)
     logger.info('Loading stats....')
-    stats = pd.read_csv(stats_csv_file)
+    stats = sc_pp.load_stats(stats_csv_file)
 
     base_name = stats_csv_file.replace('-STATS.csv', '-PJ.csv')
     gas_name = base_name.replace('-PJ.csv', '-PJ-GAS.csv')
@@ -357,31 +424,30 @@ def convert_to_pj_format(stats_csv_file, config_file):
     ogdatafile_gas = DataLogger(gas_name, ogdataheader())
 
     stats['timestamp'] = pd.to_datetime(stats['timestamp'])
-    u = stats['timestamp'].unique()
     sample_volume = sc_pp.get_sample_volume(settings.PostProcess.pix_size, path_length=settings.PostProcess.path_length)
 
     logger.info('Analysing time-series')
-    for s in tqdm(u):
-        substats = stats[stats['timestamp'] == s]
-        nims = sc_pp.count_images_in_stats(substats)
-        sv = sample_volume * nims
-
-        oil = extract_oil(substats)
-        dias, vd_oil = sc_pp.vd_from_stats(oil, settings.PostProcess)
-        vd_oil /= sv
-
-        gas = extract_gas(substats)
-        dias, vd_gas = sc_pp.vd_from_stats(gas, settings.PostProcess)
-        vd_gas /= sv
-        d50_gas = sc_pp.d50_from_vd(vd_gas, dias)
-
-        vd_total = vd_oil + vd_gas
-        d50_total = sc_pp.d50_from_vd(vd_total, dias)
-
-        data_total = cat_data_pj(s, vd_total, d50_total, len(oil) + len(gas))
+    # bin all particles at once into [images x size bins] matrices of oil and gas
+    u, image_index, size_bin = sc_pp.particle_bins(stats, settings.PostProcess)
+    dias, bin_limits_um = sc_pp.get_size_bins()
+    is_oil = oil_mask(stats)
+    is_gas = gas_mask(stats)
+
+    vd_oil = sc_pp.vd_from_nd(sc_pp.nd_timeseries(image_index, size_bin, len(u), is_oil), dias, sample_volume)
+    vd_gas = sc_pp.vd_from_nd(sc_pp.nd_timeseries(image_index, size_bin, len(u), is_gas), dias, sample_volume)
+    vd_total = vd_oil + vd_gas
+    d50_gas = sc_pp.d50_from_vd_matrix(vd_gas, dias)
+    d50_total = sc_pp.d50_from_vd_matrix(vd_total, dias)
+
+    # number of oil and gas particles in each image, whatever their size
+    n_oil = np.bincount(image_index[is_oil], minlength=len(u))
+    n_gas = np.bincount(image_index[is_gas], minlength=len(u))
+
+    for i, s in enumerate(tqdm(u)):
+        data_total = cat_data_pj(s, vd_total[i], d50_total[i], n_oil[i] + n_gas[i])
         ogdatafile.append_data(data_total)
 
-        data_gas = cat_data_pj(s, vd_gas, d50_gas, len(gas))
+        data_gas = cat_data_pj(s, vd_gas[i], d50_gas[i], n_gas[i])
         ogdatafile_gas.append_data(data_gas)
 
     logger.info('  OK.')
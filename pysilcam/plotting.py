@@ -277,7 +277,7 @@ def summarise_fancy_stats(stats_csv_file, config_file, monitor=False,
             logger.warning('Unable to make montage. Check: {0} folder for h5 files'.format(settings.ExportParticles.outputpath))
             logger.warning('  in config file ExportParticles.export_images is {0}'.format(settings.ExportParticles.export_images))
 
-        stats = pd.read_csv(stats_csv_file)
+        stats = sc_pp.load_stats(stats_csv_file)
         stats = stats[(stats['major_axis_length'] *
                 settings.PostProcess.pix_size) < maxlength]
 
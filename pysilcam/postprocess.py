@@ -12,6 +12,8 @@ import skimage
 from skimage.exposure import rescale_intensity
 import h5py
 from pysilcam.config import PySilcamSettings
+from pysilcam.statsfile import stats_h5_filename, read_stats_h5, StatsFileWriter, time_query
+from pysilcam.segments import SegmentSet
 from enum import Enum
 from tqdm import tqdm
 import logging
@@ -26,6 +28,155 @@ class outputPartType(Enum):
     oil = 2
     gas = 3
 
+def load_stats(stats_file, start_time=None, end_time=None):
+    '''
+    Loads particle statistics written by silcam process
+
+    The binary -STATS.h5 file written alongside the -STATS.csv file is used
+    if it is up to date (see stats_h5_is_current()), as it is much faster to load.
+    When a time window is given, only the rows within the window are read from
+    the -STATS.h5 file, using its timestamp index.
+
+    Args:
+        stats_file (str)            : -STATS.csv (or -STATS.h5) filename
+        start_time=None             : only load data after this time
+        end_time=None               : only load data before this time
+
+    Returns:
+        stats (DataFrame)           : particle statistics, with the timestamp column as datetime64
+    '''
+    h5_file = stats_h5_filename(stats_file)
+    if h5_file == stats_file or stats_h5_is_current(stats_file):
+        logger.info('Loading stats from ' + h5_file)
+        return read_stats_h5(h5_file, where=time_query(start_time, end_time))
+
+    if os.path.isfile(h5_file):
+        logger.warning(h5_file + ' is older than ' + stats_file + ': not used. ' +
+                       'Use stats_csv_to_h5() to re-write it')
+    logger.info('Loading stats from ' + stats_file)
+    if start_time is None and end_time is None:
+        stats = pd.read_csv(stats_file)
+        stats['timestamp'] = pd.to_datetime(stats['timestamp'])
+        return stats
+
+    # read the csv file in chunks, keeping only the rows within the window
+    chunks = []
+    for chunk in pd.read_csv(stats_file, chunksize=100000):
+        chunk['timestamp'] = pd.to_datetime(chunk['timestamp'])
+        chunks.append(stats_between(chunk, start_time, end_time))
+    return pd.concat(chunks, ignore_index=True)
+
+
+def stats_h5_is_current(stats_file):
+    '''
+    Checks whether the -STATS.h5 file holds the same data as the -STATS.csv file
+
+    silcam process writes each batch of stats to the -STATS.csv file, then to the
+    -STATS.h5 file, so the -STATS.h5 file is up to date if it was modified no
+    earlier than the -STATS.csv file. A -STATS.h5 file left by an interrupted
+    write, or a -STATS.csv file appended to by other means, is older.
+
+    Args:
+        stats_file (str)            : -STATS.csv filename
+
+    Returns:
+        current (bool)              : True if the -STATS.h5 file exists and is up to date
+    '''
+    h5_file = stats_h5_filename(stats_file)
+    if not os.path.isfile(h5_file):
+        return False
+    if not os.path.isfile(stats_file):
+        return True
+    return os.path.getmtime(h5_file) >= os.path.getmtime(stats_file)
+
+
+def time_window_index(timestamps, start_time=None, end_time=None):
+    '''
+    Finds the rows with start_time < timestamp < end_time in sorted timestamps
+
+    Args:
+        timestamps (datetime64)     : sorted array of timestamps
+        start_time=None             : start of the time window (excluded), or None for no lower limit
+        end_time=None               : end of the time window (excluded), or None for no upper limit
+
+    Returns:
+        start (int)                 : index of the first row within the window
+        end (int)                   : index after the last row within the window
+    '''
+    start = 0
+    end = len(timestamps)
+    if start_time is not None:
+        start = np.searchsorted(timestamps, np.datetime64(pd.to_datetime(start_time)), side='right')
+    if end_time is not None:
+        end = np.searchsorted(timestamps, np.datetime64(pd.to_datetime(end_time)), side='left')
+    return start, max(start, end)
+
+
+def sort_stats_by_time(stats):
+    '''
+    Sorts particle statistics by time, keeping the order of the particles within each image
+
+    Args:
+        stats (DataFrame)           : particle statistics
+
+    Returns:
+        stats (DataFrame)           : sorted copy of stats, with the timestamp column as datetime64
+        timestamps (datetime64)     : sorted array of the timestamps of stats
+    '''
+    stats = stats.copy()
+    stats['timestamp'] = pd.to_datetime(stats['timestamp'])
+    stats = stats.sort_values(by='timestamp', kind='mergesort')
+    return stats, stats['timestamp'].values
+
+
+def stats_between(stats, start_time=None, end_time=None):
+    '''
+    Selects the particle statistics with start_time < timestamp < end_time
+
+    If the stats are sorted by time (as written by silcam process), the window
+    is found by binary search instead of comparing every timestamp.
+
+    Args:
+        stats (DataFrame)           : particle statistics
+        start_time=None             : start of the time window (excluded), or None for no lower limit
+        end_time=None               : end of the time window (excluded), or None for no upper limit
+
+    Returns:
+        stats (DataFrame)           : particle statistics within the time window
+    '''
+    timestamps = pd.to_datetime(stats['timestamp']).values
+
+    if np.all(timestamps[1:] >= timestamps[:-1]):
+        start, end = time_window_index(timestamps, start_time, end_time)
+        return stats.iloc[start:end]
+
+    selection = np.ones(len(timestamps), dtype=bool)
+    if start_time is not None:
+        selection &= timestamps > np.datetime64(pd.to_datetime(start_time))
+    if end_time is not None:
+        selection &= timestamps < np.datetime64(pd.to_datetime(end_time))
+    return stats[selection]
+
+
+def stats_csv_to_h5(stats_csv_file):
+    '''
+    Writes the -STATS.h5 file of an existing -STATS.csv file, so that load_stats() is faster next time
+
+    Args:
+        stats_csv_file (str)        : -STATS.csv filename
+
+    Returns:
+        h5_file (str)               : name of the -STATS.h5 file written
+    '''
+    stats = pd.read_csv(stats_csv_file)
+    writer = StatsFileWriter(stats_csv_file)
+    if os.path.isfile(writer.filename):
+        os.remove(writer.filename)
+    writer.append(stats)
+    writer.close()
+    return writer.filename
+
+
 def d50_from_stats(stats, settings):
     '''
     Calculate the d50 from the stats and settings
@@ -295,6 +446,151 @@ def vd_from_stats(stats, settings):
     return dias, vd
 
 
+def particle_bins(stats, settings):
+    ''' assign every particle to its image and size bin, in one pass over the stats
+
+    The images are numbered in the order in which their timestamps first appear
+    in the stats (as returned by stats['timestamp'].unique()). The size bins are
+    those of nd_from_stats(), including the upper limit in the largest bin.
+
+    Args:
+        stats (DataFrame)           : particle statistics from silcam process
+        settings (PySilcamSettings) : settings associated with the data, loaded with PySilcamSettings
+
+    Returns:
+        timestamps (DatetimeIndex)  : timestamp of each image
+        image_index (int array)     : image of each particle (row of timestamps)
+        size_bin (int array)        : size bin of each particle (-1 if outside the size bins or without a diameter)
+    '''
+    image_index, timestamps = pd.factorize(pd.to_datetime(stats['timestamp']))
+
+    # convert the equiv diameter from pixels into microns
+    ecd = stats['equivalent_diameter'].values * settings.pix_size
+
+    dias, bin_limits_um = get_size_bins()
+
+    # same bin edges as np.histogram: [lower, upper), except the last bin which is [lower, upper]
+    size_bin = np.digitize(ecd, bin_limits_um) - 1
+    size_bin[ecd == bin_limits_um[-1]] = len(dias) - 1
+    size_bin[(size_bin < 0) | (size_bin >= len(dias)) | np.isnan(ecd)] = -1
+
+    return pd.DatetimeIndex(timestamps), image_index, size_bin
+
+
+def nd_timeseries(image_index, size_bin, nb_images, selection=None):
+    ''' count particles into a [images x size bins] number distribution matrix
+
+    Args:
+        image_index (int array)     : image of each particle, from particle_bins()
+        size_bin (int array)        : size bin of each particle, from particle_bins()
+        nb_images (int)             : number of images (rows of the matrix)
+        selection=None (bool array) : optional selection of particles to count (e.g. oil or gas only)
+
+    Returns:
+        necd                        : number distribution in number/size-bin/image, one row per image
+    '''
+    nb_bins = len(get_size_bins()[0])
+
+    counted = size_bin >= 0
+    if selection is not None:
+        counted &= np.asarray(selection, dtype=bool)
+
+    flat_bin = image_index[counted] * nb_bins + size_bin[counted]
+    necd = np.bincount(flat_bin, minlength=nb_images * nb_bins)
+
+    return np.float64(necd.reshape(nb_images, nb_bins))
+
+
+def d50_from_vd_matrix(vd, dias):
+    ''' calculate the d50 of each row of a volume distribution matrix
+
+    Gives the same values as calling d50_from_vd() on every row.
+
+    Args:
+        vd                          : volume distributions, one per row (e.g. from nd_timeseries() and vd_from_nd())
+        dias                        : mid-points of size bins, returned from get_size_bins()
+
+    Returns:
+        d50 (array)                 : d50 of each row, in microns (nan for rows without particles)
+    '''
+    vd = np.atleast_2d(vd)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        csvd = np.cumsum(vd / np.sum(vd, axis=1, keepdims=True), axis=1)
+
+    # interpolate the 50th percentile as np.interp does on each row
+    j = np.sum(csvd <= 0.5, axis=1) - 1
+    jp = np.minimum(j + 1, len(dias) - 1)
+    rows = np.arange(csvd.shape[0])
+    xj = csvd[rows, np.maximum(j, 0)]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (dias[jp] - dias[np.maximum(j, 0)]) / (csvd[rows, jp] - xj)
+        d50 = slope * (0.5 - xj) + dias[np.maximum(j, 0)]
+
+    d50[j < 0] = dias[0]
+    d50[j == len(dias) - 1] = dias[-1]
+    d50[~np.isfinite(csvd[:, -1])] = np.nan
+
+    return d50
+
+
+def rolling_sum(timestamps, values, window_size):
+    ''' sum the rows of values over a time window centred on each row
+
+    The window around time t holds the rows with t - window_size/2 < timestamp < t + window_size/2,
+    as used by trim_stats(). The rows are sorted by time once, and the sum over each window
+    is the difference of two cumulative sums, so the cost does not depend on the window size.
+
+    Args:
+        timestamps (datetime64)     : timestamp of each row (e.g. from particle_bins())
+        values (array)              : values to sum, one row per timestamp (e.g. from nd_timeseries())
+        window_size (float)         : length of the window in seconds (settings.PostProcess.window_size)
+
+    Returns:
+        window_sum (array)          : sum of the rows within the window around each row, in the order of timestamps
+    '''
+    td = pd.to_timedelta('00:00:' + str(window_size / 2.))
+
+    timestamps = np.asarray(pd.to_datetime(timestamps), dtype='datetime64[ns]')
+    order = np.argsort(timestamps, kind='mergesort')
+    sorted_timestamps = timestamps[order]
+    start = np.searchsorted(sorted_timestamps, sorted_timestamps - td.to_timedelta64(), side='right')
+    end = np.searchsorted(sorted_timestamps, sorted_timestamps + td.to_timedelta64(), side='left')
+
+    values = np.asarray(values)
+    cumsum = np.zeros((len(values) + 1,) + values.shape[1:], dtype=values.dtype)
+    np.cumsum(values[order], axis=0, out=cumsum[1:])
+
+    window_sum = np.empty_like(cumsum[1:])
+    window_sum[order] = cumsum[end] - cumsum[start]
+    return window_sum
+
+
+def rolling_vd(timestamps, necd, window_size, sample_volume):
+    ''' calculate the volume distribution and number concentration over a time window centred on each image
+
+    Args:
+        timestamps (datetime64)     : timestamp of each image, from particle_bins()
+        necd                        : number distribution of each image, from nd_timeseries()
+        window_size (float)         : length of the window in seconds (settings.PostProcess.window_size)
+        sample_volume (float)       : sample volume of one image in litres, from get_sample_volume()
+
+    Returns:
+        vd                          : volume distribution within the window around each image, in micro-litres/litre
+        nc                          : number concentration within the window around each image, in #/L
+    '''
+    dias, bin_limits_um = get_size_bins()
+
+    # counts are whole numbers, so the cumulative sums are exact
+    necd = rolling_sum(timestamps, necd, window_size)
+    nims = rolling_sum(timestamps, np.ones(len(necd)), window_size)
+
+    sv = sample_volume * nims
+    vd = vd_from_nd(necd, dias, sv[:, np.newaxis])
+    nc = np.sum(necd, axis=1) / sv
+
+    return vd, nc
+
+
 class TimeIntegratedVolumeDist:
     ''' class used for summarising recent stats in real-time
 
@@ -462,8 +758,8 @@ def make_montage(stats_csv_file, pixel_size, roidir,
         montage (uint8)             : a nicely-made montage in the form of an image, which can be plotted using plotting.montage_plot(montage, settings.PostProcess.pix_size)
     '''
 
-    # obtain particle statistics from the csv file
-    stats = pd.read_csv(stats_csv_file)
+    # obtain particle statistics from the stats file
+    stats = load_stats(stats_csv_file)
 
     # remove nans because concentrations are not important here
     stats = stats[~np.isnan(stats['major_axis_length'])]
@@ -602,21 +898,16 @@ def d50_timeseries(stats, settings):
 
     '''
 
-    from tqdm import tqdm
-
     stats.sort_values(by=['timestamp'], inplace=True)
 
-    td = pd.to_timedelta('00:00:' + str(settings.window_size/2.))
-    d50 = []
-    time = []
-
-    u = pd.to_datetime(stats['timestamp']).unique()
+    # bin all particles once, then sum the bins over the window around each image
+    timestamps, image_index, size_bin = particle_bins(stats, settings)
+    necd = nd_timeseries(image_index, size_bin, len(timestamps))
+    dias, bin_limits_um = get_size_bins()
+    vd = vd_from_nd(rolling_sum(timestamps, necd, settings.window_size), dias)
 
-    for t in tqdm(u):
-        dt = pd.to_datetime(t)
-        stats_ = stats[(pd.to_datetime(stats['timestamp'])<(dt+td)) & (pd.to_datetime(stats['timestamp'])>(dt-td))]
-        d50.append(d50_from_stats(stats_, settings))
-        time.append(t)
+    d50 = list(d50_from_vd_matrix(vd, dias))
+    time = list(timestamps)
 
     if len(time) == 0:
         d50 = np.nan
@@ -765,12 +1056,12 @@ def extract_latest_stats(stats, window_size):
     '''
     end = np.max(pd.to_datetime(stats['timestamp']))
     start = end - pd.to_timedelta('00:00:' + str(window_size))
-    stats = stats[pd.to_datetime(stats['timestamp'])>start]
+    stats = stats_between(stats, start_time=start)
     return stats
 
 
 def silc_to_bmp(directory):
-    '''Convert a directory of silc files to bmp images
+    '''Convert a directory of silc files (or segment files) to bmp images
 
     Args:
         directory               : path of directory to convert
@@ -789,6 +1080,15 @@ def silc_to_bmp(directory):
             logger.warning('{0} failed!'.format(f))
             continue
 
+    # images in segment files are named after their timestamp, as the .silc files are
+    for timestamp, im in SegmentSet(directory).frames():
+        fout = timestamp.strftime('D%Y%m%dT%H%M%S.%f.bmp')
+        try:
+            imo.imwrite(os.path.join(directory, fout), np.asarray(im))
+        except:
+            logger.warning('{0} failed!'.format(fout))
+            continue
+
     logger.info('Done.')
 
 
@@ -803,28 +1103,16 @@ def make_timeseries_vd(stats, settings):
         dataframe: of time series volume concentrations are in uL/L columns with number headings are diameter min-points
     '''
 
-    from tqdm import tqdm
-
     stats['timestamp'] = pd.to_datetime(stats['timestamp'])
 
-    u = stats['timestamp'].unique()
-    
     sample_volume = get_sample_volume(settings.PostProcess.pix_size, path_length=settings.PostProcess.path_length)
 
-    vdts = []
-    d50 = []
-    timestamp = []
-    dias = []
-    for s in tqdm(u):
-        dias, vd = vd_from_stats(stats[stats['timestamp']==s],
-                settings.PostProcess)
-        nims = count_images_in_stats(stats[stats['timestamp']==s])
-        sv = sample_volume * nims
-        vd /= sv
-        d50_ = d50_from_vd(vd, dias)
-        d50.append(d50_)
-        timestamp.append(pd.to_datetime(s))
-        vdts.append(vd)
+    # bin all particles at once into a [images x size bins] matrix
+    timestamp, image_index, size_bin = particle_bins(stats, settings.PostProcess)
+    dias, limits = get_size_bins()
+    necd = nd_timeseries(image_index, size_bin, len(timestamp))
+    vdts = vd_from_nd(necd, dias, sample_volume)
+    d50 = d50_from_vd_matrix(vdts, dias)
 
     if len(vdts) == 0:
         dias, limits = get_size_bins()
@@ -862,7 +1150,7 @@ def stats_to_xls_png(config_file, stats_filename, oilgas=outputPartType.all):
     '''
     settings = PySilcamSettings(config_file)
     
-    stats = pd.read_csv(stats_filename)
+    stats = load_stats(stats_filename)
     stats.sort_values(by='timestamp', inplace=True)
     oilgasTxt = ''
 
@@ -917,14 +1205,14 @@ def trim_stats(stats_csv_file, start_time, end_time, write_new=False, stats=[]):
         trimmed_stats       : pandas DataFram of particle statistics
         outname             : name of new stats csv file written to disc
     '''
-    if len(stats)==0:
-        stats = pd.read_csv(stats_csv_file)
-
     start_time = pd.to_datetime(start_time)
     end_time = pd.to_datetime(end_time)
 
-    trimmed_stats = stats[
-        (pd.to_datetime(stats['timestamp']) > start_time) & (pd.to_datetime(stats['timestamp']) < end_time)]
+    if len(stats)==0:
+        # only load the data within the time window
+        trimmed_stats = load_stats(stats_csv_file, start_time=start_time, end_time=end_time)
+    else:
+        trimmed_stats = stats_between(stats, start_time, end_time)
 
     if np.isnan(trimmed_stats.equivalent_diameter.max()) or len(trimmed_stats) == 0:
         logger.info('No data in specified time range!')
@@ -941,6 +1229,11 @@ def trim_stats(stats_csv_file, start_time, end_time, write_new=False, stats=[]):
 
     if write_new:
         trimmed_stats.to_csv(outname)
+        writer = StatsFileWriter(outname)
+        if os.path.isfile(writer.filename):
+            os.remove(writer.filename)
+        writer.append(trimmed_stats)
+        writer.close()
 
     return trimmed_stats, outname
 
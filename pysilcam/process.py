@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import time
+import datetime
 import numpy as np
 from skimage import morphology
 from skimage import segmentation
@@ -17,6 +18,7 @@ import skimage.exposure
 import h5py
 import os
 import pysilcam.silcam_classify as sccl
+import pysilcam.metrics as scmet
 from skimage.io import imsave
 import traceback
 
@@ -30,18 +32,133 @@ TODO: add tests for this module
 logger = logging.getLogger(__name__)
 
 
-def image2blackwhite_accurate(imc, greythresh):
+def histogram_percentile(hist, q):
+    ''' calculates a percentile of integer data from its histogram, following the
+    linear interpolation of np.percentile
+
+    Args:
+        hist                        : number of occurences of each integer value, starting at 0
+        q                           : percentile to compute, between 0 and 100
+
+    Returns:
+        percentile                  : the q-th percentile of the data
+    '''
+    cumhist = np.cumsum(hist)
+    index = q / 100 * (cumhist[-1] - 1)
+    below = int(np.floor(index))
+    above = int(np.ceil(index))
+
+    # the value of the n-th sorted element is the first bin whose cumulative count exceeds n
+    value_below = np.searchsorted(cumhist, below, side='right')
+    value_above = np.searchsorted(cumhist, above, side='right')
+
+    return value_below + (value_above - value_below) * (index - below)
+
+
+def equalize_adapthist_fast(img, clip_limit, nbins=256, nb_tiles=8, subsample=None):
+    ''' approximation of skimage.exposure.equalize_adapthist for uint8 images
+
+    The equalisation maps of the nb_tiles x nb_tiles contextual regions are calculated
+    from histograms of a subsampled image, and applied to the full image as lookup
+    tables that are interpolated between the centres of the regions.
+
+    Args:
+        img                         : uint8 image (2D)
+        clip_limit                  : clipping limit, normalized between 0 and 1 (higher values give more contrast)
+        nbins=256                   : number of grey bins for the histograms
+        nb_tiles=8                  : number of contextual regions along each image dimension
+        subsample=None              : step between pixels used to calculate the histograms. If None, the
+                                      largest step that keeps at least 2**14 pixels in each region is used
+
+    Returns:
+        img_adapteq                 : equalised image (uint16, between 0 and 2**14-1), not rescaled to its full range
+    '''
+    nr_of_grey = 2**14
+
+    # stretch the grey levels to the range of the image and bin them, as done in skimage
+    levels = np.flatnonzero(np.bincount(img.ravel(), minlength=256))
+    grey = (np.arange(256) - levels[0]) / max(levels[-1] - levels[0], 1)
+    grey = np.round(np.clip(grey, 0, 1) * (nr_of_grey - 1))
+    grey_bin = (grey // (1 + nr_of_grey // nbins)).astype(np.intp)
+
+    # histograms of the contextual regions
+    kernel_size = [max(s // nb_tiles, 1) for s in img.shape]
+    nb_regions = [max(s // k, 1) for s, k in zip(img.shape, kernel_size)]
+    if subsample is None:
+        subsample = int(np.sqrt(kernel_size[0] * kernel_size[1] / 2**14))
+    subsample = max(min([subsample] + kernel_size), 1)
+    sub_size = [k // subsample for k in kernel_size]
+    imsub = img[:nb_regions[0] * kernel_size[0]:subsample,
+                :nb_regions[1] * kernel_size[1]:subsample]
+    imsub = imsub[:nb_regions[0] * sub_size[0], :nb_regions[1] * sub_size[1]]
+    regions = imsub.reshape(nb_regions[0], sub_size[0], nb_regions[1], sub_size[1])
+    regions = regions.transpose(0, 2, 1, 3).reshape(nb_regions[0] * nb_regions[1], -1)
+    region_bins = grey_bin[regions] + np.arange(regions.shape[0])[:, None] * nbins
+    hist = np.bincount(region_bins.ravel(), minlength=regions.shape[0] * nbins)
+    hist = hist.reshape(-1, nbins).astype(np.float64)
+
+    # clip the histograms and redistribute the excess evenly over all bins
+    n_pixels = regions.shape[1]
+    if clip_limit > 0:
+        clim = max(clip_limit * n_pixels, 1)
+    else:
+        clim = n_pixels
+    excess = np.maximum(hist - clim, 0).sum(axis=1, keepdims=True)
+    np.minimum(hist, clim, out=hist)
+    hist += excess / nbins
+
+    # equalisation maps, as lookup tables of the uint8 grey levels
+    maps = np.cumsum(hist, axis=1) * ((nr_of_grey - 1) / n_pixels)
+    maps = np.floor(np.minimum(maps, nr_of_grey - 1))
+    luts = maps[:, grey_bin].reshape(nb_regions[0], nb_regions[1], 256).astype(np.float32)
+
+    def bands(size, k, n):
+        # pixels between two region centres are interpolated between the two regions,
+        # pixels outside the outer centres use the nearest region
+        centres = [k // 2 + i * k for i in range(n)]
+        edges = [0] + [min(c, size) for c in centres] + [size]
+        pos = np.arange(size, dtype=np.float32)
+        for j in range(n + 1):
+            start, stop = edges[j], edges[j + 1]
+            if stop <= start:
+                continue
+            if 0 < j < n:
+                weight = (pos[start:stop] - centres[j - 1]) / k
+            else:
+                weight = np.zeros(stop - start, dtype=np.float32)
+            yield slice(start, stop), max(j - 1, 0), min(j, n - 1), weight
+
+    img_adapteq = np.empty(img.shape, dtype=np.uint16)
+    for rows, ty0, ty1, wy in bands(img.shape[0], kernel_size[0], nb_regions[0]):
+        for cols, tx0, tx1, wx in bands(img.shape[1], kernel_size[1], nb_regions[1]):
+            block = img[rows, cols]
+            top = luts[ty0, tx0].take(block)
+            top += wx * (luts[ty0, tx1].take(block) - top)
+            bottom = luts[ty1, tx0].take(block)
+            bottom += wx * (luts[ty1, tx1].take(block) - bottom)
+            top += wy[:, None] * (bottom - top)
+            img_adapteq[rows, cols] = top
+
+    return img_adapteq
+
+
+def image2blackwhite_accurate(imc, greythresh, fast_clahe=False):
     ''' converts corrected image (imc) to a binary image
     using greythresh as the threshold value (some auto-scaling of greythresh is done inside)
 
     Args:
         imc                         : background-corrected image
         greythresh                  : threshold multiplier (greythresh is multiplied by 50th percentile of the image histogram)
+        fast_clahe=False            : if True, percentiles are taken from histograms and the adaptive histogram
+                                      equalization is approximated by equalize_adapthist_fast (uint8 imc only)
 
     Returns:
         imbw                        : segmented image (binary image)
 
     '''
+    if fast_clahe:
+        return image2blackwhite_accurate_fast(imc, greythresh)
+
     img = np.copy(imc) # create a copy of the input image (not sure why)
 
     # obtain a semi-autimated treshold which can handle
@@ -72,6 +189,38 @@ def image2blackwhite_accurate(imc, greythresh):
     return imbw
 
 
+def image2blackwhite_accurate_fast(imc, greythresh):
+    ''' converts corrected image (imc) to a binary image in the same way as
+    image2blackwhite_accurate, but with histogram-based percentiles and a faster
+    approximation of the adaptive histogram equalization
+
+    Args:
+        imc                         : background-corrected image (uint8)
+        greythresh                  : threshold multiplier (greythresh is multiplied by 50th percentile of the image histogram)
+
+    Returns:
+        imbw                        : segmented image (binary image)
+    '''
+    # crude threshold from the 50th percentile of the image histogram
+    thresh = np.uint8(greythresh * histogram_percentile(np.bincount(imc.ravel(), minlength=256), 50))
+    imbw1 = imc < thresh
+
+    # adaptive historgram equalization
+    img_adapteq = equalize_adapthist_fast(imc, clip_limit=(1-greythresh), nbins=256)
+
+    # second threshold from the equalised image. skimage rescales the equalised
+    # image to [0, 1], so the threshold is scaled from the minimum of the image
+    hist = np.bincount(img_adapteq.ravel(), minlength=2**14)
+    lowest = np.flatnonzero(hist)[0]
+    newthresh = lowest + (histogram_percentile(hist, 0.75) - lowest) * greythresh
+    imbw2 = img_adapteq < newthresh
+
+    # merge both segmentation methods
+    imbw = imbw1 & imbw2
+
+    return imbw
+
+
 def image2blackwhite_fast(imc, greythresh):
     ''' converts corrected image (imc) to a binary image
     using greythresh as the threshold value (fixed scaling of greythresh is done inside)
@@ -119,6 +268,134 @@ def clean_bw(imbw, min_area):
     return imbw
 
 
+def segment_particles(imbw, min_area):
+    ''' cleans up a segmented image and labels the remaining particles (as
+    clean_bw followed by ndi.binary_fill_holes and labelling), using the
+    particle sizes and bounding boxes from the labelling instead of separate
+    passes over the image
+
+    Args:
+        imbw                        : segmented image
+        min_area                    : minimum number of accepted pixels for a particle
+
+    Returns:
+        iml                         : labelled image of the remaining particles (8-connectivity)
+        imbw                        : cleaned up segmented image, with holes filled
+    '''
+    with scmet.timer('clean'):
+        # remove objects that are below the detection limit defined in the config
+        # file (connected in the same way as morphology.remove_small_objects)
+        iml, nb_labels = ndi.label(imbw > 0)
+        large = np.bincount(iml.ravel(), minlength=nb_labels + 1) >= min_area
+        large[0] = False
+        imbw = large[iml]
+
+        # remove particles touching the border of the image, within the same
+        # distance as segmentation.clear_border(imbw, buffer_size=2). This is done
+        # before the holes are filled, so that a particle inside a ring touching
+        # the border is kept, as by clean_bw followed by ndi.binary_fill_holes
+        iml, nb_labels = ndi.label(imbw, structure=np.ones((3, 3)))
+        bboxes = particle_bboxes(iml)
+        ext = 3
+        r, c = np.shape(iml)
+        keep = np.zeros(nb_labels + 1, dtype=bool)
+        keep[1:] = ((bboxes[:, 0] >= ext) & (bboxes[:, 1] >= ext) &
+                    (bboxes[:, 2] <= r - ext) & (bboxes[:, 3] <= c - ext))
+        imbw = keep[iml]
+
+        # fill holes in particles: parts of the background that are not connected
+        # to the edge of the image (as ndi.binary_fill_holes)
+        background, nb_labels = ndi.label(~imbw)
+        hole = np.ones(nb_labels + 1, dtype=bool)
+        hole[0] = False
+        for edge in [background[0, :], background[-1, :], background[:, 0], background[:, -1]]:
+            hole[edge] = False
+        imfill = imbw | hole[background]
+
+    with scmet.timer('label'):
+        # label the particles, with holes filled
+        iml, nb_labels = ndi.label(imfill, structure=np.ones((3, 3)))
+
+    return iml, iml > 0
+
+
+def particle_bboxes(iml):
+    ''' bounding boxes of the particles in a labelled image
+
+    Args:
+        iml                         : labelled segmented image (particles numbered from 1)
+
+    Returns:
+        bboxes                      : array of [minr, minc, maxr, maxc] for each particle (as in regionprops)
+    '''
+    bboxes = [[sl[0].start, sl[1].start, sl[0].stop, sl[1].stop] if sl is not None else [0, 0, 0, 0]
+              for sl in ndi.find_objects(iml)]
+    return np.array(bboxes, dtype=np.int64).reshape(-1, 4)
+
+
+def particle_properties(iml):
+    ''' vectorised calculation of the geometrical properties of all particles in a
+    labelled image, giving the same values as measure.regionprops
+
+    Args:
+        iml                         : labelled segmented image (particles numbered from 1)
+
+    Returns:
+        props (dict)                : arrays of 'area', 'bbox', 'major_axis_length',
+                                      'minor_axis_length' and 'equivalent_diameter', one row per particle
+    '''
+    bboxes = particle_bboxes(iml)
+    nb_particles = len(bboxes)
+
+    # pixel coordinates of each particle, relative to its bounding box
+    rr, cc = np.nonzero(iml)
+    labels = iml[rr, cc]
+    rr = (rr - bboxes[labels - 1, 0]).astype(np.float64)
+    cc = (cc - bboxes[labels - 1, 1]).astype(np.float64)
+
+    def label_sum(weights=None):
+        return np.bincount(labels, weights=weights, minlength=nb_particles + 1)[1:]
+
+    area = label_sum()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_r = label_sum(rr) / area
+        mean_c = label_sum(cc) / area
+
+        # normalised central moments and the eigenvalues of the inertia tensor
+        mu_rr = label_sum(rr * rr) / area - mean_r ** 2
+        mu_cc = label_sum(cc * cc) / area - mean_c ** 2
+        mu_rc = label_sum(rr * cc) / area - mean_r * mean_c
+    half_trace = (mu_rr + mu_cc) / 2
+    root = np.sqrt(((mu_rr - mu_cc) / 2) ** 2 + mu_rc ** 2)
+    l1 = np.maximum(half_trace + root, 0)
+    l2 = np.maximum(half_trace - root, 0)
+
+    props = dict()
+    props['area'] = area
+    props['bbox'] = bboxes
+    props['major_axis_length'] = 4 * np.sqrt(l1)
+    props['minor_axis_length'] = 4 * np.sqrt(l2)
+    props['equivalent_diameter'] = np.sqrt(4 * area / np.pi)
+
+    return props
+
+
+def particle_solidity(iml, label, bbox, area):
+    ''' solidity of one particle (area / convex area, as in regionprops)
+
+    Args:
+        iml                         : labelled segmented image
+        label                       : label of the particle in iml
+        bbox                        : bounding box of the particle [minr, minc, maxr, maxc]
+        area                        : area of the particle in pixels
+
+    Returns:
+        solidity                    : solidity of the particle
+    '''
+    imbw = extract_roi(iml, bbox) == label
+    return area / np.sum(morphology.convex_hull_image(imbw))
+
+
 def filter_bad_stats(stats,settings):
     ''' remove unacceptable particles from the stats
 
@@ -144,7 +421,7 @@ def filter_bad_stats(stats,settings):
     return stats
 
 
-def fancy_props(iml, imc, timestamp, settings, nnmodel, class_labels):
+def fancy_props(iml, imc, timestamp, settings, nnmodel, class_labels, imraw=None):
     '''Calculates fancy particle properties
 
     Args:
@@ -154,15 +431,18 @@ def fancy_props(iml, imc, timestamp, settings, nnmodel, class_labels):
         settings                    : PySilCam settings
         nnmodel                     : loaded tensorflow model from silcam_classify
         class_labels                : lables of particle classes in tensorflow model
+        imraw=None                  : colour raw image the particle rois are cut from, if imc is single-channel
 
     Return:
         stats                       : particle statistics
 
     '''
 
-    region_properties = measure.regionprops(iml, cache=False, coordinates='xy')
+    with scmet.timer('measure'):
+        particle_props = particle_properties(iml)
     # build the stats and export to HDF5
-    stats = extract_particles(imc,timestamp,settings,nnmodel,class_labels, region_properties)
+    stats = extract_particles(imc,timestamp,settings,nnmodel,class_labels, iml, particle_props,
+                              imraw=imraw)
 
     return stats
 
@@ -235,13 +515,15 @@ def extract_roi(im, bbox):
     return roi
 
 
-def measure_particles(imbw, imc, settings, timestamp, nnmodel, class_labels):
+def measure_particles(imbw, imc, settings, timestamp, nnmodel, class_labels, iml=None, imraw=None):
     '''Measures properties of particles
 
     Args:
       imbw (full-frame binary image)
       imc (full-frame corrected raw image)
       image_index (some sort of tag for location matching)
+      iml=None (labelled imbw, e.g. from segment_particles. imbw is labelled here if None)
+      imraw=None (full-frame colour raw image the particle rois are cut from, if imc is single-channel)
 
     Returns:
       stats (list of particle statistics for every particle, according to
@@ -254,9 +536,11 @@ def measure_particles(imbw, imc, settings, timestamp, nnmodel, class_labels):
         logger.warning('....breached concentration limit! Skipping image.')
         imbw *= 0 # this is not a good way to handle this condition
         # @todo handle situation when too many particles are found
+        iml = None
 
     # label the segmented image
-    iml = morphology.label(imbw > 0)
+    if iml is None:
+        iml, nb_labels = ndi.label(imbw > 0, structure=np.ones((3, 3)))
     logger.info('  {0} particles found'.format(iml.max()))
 
     # if there are too many particles then do no proceed with analysis
@@ -266,20 +550,21 @@ def measure_particles(imbw, imc, settings, timestamp, nnmodel, class_labels):
         # @todo handle situation when too many particles are found
 
     # calculate particle statistics
-    stats = fancy_props(iml, imc, timestamp, settings, nnmodel, class_labels)
+    stats = fancy_props(iml, imc, timestamp, settings, nnmodel, class_labels, imraw=imraw)
 
     return stats, saturation
 
 
-def statextract(imc, settings, timestamp, nnmodel, class_labels):
+def statextract(imc, settings, timestamp, nnmodel, class_labels, imraw=None):
     '''extracts statistics of particles in imc (raw corrected image)
 
     Args:
-        imc                         : background-corrected image
+        imc                         : background-corrected image, in colour or single-channel
         timestamp                   : timestamp of image collection
         settings                    : PySilCam settings
         nnmodel                     : loaded tensorflow model from silcam_classify
         class_labels                : lables of particle classes in tensorflow model
+        imraw=None                  : colour raw image the particle rois are cut from, if imc is single-channel
 
     Returns:
         stats                       : (list of particle statistics for every particle, according to Partstats class)
@@ -290,28 +575,33 @@ def statextract(imc, settings, timestamp, nnmodel, class_labels):
 
     # simplyfy processing by squeezing the image dimensions into a 2D array
     # min is used for squeezing to represent the highest attenuation of all wavelengths
-    img = np.uint8(np.min(imc, axis=2))
-
-    if settings.Process.real_time_stats:
-        imbw = image2blackwhite_fast(img, settings.Process.threshold) # image2blackwhite_fast is less fancy but
+    # (a single-channel image from a mono pipeline is already 2D)
+    if imc.ndim == 2:
+        img = imc
     else:
-        imbw = image2blackwhite_accurate(img, settings.Process.threshold) # image2blackwhite_fast is less fancy but
+        img = np.uint8(np.min(imc, axis=2))
+
+    with scmet.timer('threshold'):
+        if settings.Process.real_time_stats:
+            imbw = image2blackwhite_fast(img, settings.Process.threshold) # image2blackwhite_fast is less fancy but
+        else:
+            imbw = image2blackwhite_accurate(img, settings.Process.threshold,
+                    fast_clahe=getattr(settings.Process, 'fast_clahe', False)) # image2blackwhite_fast is less fancy but
     # image2blackwhite_fast is faster than image2blackwhite_accurate but might cause problems when trying to
     # process images with bad lighting
 
     logger.debug('clean')
 
-    # clean segmented image (small particles and border particles)
-    imbw = clean_bw(imbw, settings.Process.minimum_area)
-
-    # fill holes in particles
-    imbw = ndi.binary_fill_holes(imbw)
+    # clean segmented image (fill holes in particles, remove small particles
+    # and border particles) and label the remaining particles
+    iml, imbw = segment_particles(imbw, settings.Process.minimum_area)
 
     write_segmented_images(imbw, imc, settings, timestamp)
 
     logger.debug('measure')
     # calculate particle statistics
-    stats, saturation = measure_particles(imbw, imc, settings, timestamp, nnmodel, class_labels)
+    stats, saturation = measure_particles(imbw, imc, settings, timestamp, nnmodel, class_labels,
+                                          iml=iml, imraw=imraw)
 
     return stats, imbw, saturation
 
@@ -332,7 +622,7 @@ def write_segmented_images(imbw, imc, settings, timestamp):
         imsave(fname, imc)
 
 
-def extract_particles(imc, timestamp, settings, nnmodel, class_labels, region_properties):
+def extract_particles(imc, timestamp, settings, nnmodel, class_labels, iml, particle_props, imraw=None):
     '''extracts the particles to build stats and export particle rois to HDF5 files writted to disc in the location of settings.ExportParticles.outputpath
 
     Args:
@@ -341,17 +631,25 @@ def extract_particles(imc, timestamp, settings, nnmodel, class_labels, region_pr
         settings                    : PySilCam settings
         nnmodel                     : loaded tensorflow model from silcam_classify
         class_labels                : lables of particle classes in tensorflow model
-        region_properties           : region properties object returned from regionprops (measure.regionprops(iml, cache=False))
+        iml                         : labelled segmented image
+        particle_props              : particle properties of iml returned from particle_properties(iml)
+        imraw=None                  : colour raw image the rois are cut from instead of imc, for a
+                                      single-channel imc from a mono pipeline
 
     Returns:
         stats                       : (list of particle statistics for every particle, according to Partstats class)
 
-    @todo clean up all the unnesessary conditional statements in this
+    Solidity is only calculated for particles which match the export criteria, and is nan for the others.
+
+    The rois cut from imraw are not background corrected: they hold the background of the
+    raw image, so the exported rois and the class probabilities of a mono pipeline are not
+    the same as those of the colour pipeline. The geometrical properties are unchanged.
     '''
-    filenames = ['not_exported'] * len(region_properties)
+    nb_particles = len(particle_props['area'])
+    filenames = ['not_exported'] * nb_particles
 
     # pre-allocation
-    predictions = np.zeros((len(region_properties),
+    predictions = np.zeros((nb_particles,
          len(class_labels)),
          dtype='float64')
     predictions *= np.nan
@@ -360,61 +658,84 @@ def extract_particles(imc, timestamp, settings, nnmodel, class_labels, region_pr
     filename = timestamp.strftime('D%Y%m%dT%H%M%S.%f')
 
     if settings.ExportParticles.export_images:
-        # Make the HDF5 file
-        hdf_filename = os.path.join(settings.ExportParticles.outputpath, filename + ".h5")
-        HDF5File = h5py.File(hdf_filename, "w")
-        # metadata
-        meta = HDF5File.create_group('Meta')
-        meta.attrs['Modified'] = str(pd.datetime.now())
-        settings_dict = {s: dict(settings.config.items(s)) for s in settings.config.sections()}
-        meta.attrs['Settings'] = str(settings_dict)
-        meta.attrs['Timestamp'] = str(timestamp)
-        meta.attrs['Raw image name'] = filename
-        #@todo include more useful information in this meta data, e.g. possibly raw image location and background stack file list.
-
-    # define the geometrical properties to be calculated from regionprops
+        with scmet.timer('hdf5_export'):
+            # Make the HDF5 file
+            hdf_filename = os.path.join(settings.ExportParticles.outputpath, filename + ".h5")
+            HDF5File = h5py.File(hdf_filename, "w")
+            # metadata
+            meta = HDF5File.create_group('Meta')
+            meta.attrs['Modified'] = str(datetime.datetime.now())
+            settings_dict = {s: dict(settings.config.items(s)) for s in settings.config.sections()}
+            meta.attrs['Settings'] = str(settings_dict)
+            meta.attrs['Timestamp'] = str(timestamp)
+            meta.attrs['Raw image name'] = filename
+            #@todo include more useful information in this meta data, e.g. possibly raw image location and background stack file list.
+
+    # the geometrical properties to be reported for each particle
     propnames = ['major_axis_length', 'minor_axis_length',
                  'equivalent_diameter', 'solidity']
 
-    # pre-allocate some things
-    data = np.zeros((len(region_properties), len(propnames)), dtype=np.float64)
-    bboxes = np.zeros((len(region_properties), 4), dtype=np.float64)
-    nb_extractable_part = 0
+    major_axis_length = particle_props['major_axis_length']
+    minor_axis_length = particle_props['minor_axis_length']
+    bboxes = particle_props['bbox']
 
-    for i, el in enumerate(region_properties):
-        data[i, :] = [getattr(el, p) for p in propnames]
-        bboxes[i, :] = el.bbox
+    # Find particles that match export criteria
+    candidates = np.flatnonzero((major_axis_length > settings.ExportParticles.min_length) & #major_axis_length in pixels
+                                (minor_axis_length > 2)) # minor length in pixels
 
+    solidity = np.zeros(nb_particles, dtype=np.float64) * np.nan
+    with scmet.timer('measure'):
+        for i in candidates:
+            solidity[i] = particle_solidity(iml, i + 1, bboxes[i], particle_props['area'][i])
+
+    if settings.Process.real_time_stats:
         # if operating in realtime mode, assume we only care about oil and gas and skip export of overly-derformed particles
-        if settings.Process.real_time_stats & (((data[i, 1]/data[i, 0])<0.3) | (data[i, 3]<0.95)):
-            continue
-        # Find particles that match export criteria
-        if ((data[i, 0] > settings.ExportParticles.min_length) & #major_axis_length in pixels
-            (data[i, 1] > 2)): # minor length in pixels
-
-            nb_extractable_part += 1
-            # extract the region of interest from the corrected colour image
-            roi = extract_roi(imc,bboxes[i, :].astype(int))
-
-            # add the roi to the HDF5 file
-            filenames[int(i)] = filename + '-PN' + str(i)
-            if settings.ExportParticles.export_images:
+        candidates = candidates[((minor_axis_length[candidates] / major_axis_length[candidates]) >= 0.3) &
+                                (solidity[candidates] >= 0.95)]
+    nb_extractable_part = len(candidates)
+
+    # scaled rois and their particle numbers, classified together after the loop
+    classify_rois = []
+    classify_index = []
+
+    # the rois are cut from the corrected colour image, or from the (uncorrected) colour
+    # raw image when only a single channel was corrected
+    imroi = imc if imraw is None else imraw
+
+    for i in candidates:
+        # extract the region of interest from the colour image
+        roi = extract_roi(imroi, bboxes[i, :])
+
+        # add the roi to the HDF5 file
+        filenames[int(i)] = filename + '-PN' + str(i)
+        if settings.ExportParticles.export_images:
+            with scmet.timer('hdf5_export'):
                 dset = HDF5File.create_dataset('PN' + str(i), data = roi)
                 #@todo also include particle stats here too.
 
-            # run a prediction on what type of particle this might be
-            prediction = sccl.predict(roi, nnmodel)
-            predictions[int(i),:] = prediction[0]
+        # scale the roi ready for classification
+        with scmet.timer('classify'):
+            classify_rois.append(sccl.prepare_roi(roi))
+        classify_index.append(int(i))
 
     if settings.ExportParticles.export_images:
         # close the HDF5 file
-        HDF5File.close()
+        with scmet.timer('hdf5_export'):
+            HDF5File.close()
+
+    # run a prediction on what type of particle each exported roi might be,
+    # using batches of rois instead of one call to the model per particle
+    if len(classify_index) > 0:
+        with scmet.timer('classify'):
+            predictions[classify_index, :] = sccl.predict_batch(np.stack(classify_rois), nnmodel)
 
     # build the column names for the outputed DataFrame
     column_names = np.hstack(([propnames, 'minr', 'minc', 'maxr', 'maxc']))
 
-    # merge regionprops statistics with a seperate bounding box columns
-    cat_data = np.hstack((data, bboxes))
+    # merge particle properties with a seperate bounding box columns
+    data = np.column_stack([major_axis_length, minor_axis_length,
+                            particle_props['equivalent_diameter'], solidity])
+    cat_data = np.hstack((data, bboxes.astype(np.float64)))
 
     # put particle statistics into a DataFrame
     stats = pd.DataFrame(columns=column_names, data=cat_data)
@@ -439,10 +760,11 @@ def processImage(nnmodel, class_labels, image, settings, logger, gui):
     Args:
         nnmodel (tensorflow model object)   :  loaded using sccl.load_model()
         class_labels (str)                  :  loaded using sccl.load_model()
-        image  (tuple)                      :  tuple contianing (i, timestamp, imc)
+        image  (tuple)                      :  tuple contianing (i, timestamp, imc) or (i, timestamp, imc, imraw)
                                                where i is an int referring to the image number
                                                timestamp is the image timestamp obtained from passing the filename
                                                imc is the background-corrected image obtained using the backgrounder generator
+                                               imraw is the colour raw image, given when imc is single-channel
         settings (PySilcamSettings)         :  Settings read from a .ini file
         logger (logger object)              :  logger object created using
                                                configure_logger()
@@ -456,6 +778,7 @@ def processImage(nnmodel, class_labels, image, settings, logger, gui):
         i = image[0]
         timestamp = image[1]
         imc = image[2]
+        imraw = image[3] if len(image) > 3 else None
 
         # time the full acquisition and processing loop
         start_time = time.time()
@@ -464,7 +787,7 @@ def processImage(nnmodel, class_labels, image, settings, logger, gui):
 
         # Calculate particle statistics
         stats_all, imbw, saturation = statextract(imc, settings, timestamp,
-                                                  nnmodel, class_labels)
+                                                  nnmodel, class_labels, imraw=imraw)
 
         # if there are not particles identified, assume zero concentration.
         # This means that the data should indicate that a 'good' image was
@@ -487,6 +810,8 @@ def processImage(nnmodel, class_labels, image, settings, logger, gui):
 
         # Time the particle statistics processing step
         proc_time = time.time() - start_time
+        scmet.add('process_image', proc_time)
+        scmet.busy(proc_time)
 
         # Print timing information for this iteration
         infostr = '  Image {0} processed in {1:.2f} sec ({2:.1f} Hz). '
@@ -502,6 +827,9 @@ def processImage(nnmodel, class_labels, image, settings, logger, gui):
         infostr = 'Failed to process frame {0}, skipping.'.format(i)
         logger.warning(infostr, exc_info=True)
         return None
+    finally:
+        # the stage durations of this image are recorded, and exported at intervals
+        scmet.end_frame()
 
     return stats_all
 
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+'''
+Choice of the images to process in realtime mode, when the processing cannot
+keep up with the acquisition (load shedding).
+
+The scheduler estimates the fraction of the acquired images that can be
+processed from the number of images the workers complete for each image
+acquired, and corrects it to keep the number of images waiting for or being
+processed (in flight) around a target: more images are processed while fewer
+than the target are in flight, up to every image. The policy decides which
+images make up that fraction:
+    - 'newest': every image is queued, and the workers take the newest waiting
+      image first. Images are only skipped when all buffers are in use, so the
+      images processed come in bursts. This was the behaviour before the scheduler
+    - 'stride': the images processed are evenly spaced in time (e.g. one in three),
+      so they are an unbiased sample of the acquisition. Use this when the
+      concentrations have to be correct
+    - 'quality': the images with the most even lighting of the recent images are
+      processed (see image_quality()). The measure ignores the particles, so the
+      images with many particles are not skipped more than the others, but the
+      images processed are not evenly spaced in time
+
+Every image acquired is recorded in a frames log (CSV file), with whether it was
+queued or skipped and why, so the images actually analysed are known afterwards.
+'''
+import os
+import logging
+from collections import deque
+import numpy as np
+
+#Get module-level logger
+logger = logging.getLogger(__name__)
+
+# policies choosing the images to skip
+POLICIES = ('newest', 'stride', 'quality')
+
+# columns of the frames log
+FRAMES_LOG_HEADER = 'timestamp,frame,status,reason,fraction,in_flight,quality\n'
+
+
+def image_quality(imc, tiles=4, percentile=90):
+    '''
+    Quality of the lighting of a corrected image, from how even its background level is
+
+    The background level of each tile of the image is a high percentile of the tile,
+    which the dark particles do not change unless they cover most of the tile. The
+    standard deviation of the image (as in the bad lighting check) would rank the
+    images with many particles lowest, and skipping them would bias the concentrations low.
+
+    Args:
+        imc (uint8)                 : corrected image
+        tiles=4 (int)               : number of tiles along each side of the image
+        percentile=90 (float)       : percentile of each tile taken as its background level
+
+    Returns:
+        quality (float)     : minus the standard deviation of the background levels of the tiles, so higher is better
+    '''
+    sub = imc[::4, ::4]
+    tiles = min(tiles, sub.shape[0], sub.shape[1])
+    levels = [np.percentile(tile, percentile)
+              for band in np.array_split(sub, tiles, axis=0)
+              for tile in np.array_split(band, tiles, axis=1)]
+    return -np.std(levels)
+
+
+class FrameScheduler():
+    '''
+    Decides which acquired images are processed, and records all of them in the frames log
+
+    Usage:
+        scheduler = FrameScheduler(capacity, target, policy='stride', frames_log=datafilename + '-FRAMES.csv')
+        for i, (timestamp, imc, imraw) in enumerate(bggen):
+            process, reason = scheduler.select(imc, frame_pool.in_use())
+            if process and not addToQueue(...):
+                reason = 'full'
+            scheduler.record(i, timestamp, reason)
+        scheduler.close()
+    '''
+    def __init__(self, capacity, target=None, policy='newest', frames_log=None,
+                 gain=0.05, smoothing=0.05, min_fraction=0.01, quality_window=100):
+        '''
+        Args:
+            capacity (int)              : number of images that can be in flight (buffers available)
+            target=None (int)           : number of images in flight the scheduler aims at
+                                          (half the capacity if None)
+            policy='newest' (str)       : images to skip when overloaded, one of POLICIES
+            frames_log=None (str)       : CSV file recording every image (no log if None)
+            gain=0.05 (float)           : correction of the fraction, per buffer away from the target
+            smoothing=0.05 (float)      : weight of each image in the average number of images completed
+            min_fraction=0.01 (float)   : smallest fraction of the images processed
+            quality_window=100 (int)    : number of recent images the quality of an image is ranked against
+        '''
+        if policy not in POLICIES:
+            raise ValueError('Unknown policy {0}, expected one of {1}'.format(policy, POLICIES))
+        self.capacity = capacity
+        self.target = target if target is not None else max(1, capacity // 2)
+        self.policy = policy
+        self.gain = gain
+        self.smoothing = smoothing
+        self.min_fraction = min_fraction
+
+        # fraction of the images that can be processed, and average number of images
+        # completed by the workers for each image acquired
+        self.fraction = 1.
+        self.throughput = 1.
+        # images owed to the stride policy, an image is processed each time it reaches 1
+        self.credit = 1.
+        self.qualities = deque(maxlen=quality_window)
+
+        self.in_flight = 0
+        self.queued = False
+        self.quality = np.nan
+        self.nb_queued = 0
+        self.nb_skipped = 0
+
+        self.frames_log = None
+        if frames_log is not None:
+            new_file = not os.path.isfile(frames_log)
+            self.frames_log = open(frames_log, 'a')
+            if new_file:
+                self.frames_log.write(FRAMES_LOG_HEADER)
+            logger.info('Frames log: ' + frames_log)
+
+    def select(self, imc, in_flight):
+        '''
+        Decides whether an image is processed
+
+        Args:
+            imc (uint8)         : corrected image
+            in_flight (int)     : number of images waiting for or being processed
+
+        Returns:
+            process (bool)      : True if the image should be queued for processing
+            reason (str)        : why the image is skipped ('' if it is processed)
+        '''
+        # images completed since the previous image was acquired
+        completed = max(0, self.in_flight + self.queued - in_flight)
+        self.throughput += self.smoothing * (completed - self.throughput)
+        self.in_flight = in_flight
+
+        self.fraction = self.throughput + self.gain * (self.target - in_flight) / self.capacity
+        self.fraction = min(1., max(self.min_fraction, self.fraction))
+
+        if self.policy == 'stride':
+            self.credit += self.fraction
+            if self.credit < 1:
+                return False, 'stride'
+            self.credit -= 1
+        elif self.policy == 'quality':
+            self.quality = image_quality(imc)
+            self.qualities.append(self.quality)
+            if self.quality < np.percentile(self.qualities, 100 * (1 - self.fraction)):
+                return False, 'quality'
+        return True, ''
+
+    def record(self, i, timestamp, reason=''):
+        '''
+        Records an image in the frames log
+
+        Args:
+            i (int)                 : index of the image acquired
+            timestamp (timestamp)   : timestamp of the image
+            reason='' (str)         : why the image was skipped ('' if it was queued)
+        '''
+        self.queued = reason == ''
+        if self.queued:
+            self.nb_queued += 1
+        else:
+            self.nb_skipped += 1
+        if self.frames_log is None:
+            return
+        self.frames_log.write('{0},{1},{2},{3},{4:.3f},{5},{6:g}\n'.format(
+            timestamp, i, 'skipped' if reason else 'queued', reason, self.fraction,
+            self.in_flight, self.quality))
+        self.frames_log.flush()
+
+    def close(self):
+        '''
+        Closes the frames log
+        '''
+        logger.info('{0} images queued, {1} skipped'.format(self.nb_queued, self.nb_skipped))
+        if self.frames_log is not None:
+            self.frames_log.close()
+            self.frames_log = None
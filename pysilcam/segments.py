@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+'''
+Segment container format for raw images
+
+Instead of one .silc file per image, the images are appended to large
+pre-allocated segment files (.silcseg), each holding frames_per_segment images
+of the same shape as one .npy array. Next to each segment, an index file
+(.silcidx) holds the timestamp of each image written (int64 nanoseconds since
+epoch). The index is only appended to once the image is written, so the number
+of timestamps in the index is the number of valid images in the segment.
+
+Segments are named after the timestamp of their first image, in the same way
+as .silc files, so their sorted names are in time order.
+
+The images are read as slices of a memory map of the segment, without copying.
+'''
+import os
+import bisect
+import logging
+import numpy as np
+import pandas as pd
+
+#Get module-level logger
+logger = logging.getLogger(__name__)
+
+SEGMENT_EXT = '.silcseg'
+INDEX_EXT = '.silcidx'
+
+
+def list_segments(path):
+    '''
+    Lists the segment files of a data folder, in time order
+
+    Args:
+        path (str)      : data folder
+
+    Returns:
+        files (list)    : sorted .silcseg files
+    '''
+    return [os.path.join(path, f)
+            for f in sorted(os.listdir(path))
+            if f.endswith(SEGMENT_EXT)]
+
+
+def index_filename(segment_file):
+    '''
+    Name of the timestamp index of a segment
+
+    Args:
+        segment_file (str)  : .silcseg filename
+
+    Returns:
+        index_file (str)    : .silcidx filename
+    '''
+    return os.path.splitext(segment_file)[0] + INDEX_EXT
+
+
+def read_segment(segment_file):
+    '''
+    Opens the valid images of a segment
+
+    Args:
+        segment_file (str)      : .silcseg filename
+
+    Returns:
+        timestamps (int64)      : timestamps of the images (nanoseconds since epoch)
+        frames (memmap)         : read-only memory map of the images, [images x height x width x 3]
+    '''
+    index_file = index_filename(segment_file)
+    timestamps = np.fromfile(index_file, dtype=np.int64) if os.path.isfile(index_file) else np.zeros(0, np.int64)
+    frames = np.load(segment_file, mmap_mode='r')
+    # an image that was not completely written has no timestamp yet
+    nb_frames = min(len(timestamps), frames.shape[0])
+    return timestamps[:nb_frames], frames[:nb_frames]
+
+
+class SegmentSet():
+    '''
+    All images in the segments of a data folder, in time order
+
+    Only the index files are read when the set is created. Images are memory-mapped
+    from their segment when they are accessed.
+
+    Usage:
+        segments = SegmentSet(datapath)
+        for i in range(len(segments)):
+            timestamp, img = segments[i]
+    '''
+    def __init__(self, path, offset=0):
+        '''
+        Args:
+            path (str)          : data folder
+            offset=0 (int)      : number of images skipped at the start
+        '''
+        self.segment_files = list_segments(path)
+        self.offset = offset
+
+        self.counts = []
+        timestamps = []
+        for segment_file in self.segment_files:
+            index_file = index_filename(segment_file)
+            if os.path.isfile(index_file):
+                timestamps.append(np.fromfile(index_file, dtype=np.int64))
+            else:
+                timestamps.append(np.zeros(0, np.int64))
+            self.counts.append(len(timestamps[-1]))
+        self.starts = np.concatenate(([0], np.cumsum(self.counts))).astype(np.int64)
+        self.timestamps = pd.to_datetime(np.concatenate(timestamps + [np.zeros(0, np.int64)])[offset:])
+
+        self._open = (None, None)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def _frames(self, segment):
+        '''
+        Memory map of the images of one segment, keeping the most recently used segment open
+        '''
+        if self._open[0] != segment:
+            self._open = (segment, np.load(self.segment_files[segment], mmap_mode='r'))
+        return self._open[1]
+
+    def __getitem__(self, i):
+        '''
+        Args:
+            i (int)                 : index of the image, after the offset
+
+        Returns:
+            timestamp (Timestamp)   : timestamp of the image
+            img (memmap)            : image, as a read-only view of the segment file
+        '''
+        if i < 0 or i >= len(self):
+            raise IndexError('Image {0} is not in the segments'.format(i))
+        j = i + self.offset
+        segment = bisect.bisect_right(self.starts, j) - 1
+        return self.timestamps[i], self._frames(segment)[j - self.starts[segment]]
+
+    def frames(self):
+        '''
+        Generator of the images, in time order
+
+        Yields:
+            timestamp (Timestamp)   : timestamp of the image
+            img (memmap)            : image, as a read-only view of the segment file
+        '''
+        for i in range(len(self)):
+            yield self[i]
+
+
+class SegmentWriter():
+    '''
+    Appends raw images to pre-allocated segment files
+
+    Usage:
+        writer = SegmentWriter(datapath)
+        for timestamp, img in aqgen:
+            writer.write(timestamp, img)
+        writer.close()
+    '''
+    def __init__(self, path, frames_per_segment=100, sync=True):
+        '''
+        Args:
+            path (str)                  : data folder
+            frames_per_segment=100 (int): number of images in each segment file
+            sync=True (bool)            : if True, each image is synced to disc and indexed as it is written.
+                                          Otherwise the images are synced and indexed by flush()
+        '''
+        self.path = path
+        self.frames_per_segment = frames_per_segment
+        self.sync = sync
+        self.frames = None
+        self.index = None
+        self.nb_frames = 0
+        self.segment_file = None
+        self.pending = []
+
+    def _new_segment(self, timestamp, img):
+        '''
+        Closes the current segment and pre-allocates the next one
+        '''
+        self.close()
+        name = pd.Timestamp(timestamp).strftime('D%Y%m%dT%H%M%S.%f')
+        self.segment_file = os.path.join(self.path, name + SEGMENT_EXT)
+        self.frames = np.lib.format.open_memmap(self.segment_file, mode='w+', dtype=img.dtype,
+                                                shape=(self.frames_per_segment,) + img.shape)
+        self.index = open(index_filename(self.segment_file), 'wb')
+        self.nb_frames = 0
+        logger.info('New segment {0}'.format(self.segment_file))
+
+    def write(self, timestamp, img):
+        '''
+        Appends an image to the current segment, starting a new segment when it is full
+
+        Args:
+            timestamp (timestamp)   : timestamp of the image
+            img (uint8)             : raw image
+        '''
+        if self.frames is None or self.nb_frames == self.frames_per_segment or \
+                self.frames.shape[1:] != img.shape:
+            self._new_segment(timestamp, img)
+
+        self.frames[self.nb_frames] = img
+        self.pending.append(pd.Timestamp(timestamp).value)
+        self.nb_frames += 1
+        if self.sync:
+            self.flush()
+
+    def flush(self):
+        '''
+        Syncs the images written to the current segment to disc, then indexes them
+        '''
+        if self.frames is None or len(self.pending) == 0:
+            return
+        self.frames.flush()
+
+        # the images are only indexed once they are written
+        self.index.write(np.array(self.pending, dtype=np.int64).tobytes())
+        self.index.flush()
+        os.fsync(self.index.fileno())
+        self.pending = []
+
+    def close(self):
+        '''
+        Indexes the remaining images and closes the current segment
+        '''
+        self.flush()
+        if self.frames is not None:
+            del self.frames
+            self.frames = None
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+
+
+def silc_to_segments(directory, outputpath=None, frames_per_segment=100):
+    '''
+    Converts a folder of .silc files to segment files
+
+    Args:
+        directory (str)                 : folder of .silc files
+        outputpath=None (str)           : folder for the segments (the same folder if None)
+        frames_per_segment=100 (int)    : number of images in each segment file
+
+    Returns:
+        nb_frames (int)                 : number of images converted
+    '''
+    if outputpath is None:
+        outputpath = directory
+    files = sorted([f for f in os.listdir(directory) if f.endswith('.silc')])
+
+    writer = SegmentWriter(outputpath, frames_per_segment=frames_per_segment, sync=False)
+    nb_frames = 0
+    for f in files:
+        try:
+            img = np.load(os.path.join(directory, f), allow_pickle=False)
+            timestamp = pd.to_datetime(os.path.splitext(f)[0][1:])
+        except Exception:
+            logger.warning('{0} failed!'.format(f))
+            continue
+        writer.write(timestamp, img)
+        nb_frames += 1
+    writer.close()
+
+    logger.info('{0} images converted to segments in {1}'.format(nb_frames, outputpath))
+    return nb_frames
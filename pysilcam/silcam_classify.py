@@ -10,11 +10,17 @@ import scipy
 import numpy as np
 import pandas as pd
 import os
+import multiprocessing
+import queue
+import logging
 
 '''
 SilCam TensorFlow analysis for classification of particle types
 '''
 
+#Get module-level logger
+logger = logging.getLogger(__name__)
+
 
 def get_class_labels(model_path='/mnt/ARRAY/classifier/model/particle-classifier.tfl'):
     '''
@@ -84,6 +90,21 @@ def load_model(model_path='/mnt/ARRAY/classifier/model/particle-classifier.tfl')
 
     return model, class_labels
 
+def prepare_roi(img):
+    '''
+    Scale a particle ROI to the input size of the tensorflow model
+
+    Args:
+        img (uint8)             : a particle ROI, corrected and treated with the silcam
+                                  explode_contrast function
+
+    Returns:
+        img (float32)           : the ROI scaled to 32x32 ready for prediction
+    '''
+    img = scipy.misc.imresize(img, (32, 32), interp="bicubic").astype(np.float32, casting='unsafe')
+    return img
+
+
 def predict(img, model):
     '''
     Use tensorflow model to classify particles
@@ -98,9 +119,145 @@ def predict(img, model):
     '''
 
     # Scale it to 32x32
-    img = scipy.misc.imresize(img, (32, 32), interp="bicubic").astype(np.float32, casting='unsafe')
+    img = prepare_roi(img)
 
     # Predict
     prediction = model.predict([img])
 
     return prediction
+
+
+def predict_batch(imgs, model, batch_size=256):
+    '''
+    Use tensorflow model to classify many particles in fixed-size batches
+
+    Args:
+        imgs (float32)          : array of particle ROIs of shape (n, 32, 32, 3), each
+                                  scaled using prepare_roi()
+        model (tf model object) : loaded tfl model from load_model()
+        batch_size=256 (int)    : maximum number of ROIs passed to the model in one call
+
+    Returns:
+        predictions (array)     : the probability of each roi belonging to each class,
+                                  shape (n, number of classes)
+    '''
+    predictions = []
+    for start in range(0, len(imgs), batch_size):
+        predictions.append(np.array(model.predict(imgs[start:start + batch_size])))
+
+    predictions = np.concatenate(predictions, axis=0)
+
+    return predictions
+
+
+class ClassifierServer(multiprocessing.Process):
+    '''
+    Process that owns the tensorflow model and classifies particle ROIs on behalf
+    of the processing workers
+
+    Requests from several workers (and therefore several frames) are gathered into
+    one batch before the model is called. Workers talk to the server through a
+    ClassifierClient obtained from get_client().
+    '''
+    def __init__(self, model_path, nb_clients, batch_size=256, max_wait=0.05):
+        '''
+        Setup the server
+
+        Args:
+            model_path (str)        : path to particle-classifier e.g.
+                                      '/mnt/ARRAY/classifier/model/particle-classifier.tfl'
+            nb_clients (int)        : number of workers that will send requests
+            batch_size=256 (int)    : number of ROIs to gather before running the model
+            max_wait=0.05 (float)   : maximum number of seconds to wait for more requests
+                                      before running the model on a partial batch
+        '''
+        super(ClassifierServer, self).__init__()
+        self.model_path = model_path
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.request_queue = multiprocessing.Queue()
+        self.response_queues = [multiprocessing.Queue() for i in range(nb_clients)]
+
+    def get_client(self, client_id):
+        '''
+        Create the model stand-in used by a processing worker
+
+        Args:
+            client_id (int)         : index of the worker, between 0 and nb_clients-1
+
+        Returns:
+            client (ClassifierClient) : object with a model-like predict() method
+        '''
+        return ClassifierClient(client_id, self.request_queue,
+                                self.response_queues[client_id])
+
+    def run(self):
+        '''
+        Load the model and serve classification requests until stop() is called
+        '''
+        sess = tf.Session()
+        model, class_labels = load_model(model_path=self.model_path)
+        logger.info('Classifier server ready')
+
+        running = True
+        while running:
+            requests = [self.request_queue.get()]
+            if requests[0] is None:
+                break
+
+            # gather requests from other workers until the batch is full
+            nb_rois = len(requests[0][1])
+            while nb_rois < self.batch_size:
+                try:
+                    request = self.request_queue.get(True, self.max_wait)
+                except queue.Empty:
+                    break
+                if request is None:
+                    running = False
+                    break
+                requests.append(request)
+                nb_rois += len(request[1])
+
+            predictions = predict_batch(np.concatenate([r[1] for r in requests]),
+                                        model, self.batch_size)
+
+            # send each worker the predictions for its own rois
+            start = 0
+            for client_id, imgs in requests:
+                self.response_queues[client_id].put(predictions[start:start + len(imgs)])
+                start += len(imgs)
+
+        sess.close()
+        logger.info('Classifier server stopped')
+
+    def stop(self):
+        '''
+        Stop the server once all workers have finished
+        '''
+        self.request_queue.put(None)
+        self.join()
+
+
+class ClassifierClient():
+    '''
+    Stand-in for the tensorflow model inside processing workers, which passes
+    the ROIs to a ClassifierServer and waits for the predictions
+    '''
+    def __init__(self, client_id, request_queue, response_queue):
+        self.client_id = client_id
+        self.request_queue = request_queue
+        self.response_queue = response_queue
+
+    def predict(self, imgs):
+        '''
+        Classify particle ROIs using the server
+
+        Args:
+            imgs (float32)          : array of particle ROIs of shape (n, 32, 32, 3), each
+                                      scaled using prepare_roi()
+
+        Returns:
+            predictions (array)     : the probability of each roi belonging to each class
+        '''
+        self.request_queue.put((self.client_id, np.asarray(imgs, dtype=np.float32)))
+        return self.response_queue.get()
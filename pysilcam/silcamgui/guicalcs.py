@@ -14,6 +14,7 @@ import pygame
 import time
 import psutil
 from tqdm import tqdm
+from pysilcam.fileindex import get_file_index
 import pysilcam.silcamgui.liveviewer as lv
 
 
@@ -25,14 +26,8 @@ def get_data(self):
     return rts
 
 def count_data(datadir):
-    silcfiles = [os.path.join(datadir, f) for f in
-            sorted(os.listdir(datadir))
-            if f.endswith('.silc')]
-    bmpfiles = [os.path.join(datadir, f) for f in
-            sorted(os.listdir(datadir))
-            if f.endswith('.bmp')]
-    silc = len(silcfiles)
-    bmp = len(bmpfiles)
+    silc = len(get_file_index(datadir, ('.silc',)))
+    bmp = len(get_file_index(datadir, ('.bmp',)))
     return silc, bmp
 
 def extract_stats_im(guidata):
@@ -47,75 +42,44 @@ def export_timeseries(configfile, statsfile):
     settings = PySilcamSettings(configfile)
 
     print('Loading STATS data: ', statsfile)
-    stats = pd.read_csv(statsfile)
+    stats = sc_pp.load_stats(statsfile)
 
     stats['timestamp'] = pd.to_datetime(stats['timestamp'])
 
     stats.sort_values(by='timestamp', inplace=True)
 
     print('Extracting oil and gas')
-    stats_oil = scog.extract_oil(stats)
-    stats_gas = scog.extract_gas(stats)
+    is_oil = scog.oil_mask(stats)
+    is_gas = scog.gas_mask(stats)
 
     print('Calculating timeseries')
-    u = pd.to_datetime(stats['timestamp']).unique()
-
     sample_volume = sc_pp.get_sample_volume(settings.PostProcess.pix_size, path_length=settings.PostProcess.path_length)
 
-    td = pd.to_timedelta('00:00:' + str(settings.PostProcess.window_size / 2.))
-
-    vdts_all = []
-    vdts_oil = []
-    vdts_gas = []
-    d50_all = []
-    d50_oil = []
-    d50_gas = []
-    timestamp = []
-    d50_av_all = []
-    d50_av_oil = []
-    d50_av_gas = []
-    gor = []
-    for s in tqdm(u):
-        timestamp.append(pd.to_datetime(s))
-        dt = pd.to_datetime(s)
-
-        dias, vd_all = sc_pp.vd_from_stats(stats[stats['timestamp'] == s],
-                                 settings.PostProcess)
-        dias, vd_oil = sc_pp.vd_from_stats(stats_oil[stats_oil['timestamp'] == s],
-                                 settings.PostProcess)
-        dias, vd_gas = sc_pp.vd_from_stats(stats_gas[stats_gas['timestamp'] == s],
-                                 settings.PostProcess)
-
-        nims = sc_pp.count_images_in_stats(stats[stats['timestamp'] == s])
-        sv = sample_volume * nims
-        vd_all /= sv
-        vd_oil /= sv
-        vd_gas /= sv
-        d50_all.append(sc_pp.d50_from_vd(vd_all, dias))
-        d50_oil.append(sc_pp.d50_from_vd(vd_oil, dias))
-        d50_gas.append(sc_pp.d50_from_vd(vd_gas, dias))
-
-        vdts_all.append(vd_all)
-        vdts_oil.append(vd_oil)
-        vdts_gas.append(vd_gas)
-
-        stats_av = stats[(stats['timestamp']<(dt+td)) & (stats['timestamp']>(dt-td))]
-        stats_av_oil = scog.extract_oil(stats_av)
-        stats_av_gas = scog.extract_gas(stats_av)
-        d50_av_all.append(sc_pp.d50_from_stats(stats_av, settings.PostProcess))
-        d50_av_oil.append(sc_pp.d50_from_stats(stats_av_oil, settings.PostProcess))
-        d50_av_gas.append(sc_pp.d50_from_stats(stats_av_gas, settings.PostProcess))
-
-        dias, vdts_av = sc_pp.vd_from_stats(stats_av, settings.PostProcess)
-        dias, vdts_av_oil = sc_pp.vd_from_stats(stats_av_oil, settings.PostProcess)
-        dias, vdts_av_gas = sc_pp.vd_from_stats(stats_av_gas, settings.PostProcess)
-        nims = sc_pp.count_images_in_stats(stats_av)
-        sv = sample_volume * nims
-        vdts_av /= sv
-        vdts_av_oil /= sv
-        vdts_av_gas /= sv
-
-        gor.append(np.sum(vdts_av_gas)/np.sum(vdts_av_oil))
+    # bin all particles at once into [images x size bins] matrices
+    timestamp, image_index, size_bin = sc_pp.particle_bins(stats, settings.PostProcess)
+    dias, bin_limits_um = sc_pp.get_size_bins()
+    nd_all = sc_pp.nd_timeseries(image_index, size_bin, len(timestamp))
+    nd_oil = sc_pp.nd_timeseries(image_index, size_bin, len(timestamp), is_oil)
+    nd_gas = sc_pp.nd_timeseries(image_index, size_bin, len(timestamp), is_gas)
+
+    vdts_all = sc_pp.vd_from_nd(nd_all, dias, sample_volume)
+    vdts_oil = sc_pp.vd_from_nd(nd_oil, dias, sample_volume)
+    vdts_gas = sc_pp.vd_from_nd(nd_gas, dias, sample_volume)
+    d50_all = sc_pp.d50_from_vd_matrix(vdts_all, dias)
+    d50_oil = sc_pp.d50_from_vd_matrix(vdts_oil, dias)
+    d50_gas = sc_pp.d50_from_vd_matrix(vdts_gas, dias)
+
+    # averages over the window around each image
+    window_size = settings.PostProcess.window_size
+    vdts_av, _ = sc_pp.rolling_vd(timestamp, nd_all, window_size, sample_volume)
+    vdts_av_oil, _ = sc_pp.rolling_vd(timestamp, nd_oil, window_size, sample_volume)
+    vdts_av_gas, _ = sc_pp.rolling_vd(timestamp, nd_gas, window_size, sample_volume)
+    d50_av_all = sc_pp.d50_from_vd_matrix(vdts_av, dias)
+    d50_av_oil = sc_pp.d50_from_vd_matrix(vdts_av_oil, dias)
+    d50_av_gas = sc_pp.d50_from_vd_matrix(vdts_av_gas, dias)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gor = np.sum(vdts_av_gas, axis=1) / np.sum(vdts_av_oil, axis=1)
 
     outpath, outfile = os.path.split(statsfile)
     outfile = outfile.replace('-STATS.csv','')
@@ -190,7 +154,7 @@ def export_timeseries(configfile, statsfile):
                  '-AVERAGE' + '' + '.xlsx')
 
     #average oil
-    dias, vd = sc_pp.vd_from_stats(stats_oil,
+    dias, vd = sc_pp.vd_from_stats(stats[is_oil],
                              settings.PostProcess)
     vd /= sv # sample volume remains the same as 'all'
     d50 = sc_pp.d50_from_vd(vd, dias)
@@ -202,7 +166,7 @@ def export_timeseries(configfile, statsfile):
                  '-AVERAGE' + 'oil' + '.xlsx')
 
     #average gas
-    dias, vd = sc_pp.vd_from_stats(stats_gas,
+    dias, vd = sc_pp.vd_from_stats(stats[is_gas],
                              settings.PostProcess)
     vd /= sv # sample volume remains the same as 'all'
     d50 = sc_pp.d50_from_vd(vd, dias)
@@ -235,9 +199,7 @@ def liveview(datadir, config_file):
 
 
 def silcview(datadir):
-    files = [os.path.join(datadir, f) for f in
-            sorted(os.listdir(datadir))
-            if f.endswith('.silc') or f.endswith('.bmp')]
+    files = get_file_index(datadir, ('.silc', '.bmp')).files()
     if len(files)==0:
         return
     pygame.init()
@@ -66,7 +66,7 @@ class stats_trim_dlg(QMainWindow):
 
         print('loading stats...')
         self.stats_filename = stats_filename
-        self.stats = pd.read_csv(stats_filename)
+        self.stats = scpp.load_stats(stats_filename)
         self.trimmed_stats = pd.DataFrame()
         print('  stats loaded.')
 
@@ -517,7 +517,7 @@ def main():
             if self.stats_filename == '':
                 self.status_update('Did not get STATS file')
                 return
-            stats = pd.read_csv(self.stats_filename)
+            stats = scpp.load_stats(self.stats_filename)
             stats.sort_values(by=['timestamp'], inplace=True)
 
             self.status_update('Exporting all data....')
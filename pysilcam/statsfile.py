@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+'''
+Binary particle statistics file (-STATS.h5), written alongside -STATS.csv
+
+The statistics are appended to an HDF5 table (pytables) with typed columns,
+and the timestamp stored as an indexed int64 column (nanoseconds since epoch),
+so that the statistics of a whole cruise can be loaded without parsing text.
+
+Use load_stats() from pysilcam.postprocess to read statistics, which falls
+back to the -STATS.csv file when there is no -STATS.h5 file.
+'''
+import os
+import logging
+import warnings
+import numpy as np
+import pandas as pd
+
+#Get module-level logger
+logger = logging.getLogger(__name__)
+
+# key of the statistics table inside the -STATS.h5 file
+STATS_KEY = 'stats'
+
+# number of characters reserved for the 'export name' column
+EXPORT_NAME_SIZE = 64
+
+
+def stats_h5_filename(stats_file):
+    '''
+    Name of the -STATS.h5 file that goes with a -STATS.csv file
+
+    Args:
+        stats_file (str)        : -STATS.csv or -STATS.h5 filename, or the datafilename prefix used by silcam process
+
+    Returns:
+        h5_file (str)           : -STATS.h5 filename
+    '''
+    if stats_file.endswith('-STATS.h5'):
+        return stats_file
+    if stats_file.endswith('-STATS.csv'):
+        return stats_file[:-len('-STATS.csv')] + '-STATS.h5'
+    return stats_file + '-STATS.h5'
+
+
+def to_stats_table(stats):
+    '''
+    Converts particle statistics to the typed columns of the -STATS.h5 table
+
+    Args:
+        stats (DataFrame)       : particle statistics, as returned by processImage() or loaded from a -STATS.csv file
+
+    Returns:
+        table (DataFrame)       : statistics with an int64 timestamp and a 'particle index' column
+    '''
+    table = pd.DataFrame(index=np.arange(len(stats)))
+
+    if 'particle index' not in stats.columns:
+        table['particle index'] = np.asarray(stats.index, dtype=np.int64)
+
+    # keep the column order of the -STATS.csv file
+    for c in stats.columns:
+        if c == 'particle index':
+            table[c] = stats[c].values.astype(np.int64)
+        elif c == 'timestamp':
+            timestamp = pd.to_datetime(stats[c]).values.astype('datetime64[ns]')
+            table[c] = timestamp.astype(np.int64)
+        elif c == 'export name':
+            table[c] = stats[c].fillna('').astype(str).values
+        else:
+            table[c] = pd.to_numeric(stats[c], errors='coerce').values.astype(np.float64)
+
+    return table
+
+
+def from_stats_table(table):
+    '''
+    Converts statistics read from the -STATS.h5 table back to the columns of a -STATS.csv file
+
+    Args:
+        table (DataFrame)       : statistics as stored in the -STATS.h5 file
+
+    Returns:
+        stats (DataFrame)       : particle statistics with a datetime64 timestamp
+    '''
+    stats = table.reset_index(drop=True)
+    stats['timestamp'] = pd.to_datetime(stats['timestamp'].values.astype(np.int64))
+    if 'export name' in stats.columns:
+        stats['export name'] = stats['export name'].replace('', np.nan)
+    return stats
+
+
+def time_query(start_time=None, end_time=None):
+    '''
+    Builds the pytables query selecting the rows with start_time < timestamp < end_time
+
+    Args:
+        start_time=None         : start of the time window (excluded), or None for no lower limit
+        end_time=None           : end of the time window (excluded), or None for no upper limit
+
+    Returns:
+        where (str)             : query for read_stats_h5 (None if there are no limits)
+    '''
+    conditions = []
+    if start_time is not None:
+        conditions.append('timestamp > {0}'.format(pd.Timestamp(start_time).value))
+    if end_time is not None:
+        conditions.append('timestamp < {0}'.format(pd.Timestamp(end_time).value))
+    if len(conditions) == 0:
+        return None
+    return ' & '.join(conditions)
+
+
+def read_stats_h5(h5_file, where=None):
+    '''
+    Reads particle statistics from a -STATS.h5 file
+
+    Only the rows matching the query are read from the file. Queries on the
+    timestamp use the index created by StatsFileWriter.close().
+
+    Args:
+        h5_file (str)           : -STATS.h5 filename
+        where=None (str)        : optional pytables query on the timestamp, e.g. from time_query()
+
+    Returns:
+        stats (DataFrame)       : particle statistics
+    '''
+    with pd.HDFStore(h5_file, mode='r') as store:
+        table = store.select(STATS_KEY, where=where)
+    return from_stats_table(table)
+
+
+def last_timestamp_h5(h5_file):
+    '''
+    Latest timestamp in a -STATS.h5 file, reading only the timestamp column
+
+    Args:
+        h5_file (str)           : -STATS.h5 filename
+
+    Returns:
+        timestamp (Timestamp)   : latest timestamp (NaT if the file is empty)
+    '''
+    with pd.HDFStore(h5_file, mode='r') as store:
+        timestamps = store.select_column(STATS_KEY, 'timestamp')
+    if len(timestamps) == 0:
+        return pd.NaT
+    return pd.Timestamp(int(np.max(timestamps.values.astype(np.int64))))
+
+
+def stats_h5_rows(h5_file):
+    '''
+    Number of rows in a -STATS.h5 file
+
+    Args:
+        h5_file (str)           : -STATS.h5 filename
+
+    Returns:
+        nrows (int)             : number of rows (0 if there is no file)
+    '''
+    if not os.path.isfile(h5_file):
+        return 0
+    with pd.HDFStore(h5_file, mode='r') as store:
+        if STATS_KEY not in store:
+            return 0
+        return store.get_storer(STATS_KEY).nrows
+
+
+def truncate_stats_h5(h5_file, nrows):
+    '''
+    Removes the rows written after the first nrows of a -STATS.h5 file
+
+    Args:
+        h5_file (str)           : -STATS.h5 filename
+        nrows (int)             : number of rows to keep
+    '''
+    with pd.HDFStore(h5_file, mode='a') as store:
+        store.get_storer(STATS_KEY).table.truncate(nrows)
+
+
+class StatsFileWriter():
+    '''
+    Appends particle statistics to a -STATS.h5 file, buffering several frames
+    per write so the table is written in large blocks
+
+    Usage:
+        writer = StatsFileWriter(datafilename)
+        for stats in ...:
+            writer.append(stats)
+        writer.close()
+    '''
+    def __init__(self, datafilename, frames_per_write=50):
+        '''
+        Args:
+            datafilename (str)      : filename prefix (as for -STATS.csv) or -STATS.h5 filename
+            frames_per_write=50     : number of frames buffered before they are written to the file
+        '''
+        self.filename = stats_h5_filename(datafilename)
+        self.frames_per_write = frames_per_write
+        self.buffer = []
+
+        # number of rows in the file, including those of a previous run that is appended to
+        self.nrows = stats_h5_rows(self.filename)
+
+    def append(self, stats):
+        '''
+        Adds the statistics of one frame, writing the buffer to the file when it is full
+
+        Args:
+            stats (DataFrame)       : stats dataframe returned from processImage()
+        '''
+        self.buffer.append(to_stats_table(stats))
+        if len(self.buffer) >= self.frames_per_write:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes the buffered frames to the file
+        '''
+        if len(self.buffer) == 0:
+            return
+        table = pd.concat(self.buffer, ignore_index=True)
+        self.buffer = []
+
+        min_itemsize = None
+        if 'export name' in table.columns:
+            min_itemsize = {'export name': EXPORT_NAME_SIZE}
+
+        # the index on timestamp is created when the writer is closed
+        with warnings.catch_warnings():
+            # pytables warns about the space in 'export name', which is harmless
+            warnings.simplefilter('ignore')
+            with pd.HDFStore(self.filename, mode='a') as store:
+                store.append(STATS_KEY, table, format='table', data_columns=['timestamp'],
+                             min_itemsize=min_itemsize, index=False)
+                self.nrows = store.get_storer(STATS_KEY).nrows
+
+    def close(self):
+        '''
+        Writes the remaining frames and indexes the timestamp column for fast time queries
+        '''
+        self.flush()
+        if not os.path.isfile(self.filename):
+            return
+        with pd.HDFStore(self.filename, mode='a') as store:
+            if STATS_KEY in store:
+                store.create_table_index(STATS_KEY, columns=['timestamp'], optlevel=9, kind='full')
@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+'''
+Writing of the particle statistics in a thread of its own, so that the
+acquisition loop never waits for the output files to be written.
+
+The statistics of each image are taken from the output queue of the
+processing (or put there by the serial processing loop), buffered, and
+written to the -STATS.csv and -STATS.h5 files in batches.
+
+Each time the -STATS.csv file is synced to disc, a checkpoint manifest
+(-CHECKPOINT.json) records the size of both files, so that an interrupted run
+can be resumed from that point without reading the stats back (see
+read_checkpoint()). The images are processed in parallel and finish out of
+order, so the manifest records the timestamp of the last image before which
+every image of the run is done (written, or without stats because it failed or
+was skipped), and the timestamps of the images done after it. A resumed run
+starts after the first, and skips the others.
+'''
+import os
+import json
+import time
+import queue
+import threading
+import logging
+import datetime
+import numpy as np
+import pandas as pd
+from pysilcam.statsfile import StatsFileWriter
+import pysilcam.metrics as scmet
+
+#Get module-level logger
+logger = logging.getLogger(__name__)
+
+
+def checkpoint_filename(datafilename):
+    '''
+    Name of the checkpoint manifest that goes with the -STATS.csv file of datafilename
+
+    Args:
+        datafilename (str)      : filename prefix of the -STATS.csv file
+
+    Returns:
+        filename (str)          : -CHECKPOINT.json filename
+    '''
+    return datafilename + '-CHECKPOINT.json'
+
+
+def read_checkpoint(datafilename):
+    '''
+    Reads the checkpoint manifest written by StatsWriter
+
+    Args:
+        datafilename (str)      : filename prefix of the -STATS.csv file
+
+    Returns:
+        checkpoint (dict)       : resume_timestamp (Timestamp, NaT if no image is done yet), done_after
+                                  (list of Timestamps), frames_written, stats_csv_bytes, stats_h5_rows
+                                  and finished, or None if there is no readable checkpoint
+    '''
+    filename = checkpoint_filename(datafilename)
+    if not os.path.isfile(filename):
+        return None
+    try:
+        with open(filename) as fh:
+            checkpoint = json.load(fh)
+        checkpoint['resume_timestamp'] = pd.Timestamp(checkpoint['resume_timestamp'])
+        checkpoint['done_after'] = [pd.Timestamp(t) for t in checkpoint['done_after']]
+    except (ValueError, KeyError):
+        logger.warning('Could not read checkpoint ' + filename)
+        return None
+    return checkpoint
+
+
+def write_checkpoint(datafilename, checkpoint):
+    '''
+    Writes the checkpoint manifest, replacing the previous one in a single step
+
+    Args:
+        datafilename (str)      : filename prefix of the -STATS.csv file
+        checkpoint (dict)       : content of the manifest (as returned by read_checkpoint())
+    '''
+    filename = checkpoint_filename(datafilename)
+    checkpoint = dict(checkpoint)
+    resume_timestamp = pd.Timestamp(checkpoint['resume_timestamp'])
+    checkpoint['resume_timestamp'] = None if pd.isnull(resume_timestamp) else resume_timestamp.isoformat()
+    checkpoint['done_after'] = [pd.Timestamp(t).isoformat() for t in checkpoint['done_after']]
+    with open(filename + '.tmp', 'w') as fh:
+        json.dump(checkpoint, fh, indent=2)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(filename + '.tmp', filename)
+
+
+class StatsWriter(threading.Thread):
+    '''
+    Thread writing the particle statistics of processed images to the output files
+
+    The statistics are written when frames_per_write images are buffered, or when
+    the oldest buffered image has waited max_delay seconds. The -STATS.csv file
+    is synced to disc every fsync_interval seconds, and the checkpoint manifest
+    updated.
+
+    Each item of the queue is a tuple (i, timestamp, stats) for the image of index i
+    of the run (counted from 0 in acquisition order), where stats is None if the image
+    gave no stats, e.g. because its processing failed or it was skipped. Every image
+    of the run must be put in the queue, so that the checkpoint can tell which
+    images are done.
+
+    Each producer (processing process or serial loop) must put None in the queue
+    once it has finished, and the thread stops when all producers have finished
+    and the queue is empty, or when stop() is called and the queue is empty.
+    If writing fails, the error is kept in error and the rest of the queue is
+    discarded, so the producers can still finish. The producers should check
+    error and stop putting images in the queue.
+
+    Usage:
+        writer = StatsWriter(datafilename, outputQueue, nb_producers)
+        writer.start()
+        ...
+        writer.join()
+    '''
+    def __init__(self, datafilename, stats_queue, nb_producers=1, on_stats=None,
+                 frames_per_write=50, max_delay=1., fsync_interval=10.):
+        '''
+        Args:
+            datafilename (str)          : filename prefix of the -STATS.csv and -STATS.h5 files
+            stats_queue (Queue)         : queue of (i, timestamp, stats) of each image, where stats is
+                                          the dataframe returned from processImage() or None
+            nb_producers=1 (int)        : number of None items that end the queue
+            on_stats=None (function)    : called with the stats of each image as soon as it is received,
+                                          e.g. to update the realtime stats
+            frames_per_write=50 (int)   : number of images buffered before they are written
+            max_delay=1. (float)        : maximum number of seconds an image is buffered before it is written
+            fsync_interval=10. (float)  : number of seconds between syncs of the -STATS.csv file to disc
+        '''
+        super(StatsWriter, self).__init__(name='StatsWriter')
+        self.daemon = True
+        self.datafilename = datafilename
+        self.csv_filename = datafilename + '-STATS.csv'
+        self.stats_queue = stats_queue
+        self.nb_producers = nb_producers
+        self.on_stats = on_stats
+        self.frames_per_write = frames_per_write
+        self.max_delay = max_delay
+        self.fsync_interval = fsync_interval
+        self.h5_writer = StatsFileWriter(datafilename, frames_per_write=frames_per_write)
+
+        self.buffer = []
+        self.oldest = None
+        self.last_fsync = time.time()
+        self.need_fsync = False
+        self.stopping = threading.Event()
+        self.error = None
+
+        # images of this run that are done, after the first one that is not
+        self.next_frame = 0
+        self.done = {}
+
+        # continue the checkpoint of the run that is appended to (if any)
+        checkpoint = read_checkpoint(datafilename)
+        self.resume_timestamp = pd.NaT
+        self.done_after = set()
+        self.previous_frames = 0
+        if checkpoint is not None:
+            self.resume_timestamp = checkpoint['resume_timestamp']
+            self.done_after = set(checkpoint['done_after'])
+            self.previous_frames = checkpoint['frames_written']
+
+        # metrics
+        self.frames_written = 0
+        self.writes = 0
+        self.write_time = 0.
+        self.last_write_time = np.nan
+        self.max_write_time = 0.
+
+    def run(self):
+        '''
+        Collects the stats from the queue and writes them until all producers have finished
+        '''
+        finished = 0
+        try:
+            while finished < self.nb_producers:
+                try:
+                    item = self.stats_queue.get(True, 0.1)
+                except queue.Empty:
+                    if self.stopping.is_set():
+                        break
+                    self._write_if_due()
+                    continue
+
+                if item is None:
+                    finished += 1
+                    continue
+                self._receive(item)
+
+            # the items of the other producers can arrive after the last None
+            while True:
+                try:
+                    item = self.stats_queue.get(True, 0.1)
+                except queue.Empty:
+                    break
+                if item is not None:
+                    self._receive(item)
+
+            self.write()
+            self.h5_writer.close()
+            self._fsync(finished=True)
+        except Exception as e:
+            logger.exception('Writing of the stats failed')
+            self.error = e
+            self._discard(finished)
+
+    def _discard(self, finished):
+        '''
+        Empties the queue until all producers have finished, after a write error,
+        so that the producers do not wait for room in the queue for ever
+
+        Args:
+            finished (int)      : number of producers that had finished when the error occurred
+        '''
+        while finished < self.nb_producers:
+            try:
+                item = self.stats_queue.get(True, 0.1)
+            except queue.Empty:
+                if self.stopping.is_set():
+                    break
+                continue
+            if item is None:
+                finished += 1
+
+    def _receive(self, item):
+        '''
+        Buffers the stats of an image taken from the queue, and writes the buffer if it is due
+
+        Args:
+            item (tuple)        : (i, timestamp, stats) of the image
+        '''
+        i, timestamp, stats = item
+        if stats is None:
+            # nothing to write for this image
+            self._frame_done(i, timestamp)
+            self._write_if_due()
+            return
+
+        if self.on_stats is not None:
+            self.on_stats(stats)
+        if len(self.buffer) == 0:
+            self.oldest = time.time()
+        self.buffer.append((i, timestamp, stats))
+        self._write_if_due()
+
+    def stop(self):
+        '''
+        Asks the thread to stop once the queue is empty, without waiting for all producers to finish
+        '''
+        self.stopping.set()
+
+    def _frame_done(self, i, timestamp):
+        '''
+        Marks an image of the run as done, and moves the resume point past the images done in sequence
+
+        Args:
+            i (int)                 : index of the image in the run
+            timestamp (timestamp)   : timestamp of the image
+        '''
+        self.done[i] = pd.Timestamp(timestamp)
+        while self.next_frame in self.done:
+            timestamp = self.done.pop(self.next_frame)
+            if pd.isnull(self.resume_timestamp) or timestamp > self.resume_timestamp:
+                self.resume_timestamp = timestamp
+            self.next_frame += 1
+
+    def _write_if_due(self):
+        '''
+        Writes the buffer if it is full or has waited long enough, and syncs the file if it is time to
+        '''
+        if len(self.buffer) >= self.frames_per_write or \
+                (len(self.buffer) > 0 and time.time() - self.oldest >= self.max_delay):
+            self.write()
+        if self.need_fsync and time.time() - self.last_fsync >= self.fsync_interval:
+            self._fsync()
+
+    def write(self):
+        '''
+        Writes the buffered stats to the -STATS.csv and -STATS.h5 files
+        '''
+        if len(self.buffer) == 0:
+            return
+        start = time.time()
+
+        # create or append particle statistics to output file
+        # if the output file does not already exist, create it
+        # otherwise data will be appended
+        # @todo accidentally appending to an existing file could be dangerous
+        # because data will be duplicated (and concentrations would therefore
+        # double) GUI promts user regarding this - directly-run functions are more dangerous.
+        with scmet.timer('csv_write'):
+            with open(self.csv_filename, 'a') as fh:
+                for i, timestamp, stats in self.buffer:
+                    if fh.tell() == 0:
+                        stats.to_csv(fh, index_label='particle index')
+                    else:
+                        stats.to_csv(fh, header=False)
+
+        with scmet.timer('stats_h5_write'):
+            for i, timestamp, stats in self.buffer:
+                self.h5_writer.append(stats)
+            self.h5_writer.flush()
+
+        for i, timestamp, stats in self.buffer:
+            self._frame_done(i, timestamp)
+
+        write_time = time.time() - start
+        self.frames_written += len(self.buffer)
+        self.writes += 1
+        self.write_time += write_time
+        self.last_write_time = write_time
+        self.max_write_time = max(self.max_write_time, write_time)
+        self.need_fsync = True
+        self.buffer = []
+        logger.debug('{0} images written in {1:.3f} s'.format(self.frames_written, write_time))
+
+        # the durations of the stats writer are recorded once per write
+        scmet.gauge('stats_queue_depth', self.queue_depth())
+        scmet.end_frame()
+
+    def _fsync(self, finished=False):
+        '''
+        Syncs the -STATS.csv file to disc and updates the checkpoint manifest
+
+        Args:
+            finished=False (bool)   : True when all stats of the run are written
+        '''
+        if (self.need_fsync or finished) and os.path.isfile(self.csv_filename):
+            with open(self.csv_filename, 'a') as fh:
+                os.fsync(fh.fileno())
+                csv_bytes = fh.tell()
+            # images done after the resume point, in this run or the one it continues
+            done_after = set(self.done.values()) | self.done_after
+            if not pd.isnull(self.resume_timestamp):
+                done_after = [t for t in done_after if t > self.resume_timestamp]
+            # the manifest is only updated once the data it refers to is on disc
+            write_checkpoint(self.datafilename,
+                             {'resume_timestamp': self.resume_timestamp,
+                              'done_after': sorted(done_after),
+                              'frames_written': int(self.previous_frames + self.frames_written),
+                              'stats_csv_bytes': int(csv_bytes),
+                              'stats_h5_rows': int(self.h5_writer.nrows),
+                              'finished': finished,
+                              'updated': datetime.datetime.now().isoformat()})
+        self.need_fsync = False
+        self.last_fsync = time.time()
+
+    def queue_depth(self):
+        '''
+        Returns:
+            depth (int)         : number of items waiting in the queue (-1 if the queue cannot tell)
+        '''
+        try:
+            return self.stats_queue.qsize()
+        except NotImplementedError:
+            return -1
+
+    def metrics(self):
+        '''
+        Returns:
+            metrics (dict)      : queue depth, number of images buffered and written, and write latencies in seconds
+        '''
+        return {'queue_depth': self.queue_depth(),
+                'buffered': len(self.buffer),
+                'frames_written': self.frames_written,
+                'writes': self.writes,
+                'last_write_time': self.last_write_time,
+                'mean_write_time': self.write_time / self.writes if self.writes > 0 else np.nan,
+                'max_write_time': self.max_write_time}
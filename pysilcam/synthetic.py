@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+'''
+Synthetic SilCam images of particles with a chosen size distribution and
+concentration, for load testing of the processing without a camera.
+
+As in pysilcam/tests/synthesizer.py, the particles are drawn as non-transmitting
+(black) discs on a bright background, with sizes from a Weibull volume
+distribution similar to Oystein's MPB 2013 paper, and noise is added.
+'''
+import logging
+import numpy as np
+import pysilcam.postprocess as scpp
+
+#Get module-level logger
+logger = logging.getLogger(__name__)
+
+# image dimensions of the GC2450 camera
+IMX = 2448
+IMY = 2048
+
+
+def weibull(x, n=250, a=2.8):
+    '''weibull distribution similar to Oystein's MPB 2013 paper'''
+    n *= 1.566
+    return (a / n) * (x / n)**(a - 1) * np.exp(-(x / n)**a)
+
+
+def disc(radius):
+    '''
+    Mask of a filled disc
+
+    Args:
+        radius (float)      : radius of the disc [pixels]
+
+    Returns:
+        mask (bool)         : square mask of odd size, with the disc centred on the middle pixel
+    '''
+    r = int(np.ceil(radius))
+    rr, cc = np.ogrid[-r:r + 1, -r:r + 1]
+    return rr**2 + cc**2 < radius**2
+
+
+def draw_mask(img, mask, row, col, value=0):
+    '''
+    Sets the pixels of a mask centred on (row, col) in an image, in place,
+    leaving out the part of the mask outside the image
+
+    Args:
+        img (array)         : 2D image
+        mask (bool)         : square mask of odd size, as returned by disc()
+        row, col (int)      : centre of the mask in the image [pixels]
+        value=0             : value of the pixels in the mask
+    '''
+    r = mask.shape[0] // 2
+    r0, r1 = max(row - r, 0), min(row + r + 1, img.shape[0])
+    c0, c1 = max(col - r, 0), min(col + r + 1, img.shape[1])
+    img[r0:r1, c0:c1][mask[r0 - row + r:r1 - row + r, c0 - col + r:c1 - col + r]] = value
+
+
+class SyntheticImages():
+    '''
+    Renders synthetic images of particles
+
+    The number of particles of each size bin in an image is drawn from a Poisson
+    distribution around the number expected in the sample volume.
+
+    Usage:
+        synthetic = SyntheticImages(d50=400, concentration=800)
+        img, ecd = synthetic.image()
+    '''
+    def __init__(self, d50=400, concentration=800, pix_size=28.758169934640524,
+                 path_length=40, imx=IMX, imy=IMY, min_d=108, noise=0.01):
+        '''
+        Args:
+            d50=400 (float)             : d50 of the volume distribution [um]
+            concentration=800 (float)   : total volume concentration [uL/L]
+            pix_size=28.758 (float)     : pixel size of the setup [um]
+            path_length=40 (float)      : path length of the setup [mm]
+            imx=IMX (int)               : image width in pixels
+            imy=IMY (int)               : image height in pixels
+            min_d=108 (float)           : particles smaller than this diameter are left out, for speed [um]
+            noise=0.01 (float)          : standard deviation of the noise, relative to full scale
+        '''
+        self.pix_size = pix_size
+        self.imx = imx
+        self.imy = imy
+
+        # get diameters and limits of size bins
+        self.diams, self.bin_limits_um = scpp.get_size_bins()
+
+        # volume distribution, scaled to the concentration
+        vd = weibull(self.diams, n=d50)
+        vd = vd / np.sum(vd) * concentration
+
+        droplet_volume = ((4 / 3) * np.pi * ((self.diams * 1e-6) / 2)**3)  # the volume of each droplet in m3
+        nd = vd / (droplet_volume * 1e9)  # the number distribution in each bin
+        nd[self.diams < min_d] = 0
+
+        # expected number of particles of each bin in the sample volume of an image
+        self.sv = scpp.get_sample_volume(pix_size, path_length=path_length, imx=imx, imy=imy)
+        self.nd = nd * self.sv
+        logger.debug('Synthetic images of {0:.0f} particles on average'.format(np.sum(self.nd)))
+
+        # the particles of a size bin all have the same size, so their discs are only computed once
+        self.discs = [disc(d / 2 / pix_size) for d in self.diams]
+
+        # the noise is drawn once and shifted for each image, as drawing it takes longer than the image
+        self.noise = np.int16(np.round(np.random.normal(0, noise * 255, (imy, imx))))
+
+    def image(self):
+        '''
+        Renders an image
+
+        Returns:
+            img (uint8)         : image [imy x imx x 3]
+            ecd (array)         : diameters of the particles drawn [um]
+        '''
+        counts = np.random.poisson(self.nd)
+        img = np.zeros((self.imy, self.imx), dtype=np.int16) + 230  # scale the initial brightness down a bit
+        for size_bin in np.flatnonzero(counts):
+            # randomly decide where to put particles within the image
+            for row, col in zip(np.random.randint(0, self.imy, counts[size_bin]),
+                                np.random.randint(0, self.imx, counts[size_bin])):
+                draw_mask(img, self.discs[size_bin], row, col)
+
+        img += np.roll(self.noise, (np.random.randint(self.imy), np.random.randint(self.imx)), axis=(0, 1))
+        img = np.uint8(np.clip(img, 0, 255))
+        ecd = np.repeat(self.diams, counts)
+        return np.repeat(img[:, :, np.newaxis], 3, axis=2), ecd
@@ -9,6 +9,7 @@ import pysilcam.postprocess as scpp
 import pysilcam.process as scpr
 import pysilcam.config as sccf
 import pysilcam.silcam_classify as sccl
+from pysilcam.synthetic import weibull
 
 def generate_report(report_name, PIX_SIZE = 28.758169934640524,
                     PATH_LENGTH=40, d50 = 400, TotalVolumeConcentration = 800,
@@ -157,12 +158,6 @@ def generate_report(report_name, PIX_SIZE = 28.758169934640524,
 
     pp.close()
 
-def weibull(x,n=250,a=2.8):
-    '''weibull distribution similar to Oystein's MPB 2013 paper'''
-    n *= 1.566
-    return (a / n) * (x / n)**(a - 1) * np.exp(-(x / n)**a)
-
-
 def synthesize(diams, bin_limits_um, nd, imx, imy, PIX_SIZE):
     '''synthesize an image and measure droplets
 
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 import numpy as np
 from pysilcam.acquisition import Acquire
-from pysilcam.background import backgrounder
+from pysilcam.background import backgrounder, BackgroundStack, correct_im_accurate
 
 
 def test_background_aquire():
@@ -32,3 +32,96 @@ def test_background_aquire():
         #Try five frames, then break
         if i>5:
             break
+
+
+def test_background_stack():
+    '''Testing the running-mean background against the mean of the stack'''
+    av_window = 5
+    background = BackgroundStack(av_window)
+    images = [np.random.randint(0, 256, (10, 12, 3)).astype(np.uint8) for i in range(12)]
+
+    for i, img in enumerate(images):
+        background.push(img)
+
+        #Check that the background is the exact mean of the most recent images
+        stack = images[max(0, i + 1 - av_window):i + 1]
+        assert np.array_equal(background.mean(), np.mean(stack, axis=0))
+        assert background.is_full() == (i + 1 >= av_window)
+
+
+def test_correct_im_accurate():
+    '''Testing the histogram-median correction against the float percentile reference'''
+    base = np.random.normal(180, 20, (64, 80, 3))
+    imbg = np.mean([np.clip(base + np.random.normal(0, 6, base.shape), 0, 255).astype(np.uint8)
+                    for i in range(15)], axis=0)
+    imraw = np.clip(base + np.random.normal(0, 6, base.shape), 0, 255).astype(np.uint8)
+    imraw[:10, :10, :] = 5
+
+    for bg in [imbg, np.uint8(imbg)]:
+        imc = np.float64(imraw) - np.float64(bg)
+        for c in range(3):
+            imc[:,:,c] += (255/2 - np.percentile(imc[:,:,c], 50))
+        imc += 255 - imc.max()
+        imc = np.uint8(np.clip(imc, 0, 255))
+
+        #Check that the output is unchanged, also on re-used work buffers
+        assert np.array_equal(correct_im_accurate(bg, imraw), imc)
+        assert np.array_equal(correct_im_accurate(bg, imraw), imc)
+
+
+def test_background_snapshot():
+    '''Testing that a session restarted from a background snapshot gives the same corrected images'''
+    import os
+    import tempfile
+    import pandas as pd
+
+    start = pd.Timestamp('2018-01-01 10:00:00')
+    frames = [(start + pd.Timedelta(seconds=i), np.random.randint(0, 256, (20, 24, 3)).astype(np.uint8))
+              for i in range(20)]
+    reference = [imc for timestamp, imc, imraw in backgrounder(5, iter(frames))]
+
+    with tempfile.TemporaryDirectory() as path:
+        snapshot_file = os.path.join(path, 'test-BACKGROUND')
+
+        #Process the first frames, taking a snapshot after each frame
+        for timestamp, imc, imraw in backgrounder(5, iter(frames[:12]), snapshot_file=snapshot_file,
+                                                  snapshot_interval=0):
+            pass
+
+        background, timestamp = BackgroundStack.load(snapshot_file)
+        assert timestamp == frames[11][0]
+        assert np.array_equal(background.mean(), np.mean([f[1] for f in frames[7:12]], axis=0))
+
+        #The restarted session carries on without a new background stack
+        restarted = [imc for timestamp, imc, imraw in backgrounder(5, iter(frames[12:]),
+                                                                   snapshot_file=snapshot_file)]
+        assert len(restarted) == 8
+        for imc, imc_ref in zip(restarted, reference[7:]):
+            assert np.array_equal(imc, imc_ref)
+
+        #Images too long after the snapshot need a new background stack
+        late = [(timestamp + pd.Timedelta(minutes=10), imraw) for timestamp, imraw in frames[12:]]
+        assert len(list(backgrounder(5, iter(late), snapshot_file=snapshot_file))) == 3
+
+
+def test_mono_backgrounder():
+    '''Testing that a mono pipeline corrects the minimum channel of the raw images'''
+    import pandas as pd
+    from pysilcam.background import to_mono
+
+    start = pd.Timestamp('2018-01-01 10:00:00')
+    frames = [(start + pd.Timedelta(seconds=i), np.random.randint(0, 256, (20, 24, 3)).astype(np.uint8))
+              for i in range(10)]
+    mono_frames = [(timestamp, np.min(imraw, axis=2)) for timestamp, imraw in frames]
+
+    for real_time_stats in [False, True]:
+        mono = list(backgrounder(5, iter(frames), real_time_stats=real_time_stats, mono_channel='min'))
+        reference = list(backgrounder(5, iter(mono_frames), real_time_stats=real_time_stats))
+        assert len(mono) == 5
+        for (timestamp, imc, imraw), (timestamp_ref, imc_ref, imraw_ref) in zip(mono, reference):
+            #Check that the corrected image is single-channel, and the raw image is still in colour
+            assert imc.shape == (20, 24)
+            assert np.array_equal(imc, imc_ref)
+            assert imraw.shape == (20, 24, 3)
+
+    assert np.array_equal(to_mono(frames[0][1], 1), frames[0][1][:, :, 1])
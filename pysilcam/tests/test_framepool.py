@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import numpy as np
+from pysilcam.framepool import FramePool
+
+
+def _invert_frame(frame_pool, slot, outputQueue):
+    '''Read an image from the pool in another process and send back its inverse'''
+    outputQueue.put(255 - frame_pool.frame(slot))
+    frame_pool.release(slot)
+
+
+def test_frame_pool():
+    '''Testing transport of images through the shared frame pool'''
+    shape = (20, 30, 3)
+    frame_pool = FramePool(2, shape)
+
+    img = np.random.randint(0, 255, shape).astype(np.uint8)
+    slot = frame_pool.put(img)
+
+    #Check that the stored image is identical to the input
+    assert np.array_equal(frame_pool.frame(slot), img)
+
+    #Check that a full pool does not accept more images
+    other_slot = frame_pool.put(img)
+    assert other_slot != slot
+    assert frame_pool.put(img, timeout=0.1) is None
+    frame_pool.release(other_slot)
+
+    #Check that the image can be read by a worker process
+    outputQueue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_invert_frame, args=(frame_pool, slot, outputQueue))
+    proc.start()
+    assert np.array_equal(outputQueue.get(), 255 - img)
+    proc.join()
+
+    #Check that the worker released the slot
+    assert frame_pool.put(img, timeout=1) is not None
+
+
+def test_frame_pool_raw():
+    '''Testing that a slot holds a raw image next to a single-channel image'''
+    frame_pool = FramePool(2, (20, 30), raw_shape=(20, 30, 3))
+
+    imraw = np.random.randint(0, 255, (20, 30, 3)).astype(np.uint8)
+    slot = frame_pool.put(np.min(imraw, axis=2), imraw=imraw)
+
+    assert np.array_equal(frame_pool.frame(slot), np.min(imraw, axis=2))
+    assert np.array_equal(frame_pool.raw(slot), imraw)
+    assert frame_pool.in_use() == 1
+    frame_pool.release(slot)
+    assert frame_pool.in_use() == 0
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import tempfile
+import pandas as pd
+from pysilcam.metrics import Metrics, Histogram
+
+
+def test_histogram():
+    '''Testing the counts and quantile estimates of the histogram'''
+    histogram = Histogram(buckets=[0.1, 1, 10])
+    for value in [0.05, 0.5, 0.5, 5, 50]:
+        histogram.observe(value)
+
+    assert histogram.counts == [1, 2, 1, 1]
+    assert histogram.count == 5
+    assert histogram.sum == 56.05
+    assert histogram.quantile(0.5) == 1
+    assert histogram.quantile(1) == 50
+
+
+def test_metrics_export():
+    '''Testing that stage durations are recorded once per image and exported'''
+    metrics = Metrics(process='test')
+
+    for i in range(3):
+        #A stage timed in two places counts once per image
+        with metrics.timer('measure'):
+            time.sleep(0.001)
+        with metrics.timer('measure'):
+            time.sleep(0.001)
+        metrics.add('classify', 0.5)
+        metrics.end_frame()
+    metrics.gauge('input_queue_depth', 4)
+    metrics.count('frames_dropped')
+
+    assert metrics.histograms['measure'].count == 3
+    assert metrics.histograms['measure'].sum >= 0.006
+    assert metrics.histograms['classify'].sum == 1.5
+
+    with tempfile.TemporaryDirectory() as path:
+        prefix = os.path.join(path, 'metrics')
+
+        metrics.configure(prefix, fmt='prometheus')
+        metrics.export()
+        with open(prefix + '-test.prom') as fh:
+            lines = fh.read().splitlines()
+        assert 'pysilcam_stage_duration_seconds_count{process="test",stage="measure"} 3' in lines
+        assert 'pysilcam_stage_duration_seconds_bucket{process="test",stage="classify",le="+Inf"} 3' in lines
+        assert 'pysilcam_input_queue_depth{process="test"} 4' in lines
+        assert 'pysilcam_frames_dropped_total{process="test"} 1' in lines
+
+        metrics.configure(prefix, fmt='csv')
+        metrics.export()
+        metrics.export()
+        csv = pd.read_csv(prefix + '-test.csv')
+        assert len(csv) == 2 * 4
+        classify = csv[csv['metric'] == 'classify'].iloc[-1]
+        assert classify['count'] == 3
+        assert classify['mean'] == 0.5
+        assert csv[csv['metric'] == 'input_queue_depth']['value'].iloc[-1] == 4
@@ -102,3 +102,263 @@ def test_output_files():
     #synth.generate_report(os.path.join(reportdir, 'imagesynth_report.pdf'), PIX_SIZE=28.758169934640524,
     #                      PATH_LENGTH=10, d50=800, TotalVolumeConcentration=800,
     #                      MinD=108)
+
+
+def test_fast_clahe_segmentation():
+    '''Testing that the fast accurate segmentation agrees with the skimage-based one'''
+    from pysilcam.process import image2blackwhite_accurate, histogram_percentile
+    import numpy as np
+
+    np.random.seed(0)
+    yy, xx = np.mgrid[0:512, 0:612]
+    img = 200 + 20 * np.sin(xx / 100) + 10 * np.cos(yy / 75) + np.random.normal(0, 4, xx.shape)
+    for i in range(50):
+        y, x, r = np.random.randint(0, 512), np.random.randint(0, 612), np.random.randint(2, 15)
+        img[max(y - r, 0):y + r, max(x - r, 0):x + r] -= np.random.randint(40, 160)
+    img = np.uint8(np.clip(img, 0, 255))
+
+    #Check the histogram percentiles against np.percentile
+    hist = np.bincount(img.ravel(), minlength=256)
+    for q in [0, 0.75, 50, 100]:
+        assert np.isclose(histogram_percentile(hist, q), np.percentile(img, q))
+
+    imbw = image2blackwhite_accurate(img, 0.85)
+    imbw_fast = image2blackwhite_accurate(img, 0.85, fast_clahe=True)
+
+    #Check that the binary masks agree
+    assert np.mean(imbw == imbw_fast) > 0.99
+    assert np.sum(imbw & imbw_fast) / np.sum(imbw | imbw_fast) > 0.9
+
+
+def test_particle_properties():
+    '''Testing the vectorised particle measurements against regionprops'''
+    from pysilcam.process import clean_bw, segment_particles, particle_properties, particle_solidity
+    from scipy import ndimage as ndi
+    from skimage import measure, morphology
+    import numpy as np
+
+    imbw = np.zeros((200, 300), dtype=bool)
+    yy, xx = np.mgrid[0:200, 0:300]
+    for y, x, r, a in [(50, 50, 10, 20), (120, 200, 15, 6), (150, 60, 8, 8), (100, 120, 3, 3), (60, 220, 12, 30)]:
+        imbw |= ((yy - y) / r) ** 2 + ((xx - x) / a) ** 2 <= 1
+    imbw[45:55, 45:55] = False # hole
+    imbw[0:10, 100:130] = True # touching the border
+    imbw[180:182, 150:152] = True # too small
+    ring = np.hypot(yy - 35, xx - 150)
+    imbw |= (ring >= 30) & (ring <= 35) # ring touching the border
+    imbw |= ring <= 6 # particle inside the ring
+
+    iml, imbw_clean = segment_particles(imbw, 12)
+    props = particle_properties(iml)
+
+    #Check against the cleaning and labelling steps used previously
+    imbw_ref = ndi.binary_fill_holes(clean_bw(imbw, 12))
+    assert np.array_equal(imbw_clean, imbw_ref)
+    assert np.array_equal(iml, morphology.label(imbw_ref))
+
+    region_properties = measure.regionprops(iml)
+    assert len(region_properties) == len(props['area']) == 6
+    for i, el in enumerate(region_properties):
+        assert np.allclose(props['major_axis_length'][i], el.major_axis_length)
+        assert np.allclose(props['minor_axis_length'][i], el.minor_axis_length)
+        assert np.allclose(props['equivalent_diameter'][i], el.equivalent_diameter)
+        assert np.array_equal(props['bbox'][i], el.bbox)
+        assert np.allclose(particle_solidity(iml, i + 1, props['bbox'][i], props['area'][i]), el.solidity)
+
+
+def test_vd_timeseries():
+    '''Testing the binned time-series against the volume distribution of each image'''
+    from pysilcam.postprocess import (particle_bins, nd_timeseries, d50_from_vd_matrix, vd_from_nd,
+                                      vd_from_stats, d50_from_vd, get_size_bins)
+    from collections import namedtuple
+    import numpy as np
+
+    settings = namedtuple('PostProcess', ['pix_size', 'path_length'])(28., 40)
+    nb_particles = 2000
+    stats = pd.DataFrame({'equivalent_diameter': np.exp(np.random.rand(nb_particles) * 7)})
+    stats.loc[::50, 'equivalent_diameter'] = np.nan
+    stats['timestamp'] = pd.Timestamp('2018-01-01') + pd.to_timedelta(
+            np.random.randint(0, 100, nb_particles), unit='s')
+    selection = np.random.rand(nb_particles) > 0.5
+
+    timestamps, image_index, size_bin = particle_bins(stats, settings)
+    dias, bin_limits_um = get_size_bins()
+    vd = vd_from_nd(nd_timeseries(image_index, size_bin, len(timestamps)), dias)
+    vd_selected = vd_from_nd(nd_timeseries(image_index, size_bin, len(timestamps), selection), dias)
+    d50 = d50_from_vd_matrix(vd, dias)
+
+    assert np.array_equal(timestamps, pd.to_datetime(stats['timestamp'].unique()))
+    assert vd.shape == (len(timestamps), len(dias))
+    for i, t in enumerate(timestamps):
+        ind = stats['timestamp'] == t
+        assert np.array_equal(vd[i], vd_from_stats(stats[ind], settings)[1])
+        assert np.array_equal(vd_selected[i], vd_from_stats(stats[ind & selection], settings)[1])
+        assert d50[i] == d50_from_vd(vd[i], dias)
+
+
+def test_rolling_vd():
+    '''Testing the rolling-window volume distribution and number concentration against filtering the stats of each window'''
+    from pysilcam.postprocess import (particle_bins, nd_timeseries, rolling_vd, vd_from_stats, nd_from_stats,
+                                      nc_from_nd, get_sample_volume, count_images_in_stats)
+    from collections import namedtuple
+    import numpy as np
+
+    settings = namedtuple('PostProcess', ['pix_size', 'path_length', 'window_size'])(28., 40, 10)
+    nb_particles = 2000
+    stats = pd.DataFrame({'equivalent_diameter': np.exp(np.random.rand(nb_particles) * 7)})
+    stats['timestamp'] = pd.Timestamp('2018-01-01') + pd.to_timedelta(
+            np.random.randint(0, 200, nb_particles), unit='s')
+    sample_volume = get_sample_volume(settings.pix_size, path_length=settings.path_length)
+
+    timestamps, image_index, size_bin = particle_bins(stats, settings)
+    necd = nd_timeseries(image_index, size_bin, len(timestamps))
+    vd, nc = rolling_vd(timestamps, necd, settings.window_size, sample_volume)
+
+    td = pd.to_timedelta('00:00:' + str(settings.window_size / 2.))
+    for i, t in enumerate(timestamps):
+        stats_av = stats[(stats['timestamp'] > (t - td)) & (stats['timestamp'] < (t + td))]
+        nims = count_images_in_stats(stats_av)
+        vd_av = vd_from_stats(stats_av, settings)[1] / (sample_volume * nims)
+        assert np.allclose(vd[i], vd_av)
+        nc_av = nc_from_nd(nd_from_stats(stats_av, settings)[1], sample_volume * nims)
+        assert np.isclose(nc[i], nc_av)
+
+
+def test_rt_stats():
+    '''Testing the realtime stats against the stats of the last window_size seconds'''
+    from pysilcam.oilgas import rt_stats, extract_oil, extract_gas
+    from pysilcam.postprocess import vd_from_stats, extract_latest_stats, get_sample_volume
+    from collections import namedtuple
+    import numpy as np
+
+    settings = namedtuple('Settings', ['PostProcess'])(
+            namedtuple('PostProcess', ['pix_size', 'path_length', 'window_size'])(28., 40, 10))
+    rts = rt_stats(settings)
+    sample_volume = get_sample_volume(settings.PostProcess.pix_size, path_length=settings.PostProcess.path_length)
+    all_stats = []
+    for i in range(60):
+        nb_particles = np.random.randint(1, 50)
+        stats = pd.DataFrame(np.random.rand(nb_particles, 4),
+                             columns=['minor_axis_length', 'probability_oil', 'probability_bubble',
+                                      'probability_oily_gas'])
+        stats['major_axis_length'] = 1
+        stats['solidity'] = 1
+        stats['equivalent_diameter'] = np.exp(np.random.rand(nb_particles) * 7)
+        # images processed in parallel do not always arrive in order
+        stats['timestamp'] = pd.Timestamp('2018-01-01') + pd.Timedelta(seconds=i + 2 * (i % 3 == 0))
+        stats['saturation'] = np.random.rand() * 100
+        rts.update(stats)
+
+        all_stats.append(stats)
+        window = extract_latest_stats(pd.concat(all_stats), settings.PostProcess.window_size)
+        # the concentrations are per volume of the images analysed in the window
+        nims = sum(s['timestamp'].iloc[0] >= window['timestamp'].min() for s in all_stats)
+        assert rts.nims == nims
+        assert np.allclose(rts.vd_oil, vd_from_stats(extract_oil(window), settings.PostProcess)[1] /
+                           (sample_volume * nims))
+        assert np.allclose(rts.vd_gas, vd_from_stats(extract_gas(window), settings.PostProcess)[1] /
+                           (sample_volume * nims))
+        assert rts.saturation == window['saturation'].max()
+
+
+def test_chunk_ranges():
+    '''Testing that the chunks cover every processed image once, each with its background images'''
+    from pysilcam.__main__ import chunk_ranges
+
+    assert chunk_ranges(10, 10, 4) == []
+    for nb_files, nb_background, nb_chunks in [(100, 15, 8), (17, 5, 3), (16, 15, 4), (1000, 1, 7)]:
+        chunks = chunk_ranges(nb_files, nb_background, nb_chunks)
+        assert 1 <= len(chunks) <= nb_chunks
+        processed = []
+        for start, first_image, end in chunks:
+            assert first_image - start == nb_background
+            assert end > first_image
+            processed.extend(range(first_image, end))
+        assert processed == list(range(nb_background, nb_files))
+
+
+def test_is_processed():
+    '''Testing that a resumed run skips the images already done, also those read again for the background'''
+    from pysilcam.__main__ import is_processed
+    import pandas as pd
+    import datetime
+
+    start = pd.Timestamp('2018-01-01 10:00:00')
+    times = [start + pd.Timedelta(seconds=i) for i in range(6)]
+    resume = (times[2], {times[4]})
+    assert [is_processed(t, *resume) for t in times] == [True, True, True, False, True, False]
+    assert is_processed(datetime.datetime(2018, 1, 1, 10, 0, 4), *resume)
+
+    #Nothing is skipped when the stats are not appended to
+    assert not any(is_processed(t, pd.NaT, set()) for t in times)
+
+
+def test_synthetic_images():
+    '''Testing that synthetic images hold the particles drawn'''
+    from pysilcam.synthetic import SyntheticImages
+    import numpy as np
+
+    np.random.seed(0)
+    synthetic = SyntheticImages(d50=400, concentration=800, noise=0)
+    img, ecd = synthetic.image()
+    assert img.shape == (synthetic.imy, synthetic.imx, 3)
+    assert img.dtype == np.uint8
+    assert len(ecd) > 0
+
+    #The particles are black on a bright background, and may overlap
+    particle_area = np.sum(np.pi * (ecd / 2 / synthetic.pix_size)**2)
+    dark_area = np.sum(img[:, :, 0] == 0)
+    assert 0.5 * particle_area < dark_area < 1.1 * particle_area
+    assert np.all(img[img[:, :, 0] > 0] == 230)
+
+
+def test_mono_rois():
+    '''Testing that a mono pipeline measures the same particles, with rois cut from the uncorrected raw image'''
+    from pysilcam.process import statextract, extract_roi
+    from pysilcam.config import default_config_path
+    import numpy as np
+    import tempfile
+    import h5py
+
+    class Model():
+        def predict(self, imgs):
+            return np.ones((len(imgs), 4)) / 4
+
+    #A tinted raw image, corrected to a grey image holding the same dark particles
+    yy, xx = np.mgrid[0:300, 0:400]
+    particles = np.zeros((300, 400), dtype=bool)
+    for y, x, r in [(80, 100, 25), (150, 250, 30), (220, 120, 20)]:
+        particles |= (yy - y) ** 2 + (xx - x) ** 2 <= r ** 2
+    imraw = np.zeros((300, 400, 3), dtype=np.uint8)
+    imraw[:] = [200, 160, 120]
+    imraw[particles] = 0
+    imc = np.full((300, 400, 3), 230, dtype=np.uint8)
+    imc[particles] = 0
+
+    settings = PySilcamSettings(default_config_path())
+    timestamp = pd.Timestamp('2018-01-01 10:00:00')
+    class_labels = ['oil', 'other', 'bubble', 'oily_gas']
+    with tempfile.TemporaryDirectory() as path:
+        settings.ExportParticles = settings.ExportParticles._replace(outputpath=path, min_length=0)
+        filename = os.path.join(path, timestamp.strftime('D%Y%m%dT%H%M%S.%f.h5'))
+
+        stats, imbw, saturation = statextract(imc, settings, timestamp, Model(), class_labels)
+        with h5py.File(filename, 'r') as fh:
+            rois = {name: fh[name][:] for name in fh if name != 'Meta'}
+
+        stats_mono, imbw, saturation = statextract(imc[:, :, 0], settings, timestamp, Model(), class_labels,
+                                                   imraw=imraw)
+        with h5py.File(filename, 'r') as fh:
+            rois_mono = {name: fh[name][:] for name in fh if name != 'Meta'}
+
+    #The particles and their geometry are the same
+    assert len(stats) == len(stats_mono) == 3
+    columns = ['major_axis_length', 'minor_axis_length', 'equivalent_diameter', 'minr', 'minc', 'maxr', 'maxc']
+    assert np.allclose(stats[columns], stats_mono[columns])
+
+    #The rois are cut from the corrected image, or from the raw image for a mono pipeline
+    assert len(rois) == len(rois_mono) == 3
+    for name, bbox in zip(stats['export name'], stats[['minr', 'minc', 'maxr', 'maxc']].values.astype(int)):
+        name = name.split('-')[-1]
+        assert np.array_equal(rois[name], extract_roi(imc, bbox))
+        assert np.array_equal(rois_mono[name], extract_roi(imraw, bbox))
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from pysilcam.scheduler import FrameScheduler
+
+
+def _simulate(scheduler, images, capacity, rate):
+    '''Acquire images faster than a worker processing rate images per image acquired'''
+    in_flight = 0
+    progress = 0.
+    for i, img in enumerate(images):
+        progress += rate
+        if progress >= 1 and in_flight > 0:
+            progress -= 1
+            in_flight -= 1
+
+        process, reason = scheduler.select(img, in_flight)
+        if process:
+            if in_flight < capacity:
+                in_flight += 1
+            else:
+                reason = 'full'
+        scheduler.record(i, pd.Timestamp('2018-01-01') + pd.Timedelta(seconds=i), reason)
+
+
+def test_stride_scheduler():
+    '''Testing that the stride policy processes evenly spaced images at the rate of the processing'''
+    images = [np.zeros((8, 8, 3), dtype=np.uint8)] * 3000
+    with tempfile.TemporaryDirectory() as path:
+        frames_log = os.path.join(path, 'test-FRAMES.csv')
+        scheduler = FrameScheduler(6, target=3, policy='stride', frames_log=frames_log)
+        _simulate(scheduler, images, 6, 1 / 3)
+        scheduler.close()
+
+        frames = pd.read_csv(frames_log)
+
+    #Check that every image is in the log
+    assert len(frames) == len(images)
+    assert np.array_equal(frames['frame'], np.arange(len(images)))
+
+    #Check that about one image in three is processed, evenly spaced, once the load is known
+    steady = frames.iloc[1000:]
+    queued = steady[steady['status'] == 'queued']
+    assert np.isclose(len(queued) / len(steady), 1 / 3, atol=0.01)
+    assert set(np.diff(queued['frame'])) <= {2, 3, 4}
+    assert not (steady['reason'] == 'full').any()
+    assert scheduler.nb_queued + scheduler.nb_skipped == len(images)
+
+
+def test_quality_scheduler():
+    '''Testing that the quality policy skips the images with the most uneven lighting, whatever their particles'''
+    np.random.seed(0)
+    gradients = np.random.rand(3000) * 50
+    nb_particles = np.random.randint(0, 40, 3000)
+    ramp = np.linspace(-0.5, 0.5, 64)[np.newaxis, :, np.newaxis]
+    images = []
+    for gradient, n in zip(gradients, nb_particles):
+        img = np.clip(np.random.normal(200, 5, (64, 64, 3)) + gradient * ramp, 0, 255)
+        for y, x in np.random.randint(0, 60, (n, 2)):
+            img[y:y + 4, x:x + 4] = 0
+        images.append(np.uint8(img))
+    scheduler = FrameScheduler(6, target=3, policy='quality')
+    queued = []
+    record = scheduler.record
+    scheduler.record = lambda i, timestamp, reason='': (record(i, timestamp, reason),
+                                                        queued.append(reason == ''))
+    _simulate(scheduler, images, 6, 1 / 4)
+
+    queued = np.array(queued[1000:])
+    assert np.isclose(np.mean(queued), 1 / 4, atol=0.03)
+    assert np.mean(gradients[1000:][queued]) < np.mean(gradients[1000:][~queued]) / 2
+
+    #The images with many particles are not skipped more than the others
+    assert np.isclose(np.mean(nb_particles[1000:][queued]), np.mean(nb_particles[1000:][~queued]), rtol=0.1)
+
+
+def test_newest_scheduler():
+    '''Testing that the newest policy queues every image, as without a scheduler'''
+    scheduler = FrameScheduler(6, policy='newest')
+    for in_flight in [0, 3, 6, 6]:
+        assert scheduler.select(None, in_flight) == (True, '')
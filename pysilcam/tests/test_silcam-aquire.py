@@ -28,3 +28,274 @@ def test_acquire_five_frames():
         #Try five frames, then break
         if i>5:
             break
+
+
+def test_disc_reader():
+    '''Testing that the prefetching disc reader returns the images in order, skipping unreadable files'''
+    import os
+    import tempfile
+    import pandas as pd
+    from pysilcam.discreader import DiscReader
+    from pysilcam.fakepymba import list_image_files
+
+    with tempfile.TemporaryDirectory() as path:
+        start = pd.Timestamp('2018-01-01 10:00:00')
+        images = []
+        for i in range(10):
+            filename = os.path.join(path, (start + pd.Timedelta(seconds=i)).strftime('D%Y%m%dT%H%M%S.%f.silc'))
+            img = np.random.randint(0, 256, (20, 30, 3)).astype(np.uint8)
+            if i == 3:
+                #Unreadable file
+                with open(filename, 'wb') as fh:
+                    fh.write(b'not an image')
+                continue
+            if i == 6:
+                #Grey-scale image
+                img[:, :, 1] = img[:, :, 0]
+                img[:, :, 2] = img[:, :, 0]
+                np.save(filename, img[:, :, 0])
+            else:
+                np.save(filename, img)
+            os.rename(filename + '.npy', filename)
+            images.append((start + pd.Timedelta(seconds=i), img))
+
+        reader = DiscReader(list_image_files(path), prefetch=3)
+        frames = [(timestamp, img.copy()) for timestamp, img in reader.frames()]
+        assert len(frames) == len(images)
+        for (timestamp, img), (timestamp_ref, img_ref) in zip(frames, images):
+            assert timestamp == timestamp_ref
+            assert np.array_equal(img, img_ref)
+
+        #Check that the memory used is bounded by the buffer pool
+        assert len(reader.buffers) == 5
+        for timestamp, img in reader.frames():
+            assert any(img is buffer for buffer in reader.buffers)
+
+
+def test_segments():
+    '''Testing that images written to segment files are read back in order, from .silc conversion or acquisition'''
+    import os
+    import tempfile
+    import pandas as pd
+    from pysilcam.segments import SegmentWriter, SegmentSet, list_segments, silc_to_segments
+
+    with tempfile.TemporaryDirectory() as path:
+        start = pd.Timestamp('2018-01-01 10:00:00')
+        images = [(start + pd.Timedelta(seconds=i), np.random.randint(0, 256, (20, 30, 3)).astype(np.uint8))
+                  for i in range(12)]
+        for timestamp, img in images:
+            np.save(os.path.join(path, timestamp.strftime('D%Y%m%dT%H%M%S.%f.silc')), img)
+            os.rename(os.path.join(path, timestamp.strftime('D%Y%m%dT%H%M%S.%f.silc.npy')),
+                      os.path.join(path, timestamp.strftime('D%Y%m%dT%H%M%S.%f.silc')))
+
+        segment_path = os.path.join(path, 'segments')
+        os.mkdir(segment_path)
+        assert silc_to_segments(path, segment_path, frames_per_segment=5) == 12
+        assert len(list_segments(segment_path)) == 3
+
+        #Images written after the last timestamp of the index are not read
+        writer = SegmentWriter(segment_path, frames_per_segment=5)
+        writer.write(start + pd.Timedelta(minutes=1), images[0][1])
+        writer.frames[1] = images[1][1]
+        writer.close()
+
+        segments = SegmentSet(segment_path, offset=2)
+        assert len(segments) == 11
+        for (timestamp, img), (timestamp_ref, img_ref) in zip(segments.frames(), images[2:]):
+            assert timestamp == timestamp_ref
+            assert np.array_equal(img, img_ref)
+        assert segments[10][0] == start + pd.Timedelta(minutes=1)
+
+        #Check that the acquisition reads the segments
+        aq = Acquire()
+        frames = list(aq.get_generator(segment_path))
+        os.environ.pop('PYSILCAM_TESTDATA')
+        assert len(frames) == 13
+        assert np.array_equal(frames[4][1], images[4][1])
+
+
+def test_file_index():
+    '''Testing that the file index follows the images added to and removed from a folder'''
+    import os
+    import tempfile
+    import pandas as pd
+    from pysilcam.fileindex import FileIndex
+
+    def image_name(i):
+        return (pd.Timestamp('2018-01-01 10:00:00') + pd.Timedelta(seconds=i)).strftime('D%Y%m%dT%H%M%S.%f.silc')
+
+    with tempfile.TemporaryDirectory() as path, tempfile.TemporaryDirectory() as cache_path:
+        for i in range(0, 20, 2):
+            open(os.path.join(path, image_name(i)), 'w').close()
+        open(os.path.join(path, 'config.ini'), 'w').close()
+
+        index_file = os.path.join(cache_path, 'index.npz')
+        index = FileIndex(path, ('.silc',), index_file=index_file, save_interval=0)
+        assert len(index) == 10
+        assert index.newest(2) == [os.path.join(path, image_name(16)), os.path.join(path, image_name(18))]
+
+        #Images added out of order and removed
+        open(os.path.join(path, image_name(5)), 'w').close()
+        open(os.path.join(path, image_name(30)), 'w').close()
+        os.remove(os.path.join(path, image_name(0)))
+        #Make sure the folder modification time changes on file systems with a coarse resolution
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10**9))
+        assert index.update()
+        assert index.files() == [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith('.silc')]
+        assert index.at(pd.Timestamp('2018-01-01 10:00:05.5')) == os.path.join(path, image_name(5))
+        assert index.at(pd.Timestamp('2018-01-01 09:00:00')) is None
+        assert index.timestamps()[-1] == pd.Timestamp('2018-01-01 10:00:30')
+
+        #Newer images are taken in without scanning the whole folder again
+        index = FileIndex(path, ('.silc',), index_file='', use_inotify=False)
+        scan = index._scan
+        index._scan = None
+        for i in range(31, 34):
+            open(os.path.join(path, image_name(i)), 'w').close()
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10**9))
+        assert index.update()
+        assert index.newest(3) == [os.path.join(path, image_name(i)) for i in range(31, 34)]
+        index._scan = scan
+        for i in range(31, 34):
+            os.remove(os.path.join(path, image_name(i)))
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10**9))
+        assert index.update()
+        assert len(index) == 11
+
+        #The saved index is used while the folder is unchanged
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns - 10 * 10**9))
+        index = FileIndex(path, ('.silc',), index_file=index_file, use_inotify=False)
+        index = FileIndex(path, ('.silc',), index_file=index_file, use_inotify=False)
+        assert index._load()
+        assert len(index) == 11
+
+
+def test_raw_frame_writer():
+    '''Testing that the raw image writer writes all images, or drops them following its policy'''
+    import os
+    import time
+    import tempfile
+    import pandas as pd
+    from pysilcam.framewriter import RawFrameWriter
+    from pysilcam.fakepymba import list_image_files
+    from pysilcam.segments import SegmentSet
+
+    class SlowWriter(RawFrameWriter):
+        def write(self, *args):
+            time.sleep(0.05)
+            super(SlowWriter, self).write(*args)
+
+    start = pd.Timestamp('2018-01-01 10:00:00')
+    images = [(start + pd.Timedelta(seconds=i), np.random.randint(0, 256, (20, 30, 3)).astype(np.uint8))
+              for i in range(10)]
+
+    for policy in ['block', 'drop-oldest', 'drop-newest']:
+        with tempfile.TemporaryDirectory() as path:
+            writer = SlowWriter(path, queue_size=2, policy=policy, fsync_frames=3)
+            writer.start()
+            queued = [writer.put(timestamp, img) for timestamp, img in images]
+            writer.close()
+
+            metrics = writer.metrics()
+            assert writer.error is None
+            assert metrics['frames_written'] + metrics['frames_dropped'] == 10
+            files = list_image_files(path)
+            assert len(files) == metrics['frames_written']
+            if policy == 'block':
+                assert metrics['frames_dropped'] == 0
+                for filename, (timestamp, img) in zip(files, images):
+                    assert np.array_equal(np.load(filename), img)
+            else:
+                assert metrics['frames_dropped'] > 0
+            if policy == 'drop-oldest':
+                #The newest images are kept
+                assert all(queued)
+                assert np.array_equal(np.load(files[-1]), images[-1][1])
+            if policy == 'drop-newest':
+                assert not all(queued)
+
+    #Images appended to segments
+    with tempfile.TemporaryDirectory() as path:
+        writer = RawFrameWriter(path, frames_per_segment=4)
+        writer.start()
+        for timestamp, img in images:
+            writer.put(timestamp, img)
+        writer.close()
+        segments = SegmentSet(path)
+        assert len(segments) == 10
+        assert np.array_equal(segments[9][1], images[9][1])
+
+
+def test_stream_frames():
+    '''Testing that continuous acquisition into several frames gives the images of single frame acquisition'''
+    import os
+    import tempfile
+    import pandas as pd
+
+    start = pd.Timestamp('2018-01-01 10:00:00')
+    images = [np.random.randint(0, 256, (20, 30, 3)).astype(np.uint8) for i in range(6)]
+    testdata = os.environ.get('PYSILCAM_TESTDATA')
+    try:
+        with tempfile.TemporaryDirectory() as path:
+            for i, img in enumerate(images):
+                timestamp = start + pd.Timedelta(seconds=i)
+                with open(os.path.join(path, timestamp.strftime('D%Y%m%dT%H%M%S.%f.silc')), 'wb') as fh:
+                    np.save(fh, img, allow_pickle=False)
+
+            for stream_buffers in [None, 1, 3]:
+                #Acquire until the end of the images
+                acquired = []
+                try:
+                    for timestamp, img in Acquire(stream_buffers=stream_buffers).get_generator_camera(path):
+                        acquired.append((timestamp, img))
+                except IndexError:
+                    pass
+
+                #The fake camera fills the frames faster than they are taken, so the oldest
+                #images may be dropped, but the images acquired are in order and the newest is kept
+                if stream_buffers is None:
+                    assert len(acquired) == len(images)
+                else:
+                    assert len(acquired) >= stream_buffers
+                indexes = [int((timestamp - start) / pd.Timedelta(seconds=1)) for timestamp, img in acquired]
+                assert indexes == sorted(set(indexes))
+                assert indexes[-1] == len(images) - 1
+                for i, (timestamp, img) in zip(indexes, acquired):
+                    assert np.array_equal(img, images[i])
+    finally:
+        if testdata is None:
+            os.environ.pop('PYSILCAM_TESTDATA', None)
+        else:
+            os.environ['PYSILCAM_TESTDATA'] = testdata
+
+
+def test_fake_camera_faults():
+    '''Testing the frame rate and the dropped and corrupted frames of the fake camera'''
+    import os
+    import time
+    from pysilcam import fakepymba
+
+    variables = {'PYSILCAM_FPS': '50', 'PYSILCAM_DROP_RATE': '0.3', 'PYSILCAM_CORRUPT_RATE': '0.3'}
+    environ = dict(os.environ)
+    try:
+        os.environ.pop('PYSILCAM_TESTDATA', None)
+        os.environ.update(variables)
+        np.random.seed(0)
+        frame = fakepymba.Frame()
+
+        start = time.time()
+        nb_corrupted = 0
+        for i in range(20):
+            img = np.frombuffer(frame.getBufferByteData(), dtype=np.float64)
+            img = img.reshape((frame.height, frame.width, 3))
+            #A corrupted frame misses its last rows
+            nb_corrupted += np.all(img[-1] == 0)
+        elapsed = time.time() - start
+
+        assert frame.frames_dropped > 0
+        assert frame.frames_corrupted == nb_corrupted > 0
+        #Each frame, dropped or not, takes one frame interval
+        assert elapsed > (20 + frame.frames_dropped - 1) / 50.
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
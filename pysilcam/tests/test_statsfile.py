@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from pysilcam.statsfile import (StatsFileWriter, read_stats_h5, stats_h5_filename, time_query,
+                                last_timestamp_h5)
+
+
+def make_stats(timestamp, nb_particles):
+    '''Particle statistics of one frame, as returned by processImage'''
+    stats = pd.DataFrame(np.random.rand(nb_particles, 4),
+                         columns=['major_axis_length', 'minor_axis_length',
+                                  'equivalent_diameter', 'solidity'])
+    stats['probability_oil'] = np.random.rand(nb_particles)
+    stats['export name'] = ['D{0}-PN{1}'.format(timestamp.strftime('%Y%m%dT%H%M%S.%f'), i)
+                            for i in range(nb_particles)]
+    stats['timestamp'] = timestamp
+    stats['saturation'] = 10.
+    return stats
+
+
+def test_stats_file_round_trip():
+    '''Testing that the -STATS.h5 file holds the same data as the -STATS.csv file'''
+    with tempfile.TemporaryDirectory() as path:
+        datafilename = os.path.join(path, 'test')
+        writer = StatsFileWriter(datafilename, frames_per_write=3)
+
+        start = pd.Timestamp('2018-01-01 10:00:00.123456')
+        for i in range(10):
+            stats = make_stats(start + pd.Timedelta(seconds=i), i % 4 + 1)
+            if i == 5:
+                # frame without particles and without export names
+                stats = stats.iloc[:1].copy()
+                stats.loc[:, ['major_axis_length', 'export name']] = np.nan
+
+            if not os.path.isfile(datafilename + '-STATS.csv'):
+                stats.to_csv(datafilename + '-STATS.csv', index_label='particle index')
+            else:
+                stats.to_csv(datafilename + '-STATS.csv', mode='a', header=False)
+            writer.append(stats)
+        writer.close()
+
+        assert stats_h5_filename(datafilename + '-STATS.csv') == datafilename + '-STATS.h5'
+
+        stats_csv = pd.read_csv(datafilename + '-STATS.csv')
+        stats_csv['timestamp'] = pd.to_datetime(stats_csv['timestamp'])
+        stats_h5 = read_stats_h5(datafilename + '-STATS.h5')
+
+        #Check that all columns and rows are the same
+        assert list(stats_h5.columns) == list(stats_csv.columns)
+        pd.testing.assert_frame_equal(stats_h5, stats_csv, check_dtype=False)
+
+
+def test_stats_file_time_query():
+    '''Testing that time queries only return the rows within the time window'''
+    with tempfile.TemporaryDirectory() as path:
+        datafilename = os.path.join(path, 'test')
+        writer = StatsFileWriter(datafilename, frames_per_write=4)
+        start = pd.Timestamp('2018-01-01 10:00:00')
+        for i in range(20):
+            writer.append(make_stats(start + pd.Timedelta(seconds=i), 3))
+        writer.close()
+
+        h5_file = datafilename + '-STATS.h5'
+        assert last_timestamp_h5(h5_file) == start + pd.Timedelta(seconds=19)
+        assert len(read_stats_h5(h5_file, where=time_query())) == 60
+
+        #Check that the window limits are excluded, as in trim_stats
+        stats = read_stats_h5(h5_file, where=time_query(start + pd.Timedelta(seconds=5),
+                                                        start + pd.Timedelta(seconds=10)))
+        assert len(stats) == 4 * 3
+        assert stats['timestamp'].min() == start + pd.Timedelta(seconds=6)
+        assert stats['timestamp'].max() == start + pd.Timedelta(seconds=9)
+
+        stats = read_stats_h5(h5_file, where=time_query(start_time=start + pd.Timedelta(seconds=15)))
+        assert len(stats) == 4 * 3
+
+
+def test_stats_writer():
+    '''Testing that the stats writer thread writes the same -STATS.csv file as writing each frame'''
+    import queue
+    from pysilcam.statswriter import StatsWriter
+
+    with tempfile.TemporaryDirectory() as path:
+        datafilename = os.path.join(path, 'test')
+        stats_queue = queue.Queue()
+        received = []
+        writer = StatsWriter(datafilename, stats_queue, nb_producers=2, on_stats=received.append,
+                             frames_per_write=4)
+        writer.start()
+
+        start = pd.Timestamp('2018-01-01 10:00:00')
+        frames = [make_stats(start + pd.Timedelta(seconds=i), i % 3 + 1) for i in range(10)]
+        for i, stats in enumerate(frames):
+            stats_queue.put((i, stats['timestamp'].iloc[0], stats))
+        stats_queue.put(None)
+        stats_queue.put(None)
+        writer.join(timeout=30)
+
+        assert not writer.is_alive()
+        assert writer.error is None
+        assert len(received) == 10
+        metrics = writer.metrics()
+        assert metrics['frames_written'] == 10
+        assert metrics['queue_depth'] == 0
+
+        reference = os.path.join(path, 'reference.csv')
+        frames[0].to_csv(reference, index_label='particle index')
+        for stats in frames[1:]:
+            stats.to_csv(reference, mode='a', header=False)
+        with open(reference) as fh_ref, open(datafilename + '-STATS.csv') as fh:
+            assert fh.read() == fh_ref.read()
+
+        assert len(read_stats_h5(datafilename + '-STATS.h5')) == sum(len(s) for s in frames)
+
+
+def test_stats_writer_checkpoint():
+    '''Testing that the checkpoint manifest allows the stats files to be cut back to the last checkpoint'''
+    import queue
+    from pysilcam.statswriter import StatsWriter, read_checkpoint
+    from pysilcam.statsfile import stats_h5_rows, truncate_stats_h5
+
+    with tempfile.TemporaryDirectory() as path:
+        datafilename = os.path.join(path, 'test')
+        assert read_checkpoint(datafilename) is None
+
+        start = pd.Timestamp('2018-01-01 10:00:00')
+        frames = [make_stats(start + pd.Timedelta(seconds=i), 2) for i in range(6)]
+        stats_queue = queue.Queue()
+        writer = StatsWriter(datafilename, stats_queue, frames_per_write=2)
+        writer.start()
+        for i, stats in enumerate(frames):
+            stats_queue.put((i, stats['timestamp'].iloc[0], stats))
+        stats_queue.put(None)
+        writer.join(timeout=30)
+        assert writer.error is None
+
+        checkpoint = read_checkpoint(datafilename)
+        assert checkpoint['finished']
+        assert checkpoint['frames_written'] == 6
+        assert checkpoint['resume_timestamp'] == start + pd.Timedelta(seconds=5)
+        assert checkpoint['done_after'] == []
+        assert checkpoint['stats_csv_bytes'] == os.path.getsize(datafilename + '-STATS.csv')
+        assert checkpoint['stats_h5_rows'] == stats_h5_rows(datafilename + '-STATS.h5') == 12
+
+        #Append the stats of an interrupted run, then cut the files back to the checkpoint
+        with open(datafilename + '-STATS.csv', 'a') as fh:
+            frames[0].to_csv(fh, header=False)
+        writer = StatsFileWriter(datafilename)
+        writer.append(frames[0])
+        writer.flush()
+        assert stats_h5_rows(datafilename + '-STATS.h5') == 14
+
+        truncate_stats_h5(datafilename + '-STATS.h5', checkpoint['stats_h5_rows'])
+        assert len(read_stats_h5(datafilename + '-STATS.h5')) == 12
+        assert last_timestamp_h5(datafilename + '-STATS.h5') == checkpoint['resume_timestamp']
+
+        #A run appending to the files continues the count of frames
+        writer = StatsWriter(datafilename, queue.Queue())
+        assert writer.previous_frames == 6
+
+
+def test_stats_writer_out_of_order():
+    '''Testing that the checkpoint only moves past the images before which every image is done'''
+    import queue
+    from pysilcam.statswriter import StatsWriter, read_checkpoint
+
+    with tempfile.TemporaryDirectory() as path:
+        datafilename = os.path.join(path, 'test')
+        start = pd.Timestamp('2018-01-01 10:00:00')
+        times = [start + pd.Timedelta(seconds=i) for i in range(6)]
+
+        #The workers finish out of order: image 4 gave no stats, and the run stops before image 3 is done
+        stats_queue = queue.Queue()
+        writer = StatsWriter(datafilename, stats_queue, frames_per_write=1)
+        writer.start()
+        for i in [2, 1, 4, 0, 5]:
+            stats_queue.put((i, times[i], None if i == 4 else make_stats(times[i], 2)))
+        writer.stop()
+        writer.join(timeout=30)
+        assert writer.error is None
+
+        checkpoint = read_checkpoint(datafilename)
+        assert checkpoint['frames_written'] == 4
+        assert checkpoint['resume_timestamp'] == times[2]
+        assert checkpoint['done_after'] == [times[4], times[5]]
+
+        #The resumed run starts after image 2, and skips the images already done
+        stats_queue = queue.Queue()
+        writer = StatsWriter(datafilename, stats_queue, frames_per_write=1)
+        writer.start()
+        for i, timestamp in enumerate(times[3:]):
+            done = timestamp in checkpoint['done_after']
+            stats_queue.put((i, timestamp, None if done else make_stats(timestamp, 2)))
+        stats_queue.put(None)
+        writer.join(timeout=30)
+        assert writer.error is None
+
+        checkpoint = read_checkpoint(datafilename)
+        assert checkpoint['frames_written'] == 5
+        assert checkpoint['resume_timestamp'] == times[5]
+        assert checkpoint['done_after'] == []
+
+        stats = pd.read_csv(datafilename + '-STATS.csv', parse_dates=['timestamp'])
+        assert sorted(stats['timestamp'].unique()) == [times[i] for i in [0, 1, 2, 3, 5]]
+        assert len(read_stats_h5(datafilename + '-STATS.h5')) == 10
+
+
+def test_stats_writer_after_last_producer():
+    '''Testing that the stats put in the queue after the None of the last producer are still written'''
+    import queue
+    from pysilcam.statswriter import StatsWriter, read_checkpoint
+
+    with tempfile.TemporaryDirectory() as path:
+        datafilename = os.path.join(path, 'test')
+        start = pd.Timestamp('2018-01-01 10:00:00')
+        times = [start + pd.Timedelta(seconds=i) for i in range(3)]
+
+        #Both producers have finished before the stats of the first image come out of the queue
+        stats_queue = queue.Queue()
+        stats_queue.put((1, times[1], make_stats(times[1], 2)))
+        stats_queue.put(None)
+        stats_queue.put(None)
+        stats_queue.put((0, times[0], make_stats(times[0], 2)))
+        stats_queue.put((2, times[2], None))
+        writer = StatsWriter(datafilename, stats_queue, nb_producers=2, frames_per_write=1)
+        writer.start()
+        writer.join(timeout=30)
+        assert writer.error is None
+
+        checkpoint = read_checkpoint(datafilename)
+        assert checkpoint['frames_written'] == 2
+        assert checkpoint['resume_timestamp'] == times[2]
+        assert len(read_stats_h5(datafilename + '-STATS.h5')) == 4
+
+
+def test_stats_writer_error():
+    '''Testing that the producers can still finish when the stats cannot be written'''
+    import queue
+    from pysilcam.statswriter import StatsWriter
+
+    with tempfile.TemporaryDirectory() as path:
+        datafilename = os.path.join(path, 'test')
+
+        #The disc is full: every write fails
+        def write():
+            raise OSError(28, 'No space left on device')
+
+        stats_queue = queue.Queue(2)
+        writer = StatsWriter(datafilename, stats_queue, frames_per_write=1)
+        writer.write = write
+        writer.start()
+
+        start = pd.Timestamp('2018-01-01 10:00:00')
+        for i in range(20):
+            timestamp = start + pd.Timedelta(seconds=i)
+            stats_queue.put((i, timestamp, make_stats(timestamp, 2)), timeout=10)
+        stats_queue.put(None, timeout=10)
+        writer.join(timeout=30)
+
+        assert not writer.is_alive()
+        assert isinstance(writer.error, OSError)
+
+
+def test_load_stale_stats_h5():
+    '''Testing that load_stats only uses the -STATS.h5 file if it is as new as the -STATS.csv file'''
+    from pysilcam.postprocess import load_stats, stats_h5_is_current
+
+    with tempfile.TemporaryDirectory() as path:
+        datafilename = os.path.join(path, 'test')
+        csv_file = datafilename + '-STATS.csv'
+        start = pd.Timestamp('2018-01-01 10:00:00')
+        frames = [make_stats(start + pd.Timedelta(seconds=i), 2) for i in range(4)]
+
+        writer = StatsFileWriter(datafilename)
+        frames[0].to_csv(csv_file, index_label='particle index')
+        writer.append(frames[0])
+        writer.close()
+        assert stats_h5_is_current(csv_file)
+        assert len(load_stats(csv_file)) == 2
+
+        #Stats appended to the -STATS.csv file only
+        for stats in frames[1:]:
+            stats.to_csv(csv_file, mode='a', header=False)
+        h5_time = os.path.getmtime(datafilename + '-STATS.h5')
+        os.utime(csv_file, (h5_time + 1, h5_time + 1))
+        assert not stats_h5_is_current(csv_file)
+        assert len(load_stats(csv_file)) == 8
+        assert len(load_stats(csv_file, start_time=start)) == 6
+
+        #The -STATS.h5 file is used when asked for
+        assert len(load_stats(datafilename + '-STATS.h5')) == 2
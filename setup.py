@@ -64,6 +64,10 @@ setup(
         'Programming Language :: Python :: 3.6',
     ],
     packages=['pysilcam'],
+    extras_require={
+        # follow new images with inotify instead of polling the folder (Linux)
+        'inotify': ['inotify_simple'],
+    },
     entry_points={
         'console_scripts': [
             'silcam = pysilcam.__main__:silcam',
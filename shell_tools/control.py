@@ -10,6 +10,7 @@ import skimage.io
 import pickle
 #from investigate_particles import *
 import pysilcam.postprocess as scpp
+from pysilcam.fileindex import get_file_index
 from pysilcam.config import load_config, PySilcamSettings
 import pandas as pd
 import os
@@ -87,9 +88,10 @@ class guiclass:
         #montxt = "ls /mnt/DATA/ | wc -l | awk '{{print $1}}'"
         #prc = subprocess.Popen([montxt], shell=True, stdout=subprocess.PIPE)
         #nimages = prc.stdout.read().decode('ascii').strip()
-        files = [os.path.join(DATADIR, f) for f in sorted(os.listdir(DATADIR))]
-        nimages = str(len(files))
-        if len(files) > 3:
+        index = get_file_index(DATADIR)
+        files = index.newest(3)
+        nimages = str(len(index))
+        if len(index) > 3:
 
             name1 = os.path.split(files[-3])[1]
             ts1 = pd.to_datetime(name1[1:-4])
@@ -135,7 +137,7 @@ class guiclass:
             return
         self.lvbt.configure(bg = "green")
         try:
-            files = [os.path.join(DATADIR, f) for f in sorted(os.listdir(DATADIR))]
+            files = get_file_index(DATADIR).newest(4)
             imfile = files[-4]
 
             name = os.path.split(imfile)[1]